@@ -1,34 +1,57 @@
 import os
 import logging
 import shutil
+import subprocess
 import json
 import uuid
 import re
 import mimetypes
 import socket
-import base64
-import imghdr
-from urllib.parse import urlparse, urlunparse, parse_qs
+import sqlite3
+import gzip
+import hashlib
+import hmac
+import multiprocessing
+import sys
+import math
+import random
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qs, quote
 from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
-from flask import Flask, request, jsonify, render_template, send_from_directory, after_this_request
+from flask import Flask, Response, request, jsonify, make_response, redirect, render_template, send_file, after_this_request, url_for
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 from dotenv import load_dotenv
 import yt_dlp
+import cover_worker
+import download_worker
+from cover_worker import PILLOW_AVAILABLE
+from download_worker import MUTAGEN_AVAILABLE, PLAYLIST_CONTEXT_KEYS, DurationMatchFilter, RetryBackoff, TranscodeScheduler, is_network_failure
 
 try:
-    from mutagen.easyid3 import EasyID3
-    try:
-        EasyID3.RegisterTextKey('comment', 'COMM')
-    except Exception:  
-        pass
-    from mutagen.id3 import ID3NoHeaderError, APIC
-    from mutagen.mp3 import MP3
-    from mutagen.mp4 import MP4, MP4Cover
-    from mutagen.oggopus import OggOpus
-    from mutagen.flac import Picture
-    MUTAGEN_AVAILABLE = True
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка манифеста недоступна
+    fcntl = None
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
 except ImportError:
-    MUTAGEN_AVAILABLE = False
+    BROTLI_AVAILABLE = False
 
 load_dotenv()
 
@@ -39,15 +62,29 @@ logger = logging.getLogger(__name__)
 
 if not MUTAGEN_AVAILABLE:
     logger.warning("Библиотека mutagen не установлена. Теги исполнителя не будут добавлены в медиафайлы.")
+if not PILLOW_AVAILABLE:
+    logger.warning("Библиотека Pillow не установлена. Обложки будут встраиваться без обрезки и уменьшения.")
 
 app = Flask(__name__)
 
+# Количество доверенных обратных прокси перед приложением (для определения IP клиента по X-Forwarded-For)
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
 # Базовая директория приложения
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Директория для временных загрузок пользователей
 USER_DOWNLOADS_DIR = os.path.join(BASE_DIR, "user_downloads")
 # Директория для HTML-шаблонов
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
+# Статика и её сборка: копии с хешем содержимого в имени и сжатые варианты (gzip, brotli)
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+ASSET_BUILD_DIR = os.getenv('ASSET_BUILD_DIR', os.path.join(BASE_DIR, '.assets'))
+STATIC_FINGERPRINT_ENABLED = os.getenv('STATIC_FINGERPRINT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ASSET_MAX_AGE_SECONDS = 365 * 24 * 3600
+ASSET_COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.json', '.html', '.svg', '.txt')
+ASSET_MANIFEST_FILENAME = 'manifest.json'
 
 if not os.path.exists(USER_DOWNLOADS_DIR):
     os.makedirs(USER_DOWNLOADS_DIR)
@@ -83,15 +120,1147 @@ DEFAULT_ALBUM_NAME = os.getenv('DEFAULT_ALBUM_NAME', "Music Jacker Downloads")
 # Ограничение длительности контента (10 минут в секундах)
 DURATION_LIMIT_SECONDS = 600
 SEARCH_RESULTS_LIMIT = 10 # Лимит результатов поиска для поиска
+SUPPORTED_FORMATS = ('mp3', 'm4a', 'opus', 'mp4')
 PLAYLIST_DURATION_CHECK_LIMIT = int(os.getenv('PLAYLIST_DURATION_CHECK_LIMIT', '50'))
 
+# Планировщик ffmpeg: не больше одного процесса на ядро, лишние задачи ждут в очереди
+CPU_COUNT = os.cpu_count() or 1
+FFMPEG_MAX_CONCURRENT_JOBS = int(os.getenv('FFMPEG_MAX_CONCURRENT_JOBS', str(CPU_COUNT)))
+FFMPEG_THREADS_PER_JOB = int(os.getenv('FFMPEG_THREADS_PER_JOB', '0'))  # 0 — поделить ядра между задачами
+FFMPEG_NICE_LEVEL = int(os.getenv('FFMPEG_NICE_LEVEL', '10'))
+
+# Контроль нагрузки: лимит запросов на клиента (token bucket) и ограничение одновременных загрузок
+RATE_LIMIT_REQUESTS_PER_MINUTE = float(os.getenv('RATE_LIMIT_REQUESTS_PER_MINUTE', '6'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '3'))
+# Выданные клиентам ключи X-API-Key через запятую; с неизвестным ключом клиент считается по IP
+API_KEYS = frozenset(key.strip() for key in os.getenv('API_KEYS', '').split(',') if key.strip())
+MAX_ACTIVE_DOWNLOADS = int(os.getenv('MAX_ACTIVE_DOWNLOADS', '6'))
+MAX_TRANSCODE_QUEUE = int(os.getenv('MAX_TRANSCODE_QUEUE', str(FFMPEG_MAX_CONCURRENT_JOBS * 2)))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '15'))
+
+# Справедливое распределение слотов загрузки между клиентами с учётом длительности контента
+DOWNLOAD_WORKER_SLOTS = int(os.getenv('DOWNLOAD_WORKER_SLOTS', '4'))
+DEFAULT_JOB_COST_SECONDS = int(os.getenv('DEFAULT_JOB_COST_SECONDS', '240'))
+
+# Несколько узлов: общее состояние сессий и пересылка /serve_file на узел-владелец файла
+NODE_ID = os.getenv('NODE_ID') or socket.gethostname()
+NODE_URL = os.getenv('NODE_URL', '').rstrip('/')  # адрес этого узла, доступный другим узлам (например, http://10.0.0.5:8080)
+# Публичный адрес этого узла для браузеров (например, https://node1.example.com); без него режим redirect проксирует
+NODE_PUBLIC_URL = os.getenv('NODE_PUBLIC_URL', '').rstrip('/')
+SESSION_STATE_BACKEND = os.getenv('SESSION_STATE_BACKEND', 'sqlite').lower()  # sqlite | redis
+SESSION_STATE_SQLITE_PATH = os.getenv('SESSION_STATE_SQLITE_PATH', os.path.join(USER_DOWNLOADS_DIR, '.session_state.sqlite3'))
+SESSION_STATE_REDIS_URL = os.getenv('SESSION_STATE_REDIS_URL', 'redis://localhost:6379/0')
+SESSION_STATE_TTL_SECONDS = int(os.getenv('SESSION_STATE_TTL_SECONDS', '3600'))
+SERVE_FILE_FORWARD_MODE = os.getenv('SERVE_FILE_FORWARD_MODE', 'proxy').lower()  # proxy | redirect
+SERVE_FILE_PROXY_TIMEOUT_SECONDS = int(os.getenv('SERVE_FILE_PROXY_TIMEOUT_SECONDS', '30'))
+FORWARDED_BY_NODE_HEADER = 'X-MusicJacker-Forwarded-By'
+
+# RAM-уровень (tmpfs) для небольших сессий с переносом на диск при нехватке бюджета
+MEMORY_STORE_ENABLED = os.getenv('MEMORY_STORE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+MEMORY_STORE_DIR = os.getenv('MEMORY_STORE_DIR', '/dev/shm/musicjacker')
+MEMORY_STORE_MAX_SESSION_BYTES = int(os.getenv('MEMORY_STORE_MAX_SESSION_BYTES', str(32 * 1024 * 1024)))
+MEMORY_STORE_MAX_FILE_BYTES = int(os.getenv('MEMORY_STORE_MAX_FILE_BYTES', str(16 * 1024 * 1024)))
+MEMORY_STORE_BUDGET_BYTES = int(os.getenv('MEMORY_STORE_BUDGET_BYTES', str(256 * 1024 * 1024)))
+
+# Пакетная загрузка нескольких URL одним запросом
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '25'))
+# Пакеты списывают элементы из отдельного ведра клиента: запас ведра — целый пакет, пополнение — элементов в минуту
+BATCH_RATE_LIMIT_ITEMS_PER_MINUTE = float(os.getenv('BATCH_RATE_LIMIT_ITEMS_PER_MINUTE', '30'))
+BATCH_PROBE_CONCURRENCY = int(os.getenv('BATCH_PROBE_CONCURRENCY', '4'))
+BATCH_DOWNLOAD_CONCURRENCY = int(os.getenv('BATCH_DOWNLOAD_CONCURRENCY', str(DOWNLOAD_WORKER_SLOTS)))
+# Профили загрузки по источникам и их подстройка по измеренной скорости
+DOWNLOAD_ADAPTIVE_TUNING = os.getenv('DOWNLOAD_ADAPTIVE_TUNING', 'true').lower() in ('1', 'true', 'yes')
+DOWNLOAD_MAX_CONCURRENT_FRAGMENTS = int(os.getenv('DOWNLOAD_MAX_CONCURRENT_FRAGMENTS', '16'))
+DOWNLOAD_TUNING_MIN_BYTES = int(os.getenv('DOWNLOAD_TUNING_MIN_BYTES', str(2 * 1024 * 1024)))  # мелкие загрузки не показательны
+DOWNLOAD_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv('DOWNLOAD_RETRY_BACKOFF_MAX_SECONDS', '30'))
+# Предзагрузка метаданных и обложек первых результатов поиска (0 отключает)
+SEARCH_PREFETCH_TOP_N = int(os.getenv('SEARCH_PREFETCH_TOP_N', '3'))
+SEARCH_PREFETCH_WORKERS = int(os.getenv('SEARCH_PREFETCH_WORKERS', '2'))
+SEARCH_PREFETCH_TTL_SECONDS = int(os.getenv('SEARCH_PREFETCH_TTL_SECONDS', '300'))
+SEARCH_PREFETCH_MAX_ENTRIES = int(os.getenv('SEARCH_PREFETCH_MAX_ENTRIES', '128'))
+# Ленивый режим плейлиста: элементы читаются и скачиваются по одному, ответ приходит потоком NDJSON
+LAZY_PLAYLIST_MAX_ITEMS = int(os.getenv('LAZY_PLAYLIST_MAX_ITEMS', '500'))
+LAZY_PLAYLIST_ADMISSION_POLL_SECONDS = float(os.getenv('LAZY_PLAYLIST_ADMISSION_POLL_SECONDS', '2'))
+
 THUMBNAIL_TIMEOUT_SECONDS = int(os.getenv('THUMBNAIL_TIMEOUT_SECONDS', '12'))
 MAX_THUMBNAIL_SIZE_BYTES = int(os.getenv('MAX_THUMBNAIL_SIZE_BYTES', str(5 * 1024 * 1024)))
 
+# Обработка обложек: квадрат по центру, уменьшение и JPEG, в отдельных процессах
+COVER_ART_SIZE = int(os.getenv('COVER_ART_SIZE', '600'))
+COVER_ART_JPEG_QUALITY = int(os.getenv('COVER_ART_JPEG_QUALITY', '88'))
+COVER_PROCESS_WORKERS = int(os.getenv('COVER_PROCESS_WORKERS', '2'))
+COVER_CACHE_MAX_BYTES = int(os.getenv('COVER_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Профилирование запросов (по умолчанию выключено)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))  # доля профилируемых запросов, 0..1
+PROFILE_ADMIN_TOKEN = os.getenv('PROFILE_ADMIN_TOKEN', '')  # запрос с этим токеном в PROFILE_HEADER профилируется всегда
+PROFILE_HEADER = 'X-Profile-Token'
+PROFILE_OUTPUT_DIR = os.getenv('PROFILE_OUTPUT_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '200'))  # старые профили сверх лимита удаляются, 0 — хранить все
+
+# Отрицательный кеш (приватный, удалённый, заблокированный контент) и предохранители источников
+NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv('NEGATIVE_CACHE_TTL_SECONDS', '300'))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv('NEGATIVE_CACHE_MAX_ENTRIES', '2048'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # 0 отключает предохранители
+CIRCUIT_RESET_SECONDS = int(os.getenv('CIRCUIT_RESET_SECONDS', '60'))
+
+# --- Планировщик транскодирования ---
+TRANSCODE_SCHEDULER = TranscodeScheduler(FFMPEG_MAX_CONCURRENT_JOBS, FFMPEG_THREADS_PER_JOB, FFMPEG_NICE_LEVEL)
+logger.info(
+    f"Транскодирование: до {TRANSCODE_SCHEDULER.max_jobs} процессов ffmpeg одновременно, "
+    f"{TRANSCODE_SCHEDULER.threads_per_job} потоков на задачу, nice={FFMPEG_NICE_LEVEL}."
+)
+download_worker.use_transcode_scheduler(TRANSCODE_SCHEDULER)
+
+
+# --- Контроль нагрузки ---
+class TokenBucketLimiter:
+    """Ограничивает частоту запросов для каждого клиента по алгоритму token bucket."""
+
+    def __init__(self, rate_per_minute, burst, idle_ttl_seconds=900):
+        self.rate_per_second = max(rate_per_minute, 0) / 60.0
+        self.burst = max(1, burst)
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._last_prune = time.monotonic()
+
+    def _prune(self, now):
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        stale = [key for key, (_, updated) in self._buckets.items() if now - updated > self.idle_ttl_seconds]
+        for key in stale:
+            del self._buckets[key]
+
+    def try_acquire(self, client_key, cost=1):
+        """
+        Списывает токены клиента. Возвращает (разрешено, через сколько секунд повторить).
+        Запрос дороже полного ведра не пройдёт никогда: для него возвращается (False, None).
+        """
+        if self.rate_per_second <= 0:
+            return True, 0
+        if cost > self.burst:
+            return False, None
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            tokens, updated = self._buckets.get(client_key, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - updated) * self.rate_per_second)
+            if tokens >= cost:
+                self._buckets[client_key] = (tokens - cost, now)
+                return True, 0
+            self._buckets[client_key] = (tokens, now)
+            missing = cost - tokens
+            return False, max(1, math.ceil(missing / self.rate_per_second))
+
+
+class DownloadAdmission:
+    """Пропускает новые загрузки только при наличии свободной мощности конвейера."""
+
+    def __init__(self, max_active, max_transcode_queue):
+        self.max_active = max(1, max_active)
+        self.max_transcode_queue = max(0, max_transcode_queue)
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def try_enter(self):
+        transcode_queued = TRANSCODE_SCHEDULER.stats()["queued"]
+        with self._lock:
+            if self._active >= self.max_active or transcode_queued > self.max_transcode_queue:
+                return False
+            self._active += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self._active = max(0, self._active - 1)
+
+    def capacity(self):
+        transcode = TRANSCODE_SCHEDULER.stats()
+        with self._lock:
+            active = self._active
+        remaining = max(0, self.max_active - active)
+        if transcode["queued"] > self.max_transcode_queue:
+            remaining = 0
+        return {
+            "active_downloads": active,
+            "max_active_downloads": self.max_active,
+            "remaining": remaining,
+            "downloads": DOWNLOAD_SCHEDULER.stats(),
+            "transcode": transcode,
+        }
+
+
+class FairDownloadScheduler:
+    """
+    Раздаёт ограниченное число слотов загрузки по взвешенной справедливой очереди (start-time fair queueing).
+    Стоимость задачи — длительность контента: каждый следующий элемент плейлиста клиента встаёт в очередь
+    за уже выданной ему работой. Задачи выдаются по метке начала, а виртуальное время переходит к метке начала
+    выданной задачи, поэтому большая задача ждёт не больше, чем уже стоявшие перед ней, и не голодает.
+    """
+
+    def __init__(self, slots, default_cost):
+        self.slots = max(1, slots)
+        self.default_cost = max(1, default_cost)
+        self._cond = threading.Condition()
+        self._free = self.slots
+        self._waiting = []
+        self._client_finish = {}
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+
+    def _cost(self, duration):
+        try:
+            duration = float(duration)
+        except (TypeError, ValueError):
+            return float(self.default_cost)
+        return duration if duration > 0 else float(self.default_cost)
+
+    @contextmanager
+    def slot(self, client_key, duration=None):
+        """Блокирует поток до получения слота загрузки и освобождает слот по выходу из блока."""
+        with self._cond:
+            start_tag = max(self._virtual_time, self._client_finish.get(client_key, 0.0))
+            finish_tag = start_tag + self._cost(duration)
+            self._client_finish[client_key] = finish_tag
+            ticket = (start_tag, next(self._sequence), finish_tag)
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while self._free == 0 or self._waiting[0] is not ticket:
+                    self._cond.wait()
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._free -= 1
+            self._virtual_time = max(self._virtual_time, start_tag)
+            self._client_finish = {key: tag for key, tag in self._client_finish.items() if tag > self._virtual_time}
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._free += 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"slots": self.slots, "busy": self.slots - self._free, "waiting": len(self._waiting)}
+
+
+RATE_LIMITER = TokenBucketLimiter(RATE_LIMIT_REQUESTS_PER_MINUTE, RATE_LIMIT_BURST)
+BATCH_RATE_LIMITER = TokenBucketLimiter(BATCH_RATE_LIMIT_ITEMS_PER_MINUTE, BATCH_MAX_ITEMS)
+DOWNLOAD_ADMISSION = DownloadAdmission(MAX_ACTIVE_DOWNLOADS, MAX_TRANSCODE_QUEUE)
+DOWNLOAD_SCHEDULER = FairDownloadScheduler(DOWNLOAD_WORKER_SLOTS, DEFAULT_JOB_COST_SECONDS)
+
+
+def client_key_from(api_key, remote_addr):
+    """
+    Определяет клиента для лимитов: по API-ключу из API_KEYS, иначе по IP.
+    Неизвестный ключ игнорируется, чтобы случайными ключами нельзя было получать новые вёдра токенов.
+    """
+    api_key = (api_key or '').strip()
+    if api_key and api_key in API_KEYS:
+        return f"key:{api_key}"
+    return f"ip:{remote_addr or 'unknown'}"
+
+
+def rate_limiter_for(limit):
+    """Ведро токенов для вида лимита: 'batch' — элементы пакетов, иначе — обычные запросы."""
+    return BATCH_RATE_LIMITER if limit == 'batch' else RATE_LIMITER
+
+
+def oversized_request_message(limiter):
+    return f"Запрос больше, чем позволяет лимит клиента: не больше {limiter.burst} элементов за раз."
+
+
+def get_client_key():
+    return client_key_from(request.headers.get('X-API-Key'), request.remote_addr)
+
+
+def reject_request(status_code, message, retry_after):
+    response = jsonify({"status": "error", "message": message, "retry_after": retry_after})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def admission_controlled(route=None, *, cost=None, limit=None):
+    """
+    Декоратор маршрутов загрузки: отклоняет запрос сразу (503/429), если мощности или лимита клиента не хватает.
+    cost — функция от JSON тела запроса, возвращающая число списываемых токенов (по умолчанию 1);
+    limit — вид лимита для rate_limiter_for.
+    """
+    if route is None:
+        return lambda wrapped_route: admission_controlled(wrapped_route, cost=cost, limit=limit)
+
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        # Сначала лимит клиента: отклонённый по лимиту запрос не должен даже на миг занимать место загрузки
+        client_key = get_client_key()
+        request_cost = cost(request.get_json(silent=True) or {}) if cost else 1
+        limiter = rate_limiter_for(limit)
+        allowed, retry_after = limiter.try_acquire(client_key, request_cost)
+        if not allowed and retry_after is None:
+            return jsonify({"status": "error", "message": oversized_request_message(limiter)}), 400
+        if not allowed:
+            logger.warning(f"Превышен лимит запросов для клиента {client_key}.")
+            return reject_request(429, "Слишком много запросов. Попробуйте повторить запрос позже.", retry_after)
+        if not DOWNLOAD_ADMISSION.try_enter():
+            logger.warning("Запрос на загрузку отклонён: сервер перегружен.")
+            return reject_request(503, "Сервер перегружен. Попробуйте повторить запрос позже.", ADMISSION_RETRY_AFTER_SECONDS)
+        # Потоковый ответ (ленивый плейлист) освобождает место при выходе из маршрута:
+        # дальше каждый его элемент сам занимает место и токен клиента, см. iter_lazy_playlist
+        try:
+            return route(*args, **kwargs)
+        finally:
+            DOWNLOAD_ADMISSION.leave()
+    return wrapper
+
+
+# --- Профилирование запросов ---
+_PROFILE_STATE = threading.local()
+
+
+class RequestProfile:
+    """
+    Сэмплирующий профиль одного запроса: фоновый поток периодически снимает стек потока запроса
+    и копит его в формате folded stacks (flamegraph.pl, speedscope). Фазы дают разбивку по wall-времени.
+    Работа в пулах (ffmpeg, обложки, процессы загрузок) видна как ожидание результата в потоке запроса.
+    Потоковый ответ профилируется до закрытия потока через stream().
+    """
+
+    def __init__(self, name, sample_interval):
+        self.name = name
+        self.sample_interval = sample_interval
+        self.profile_name = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+        self.thread_id = threading.get_ident()
+        self.samples = {}
+        self.phases = OrderedDict()
+        self._phase_stack = []
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{name}", daemon=True)
+        self._started = None
+        self._finish_lock = threading.Lock()
+        self._finished = False
+        self._result = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self.attach()
+        self._sampler.start()
+
+    def attach(self):
+        """Сэмплирует текущий поток и включает в нём profile_phase."""
+        self.thread_id = threading.get_ident()
+        _PROFILE_STATE.profile = self
+
+    def detach(self):
+        """Приостанавливает сэмплирование: поток занялся чужой работой."""
+        self.thread_id = None
+        _PROFILE_STATE.profile = None
+
+    def stream(self, events):
+        """
+        Продолжает профиль на время отдачи потокового ответа: сэмплируется поток, выполняющий очередной шаг генератора
+        (в ASGI шаги идут в разных потоках), а не запись в сокет между шагами. Профиль завершается при закрытии потока.
+        """
+        events = iter(events)
+        try:
+            while True:
+                self.attach()
+                try:
+                    event = next(events)
+                except StopIteration:
+                    return
+                finally:
+                    self.detach()
+                yield event
+        finally:
+            close = getattr(events, 'close', None)
+            if close:
+                close()
+            self.finish()
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                folded = ';'.join(reversed(stack))
+                self.samples[folded] = self.samples.get(folded, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        path = '/'.join(self._phase_stack + [name])
+        self._phase_stack.append(name)
+        phase_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._phase_stack.pop()
+            self.phases[path] = self.phases.get(path, 0.0) + time.perf_counter() - phase_started
+
+    def finish(self):
+        """
+        Останавливает сэмплирование, пишет профиль на диск и логирует разбивку по фазам. Возвращает имя файла или None.
+        Повторный вызов возвращает тот же результат.
+        """
+        with self._finish_lock:
+            if not self._finished:
+                self._finished = True
+                self._result = self._write()
+            return self._result
+
+    def _write(self):
+        self._stop.set()
+        self._sampler.join()
+        total = time.perf_counter() - self._started
+        top_level = sum(duration for path, duration in self.phases.items() if '/' not in path)
+        breakdown = ', '.join(f"{path} {duration:.3f} с" for path, duration in self.phases.items())
+        logger.info(f"Профиль {self.name}: всего {total:.3f} с; {breakdown or 'фаз нет'}; вне фаз {max(total - top_level, 0.0):.3f} с; сэмплов {sum(self.samples.values())}.")
+
+        profile_name = self.profile_name
+        try:
+            os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+            with open(os.path.join(PROFILE_OUTPUT_DIR, profile_name), 'w', encoding='utf-8') as profile_file:
+                for folded, count in sorted(self.samples.items()):
+                    profile_file.write(f"{folded} {count}\n")
+        except OSError as profile_error:
+            logger.error(f"Не удалось записать профиль {profile_name}: {profile_error}")
+            return None
+        prune_profiles()
+        return profile_name
+
+
+def prune_profiles():
+    """Оставляет в PROFILE_OUTPUT_DIR не больше PROFILE_MAX_FILES самых свежих профилей."""
+    if PROFILE_MAX_FILES <= 0:
+        return
+    profiles = []
+    try:
+        entries = list(os.scandir(PROFILE_OUTPUT_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.name.endswith('.folded'):
+            continue
+        try:
+            profiles.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            continue  # удалён параллельной очисткой
+    profiles.sort(reverse=True)
+    for _, path in profiles[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def profile_phase(name):
+    """Засекает фазу запроса, если он профилируется; иначе ничего не делает."""
+    profile = getattr(_PROFILE_STATE, 'profile', None)
+    if profile is None or profile.thread_id != threading.get_ident():
+        yield
+        return
+    with profile.phase(name):
+        yield
+
+
+def profiling_requested(headers=None):
+    """Профилировать ли запрос: по токену администратора в заголовке или по доле PROFILE_SAMPLE_RATE."""
+    if PROFILE_ADMIN_TOKEN:
+        token = (request.headers if headers is None else headers).get(PROFILE_HEADER)
+        if token and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_profile(route_name):
+    """Начинает профиль запроса в текущем потоке."""
+    profile = RequestProfile(route_name, PROFILE_SAMPLE_INTERVAL_MS / 1000)
+    profile.start()
+    return profile
+
+
+def call_profiled(route_name, func, *args):
+    """Выполняет func в текущем потоке под профилем. Возвращает (результат, имя файла профиля или None)."""
+    profile = start_profile(route_name)
+    try:
+        result = func(*args)
+    finally:
+        profile.detach()
+        profile_name = profile.finish()
+    return result, profile_name
+
+
+def profiled(route_name):
+    """
+    Декоратор маршрута: при включённом профилировании снимает профиль всего вызова и возвращает его имя в X-Profile-Id.
+    У потокового ответа профиль охватывает и отдачу тела, а заголовок содержит имя файла, который появится после её завершения.
+    """
+    def decorator(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            if not profiling_requested():
+                return route(*args, **kwargs)
+            profile = start_profile(route_name)
+            try:
+                response = make_response(route(*args, **kwargs))
+            except BaseException:
+                profile.detach()
+                profile.finish()
+                raise
+            profile.detach()
+            if response.is_streamed:
+                response.response = profile.stream(response.response)
+                # Генератор, который так и не начали читать, не выполнит свой finally
+                response.call_on_close(profile.finish)
+                profile_name = profile.profile_name
+            else:
+                profile_name = profile.finish()
+            if profile_name:
+                response.headers['X-Profile-Id'] = profile_name
+            return response
+        return wrapper
+    return decorator
+
+
+# --- Отрицательный кеш и предохранители источников ---
+# Классы ошибок yt-dlp: признаки в тексте ошибки и сообщение для пользователя
+DOWNLOAD_ERROR_CLASSES = (
+    ('private', ("private video", "login required", "sign in to confirm"), "Это приватное видео/трек или для доступа требуется вход."),
+    ('geo_blocked', ("available in your country", "geo restriction", "geo-restricted", "blocked it in your country"), "Контент недоступен в регионе сервера."),
+    ('unavailable', ("video unavailable", "track unavailable", "has been removed", "no longer available"), "Контент недоступен."),
+    ('ffmpeg_missing', ("ffmpeg is not installed", "ffmpeg command not found"), "Ошибка конвертации: FFmpeg не найден на сервере."),
+    ('format_unavailable', ("requested format is not available",), None),
+    ('unsupported', ("unsupported url",), "Неподдерживаемый URL или не удалось извлечь информацию. Убедитесь, что ссылка корректна и поддерживается (YouTube, SoundCloud, TikTok)."),
+    ('extraction', ("unable to extract",), "Неподдерживаемый URL или не удалось извлечь информацию. Убедитесь, что ссылка корректна и поддерживается (YouTube, SoundCloud, TikTok)."),
+)
+DOWNLOAD_ERROR_MESSAGES = {error_class: message for error_class, _, message in DOWNLOAD_ERROR_CLASSES}
+# Ошибки самого контента: повтор даст тот же результат, их запоминаем
+NEGATIVE_CACHE_ERROR_CLASSES = ('private', 'geo_blocked', 'unavailable', 'unsupported')
+# Отказы самого источника (сеть, таймауты, HTTP 5xx и 429): только их считает предохранитель.
+# Ошибки отдельных ссылок (404, возрастные ограничения, ещё не начатые трансляции, неверные ID, смена вёрстки
+# для одного ролика) предохранитель не видит: иначе несколько плохих ссылок одного клиента отключили бы источник для всех.
+PROVIDER_FAILURE_ERROR_CLASSES = ('provider',)
+PROVIDER_FAILURE_PATTERN = re.compile(
+    r'http error (?:5\d\d|429)|too many requests|timed out|connection (?:reset|refused|aborted)|remote end closed'
+    r'|temporary failure in name resolution|name or service not known|network is unreachable',
+    re.IGNORECASE,
+)
+
+
+def is_provider_failure(error):
+    """Отказ источника: сетевая ошибка, таймаут, ответ 5xx или 429 — по исходному исключению или тексту ошибки."""
+    return is_network_failure(error) or bool(PROVIDER_FAILURE_PATTERN.search(str(error)))
+
+
+def classify_download_error(error):
+    """
+    Возвращает класс ошибки yt-dlp из DOWNLOAD_ERROR_CLASSES, 'provider' для отказов источника
+    или 'content' для прочих ошибок конкретной ссылки.
+    """
+    error_message = str(error).lower()
+    for error_class, markers, _ in DOWNLOAD_ERROR_CLASSES:
+        if any(marker in error_message for marker in markers):
+            return error_class
+    return 'provider' if is_provider_failure(error) else 'content'
+
+
+class ProviderUnavailableError(Exception):
+    """Предохранитель источника разомкнут: запрос отклоняется без обращения к нему."""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"Источник {provider} временно недоступен. Попробуйте повторить запрос позже.")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class NegativeResultCache:
+    """Кеш с коротким TTL для контента, который гарантированно не скачается: ключ — канонический ID, значение — класс ошибки и сообщение."""
+
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if self.ttl_seconds <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry
+
+    def put(self, key, error_class, message):
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = {"error_class": error_class, "message": message, "expires_at": time.monotonic() + self.ttl_seconds}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель источника: после failure_threshold неудач подряд размыкается и отклоняет запросы,
+    через reset_seconds пропускает один пробный запрос и по его исходу замыкается или снова размыкается.
+    """
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли обратиться к источнику. В полуоткрытом состоянии разрешает только один пробный запрос."""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probe_in_flight or time.monotonic() - self._opened_at < self.reset_seconds:
+                return False
+            self._probe_in_flight = True
+            logger.info(f"Предохранитель '{self.name}': пробный запрос после паузы.")
+            return True
+
+    def retry_after(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 1
+            return max(1, math.ceil(self.reset_seconds - (time.monotonic() - self._opened_at)))
+
+    def record_success(self):
+        """Источник ответил (в том числе ошибкой самого контента)."""
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Предохранитель '{self.name}' замкнут: источник снова отвечает.")
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or (self._opened_at is None and self.failure_threshold > 0 and self._failures >= self.failure_threshold):
+                logger.warning(f"Предохранитель '{self.name}' разомкнут на {self.reset_seconds} с после {self._failures} неудач подряд.")
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+NEGATIVE_RESULT_CACHE = NegativeResultCache(NEGATIVE_CACHE_TTL_SECONDS, NEGATIVE_CACHE_MAX_ENTRIES)
+CIRCUIT_BREAKERS = {}
+CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    with CIRCUIT_BREAKERS_LOCK:
+        breaker = CIRCUIT_BREAKERS.get(name)
+        if breaker is None:
+            breaker = CIRCUIT_BREAKERS[name] = CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        return breaker
+
+
+def acquire_circuit_breaker(name):
+    """Возвращает предохранитель источника или выбрасывает ProviderUnavailableError, если он разомкнут."""
+    breaker = get_circuit_breaker(name)
+    if not breaker.allow():
+        raise ProviderUnavailableError(name, breaker.retry_after())
+    return breaker
+
+
+def retry_after_headers(payload):
+    """Заголовок Retry-After для ответа, в теле которого есть retry_after."""
+    retry_after = payload.get("retry_after") if isinstance(payload, dict) else None
+    return {'Retry-After': str(retry_after)} if retry_after else {}
+
+
+# --- Размещение файлов сессий ---
+class SessionStorage:
+    """
+    Размещает папки сессий: небольшие — в RAM (tmpfs), остальные — на диске.
+    Файлы на tmpfs остаются обычными файлами, поэтому переименование, теги и отдача работают без изменений.
+    Занятый объём считается по содержимому tmpfs и виден всем воркерам хоста, а резервы ещё не скачанных сессий
+    хранятся в процессе: при нескольких воркерах бюджет может быть превышен на сумму их резервов,
+    лишнее переносится на диск в settle().
+    """
+
+    def __init__(self, disk_root, memory_root, max_session_bytes, max_file_bytes, budget_bytes):
+        self.disk_root = disk_root
+        self.memory_root = memory_root
+        self.max_session_bytes = max_session_bytes
+        self.max_file_bytes = max_file_bytes
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def roots(self):
+        return [root for root in (self.memory_root, self.disk_root) if root]
+
+    def session_dirs(self, session_id):
+        """Существующие папки сессии на всех уровнях."""
+        return [path for path in (safe_join(root, session_id) for root in self.roots()) if path and os.path.isdir(path)]
+
+    @staticmethod
+    def _file_sizes(directory):
+        """Размеры файлов папки; файлы и папки, удалённые во время обхода (отдача, очистка), пропускаются."""
+        sizes = {}
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return sizes
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    sizes[entry.path] = entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                continue
+        return sizes
+
+    def _memory_usage(self):
+        total = 0
+        try:
+            session_entries = list(os.scandir(self.memory_root))
+        except FileNotFoundError:
+            return total
+        for session_entry in session_entries:
+            try:
+                if not session_entry.is_dir(follow_symlinks=False):
+                    continue
+            except FileNotFoundError:
+                continue
+            total += sum(self._file_sizes(session_entry.path).values())
+        return total
+
+    def allocate(self, session_id, expected_bytes=None):
+        """Создаёт папку сессии: в RAM, если ожидаемый объём известен, мал и помещается в бюджет, иначе на диске."""
+        if self.memory_root and expected_bytes and expected_bytes <= self.max_session_bytes:
+            with self._lock:
+                if self._memory_usage() + sum(self._pending.values()) + expected_bytes <= self.budget_bytes:
+                    self._pending[session_id] = expected_bytes
+                    path = os.path.join(self.memory_root, session_id)
+                    os.makedirs(path, exist_ok=True)
+                    logger.debug(f"Сессия {session_id} размещена в RAM (ожидается ~{expected_bytes} байт).")
+                    return path
+        path = os.path.join(self.disk_root, session_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def settle(self, session_id):
+        """
+        Снимает резерв после загрузки и переносит на диск файлы, которые слишком велики или не помещаются в бюджет.
+        Возвращает словарь {старый путь: новый путь} перенесённых файлов.
+        """
+        moved = {}
+        to_move = []
+        with self._lock:
+            self._pending.pop(session_id, None)
+            if not self.memory_root:
+                return moved
+            memory_dir = os.path.join(self.memory_root, session_id)
+            usage = self._memory_usage() + sum(self._pending.values())
+            # Служебные файлы (манифест и его блокировка) остаются на месте
+            sizes = {path: size for path, size in self._file_sizes(memory_dir).items() if not os.path.basename(path).startswith('.')}
+            for path, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+                if size <= self.max_file_bytes and usage <= self.budget_bytes:
+                    continue
+                to_move.append((path, size))
+                usage -= size
+        # Копирование на диск может быть долгим, поэтому идёт без блокировки
+        for path, size in to_move:
+            disk_dir = os.path.join(self.disk_root, session_id)
+            new_path = os.path.join(disk_dir, os.path.basename(path))
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+                shutil.move(path, new_path)
+            except FileNotFoundError:
+                continue
+            except OSError as move_error:
+                logger.error(f"Не удалось перенести файл '{os.path.basename(path)}' из RAM на диск, он остаётся в RAM: {move_error}")
+                continue
+            moved[path] = new_path
+            logger.info(f"Файл '{os.path.basename(path)}' ({size} байт) перенесён из RAM на диск.")
+        try:
+            os.rmdir(memory_dir)
+        except OSError:
+            pass  # в папке остались файлы или её уже нет
+        return moved
+
+    def discard(self, session_id):
+        """Удаляет сессию со всех уровней."""
+        with self._lock:
+            self._pending.pop(session_id, None)
+        for path in self.session_dirs(session_id):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def settle_session(session_id, manifest):
+    """Переносит лишнее из RAM на диск и обновляет манифест; ошибка переноса оставляет файлы на месте, а не ломает сессию."""
+    try:
+        manifest.relocate(SESSION_STORAGE.settle(session_id))
+    except OSError as settle_error:
+        logger.error(f"Не удалось перенести файлы сессии {session_id} из RAM на диск: {settle_error}", exc_info=True)
+
+
+def create_session_storage():
+    memory_root = None
+    if MEMORY_STORE_ENABLED:
+        try:
+            os.makedirs(MEMORY_STORE_DIR, exist_ok=True)
+            memory_root = MEMORY_STORE_DIR
+            logger.info(f"RAM-уровень для файлов сессий: {MEMORY_STORE_DIR} (бюджет {MEMORY_STORE_BUDGET_BYTES} байт).")
+        except OSError as memory_error:
+            logger.error(f"Не удалось создать {MEMORY_STORE_DIR}, файлы сессий будут храниться только на диске: {memory_error}")
+    return SessionStorage(USER_DOWNLOADS_DIR, memory_root, MEMORY_STORE_MAX_SESSION_BYTES, MEMORY_STORE_MAX_FILE_BYTES, MEMORY_STORE_BUDGET_BYTES)
+
+
+SESSION_STORAGE = create_session_storage()
+
+# Оценка битрейта для прогноза объёма аудиосессии (байт в секунду при 192 кбит/с)
+ESTIMATED_AUDIO_BYTES_PER_SECOND = 192 * 1000 // 8
+
+
+def estimate_session_bytes(probe_info, requested_formats):
+    """
+    Оценивает объём, который сессия займёт на пике: исходник плюс все выходные файлы.
+    Возвращает None, если оценить нельзя (плейлист, видео без размера) — такие сессии идут на диск.
+    """
+    if not probe_info or probe_info.get('_type') == 'playlist':
+        return None
+    copies = 1 + len(requested_formats)
+    if 'mp4' in requested_formats:
+        filesize = probe_info.get('filesize') or probe_info.get('filesize_approx')
+        return int(filesize * copies) if filesize else None
+    duration = probe_info.get('duration')
+    return int(duration * ESTIMATED_AUDIO_BYTES_PER_SECOND * copies) if duration else None
+
+
+# --- Манифест сессии ---
+MANIFEST_FILENAME = '.manifest.json'
+MANIFEST_LOCK_FILENAME = '.manifest.lock'
+
+
+class SessionManifest:
+    """
+    Манифест сессии: имя, путь, размер, контрольная сумма, формат, метаданные и время создания каждого файла.
+    Записывается атомарно (временный файл + os.replace) и служит единственным источником для имён, отдачи и очистки.
+    """
+
+    def __init__(self, session_id, directory, data=None):
+        self.session_id = session_id
+        self.directory = directory
+        self.data = data or {"session_id": session_id, "created_at": time.time(), "files": {}}
+        self._lock = threading.RLock()
+        self._reserved = set(self.data["files"])
+        self._name_counters = {}
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    @classmethod
+    def load(cls, session_id):
+        """Читает манифест сессии с любого уровня хранения. Возвращает None, если его нет."""
+        for directory in SESSION_STORAGE.session_dirs(session_id):
+            try:
+                with open(os.path.join(directory, MANIFEST_FILENAME), encoding='utf-8') as manifest_file:
+                    return cls(session_id, directory, json.load(manifest_file))
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as manifest_error:
+                logger.error(f"Не удалось прочитать манифест сессии {session_id}: {manifest_error}")
+                return None
+        return None
+
+    @contextmanager
+    def _locked(self):
+        """Блокирует манифест в этом процессе и, где доступно, между воркерами, перечитывая актуальную версию."""
+        with self._lock:
+            lock_file = None
+            if fcntl is not None:
+                lock_file = open(os.path.join(self.directory, MANIFEST_LOCK_FILENAME), 'a')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, encoding='utf-8') as manifest_file:
+                        self.data = json.load(manifest_file)
+                except FileNotFoundError:
+                    pass
+                yield self.data
+            finally:
+                if lock_file is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+
+    def _save(self):
+        temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            json.dump(self.data, temp_file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def reserve_filename(self, directory, desired_name, current_path=None):
+        """Выдаёт свободное имя в сессии, продолжая счётчик для повторяющихся названий."""
+        base, ext = os.path.splitext(desired_name)
+        with self._lock:
+            counter = self._name_counters.get(desired_name, 0)
+            while True:
+                candidate = f"{base} ({counter}){ext}" if counter else desired_name
+                counter += 1
+                if candidate in self._reserved:
+                    continue
+                candidate_path = os.path.join(directory, candidate)
+                if current_path and os.path.abspath(candidate_path) == os.path.abspath(current_path):
+                    break
+                # Имя может совпасть с ещё не переименованным файлом yt-dlp — это единственная проверка диска
+                if not os.path.exists(candidate_path):
+                    break
+            self._name_counters[desired_name] = counter
+            self._reserved.add(candidate)
+            return candidate
+
+    def add_file(self, file_path, output_format=None, metadata=None, sha256=None):
+        """Вносит готовый файл в манифест. sha256 — уже посчитанная контрольная сумма, иначе она считается здесь."""
+        metadata = metadata or {}
+        filename = os.path.basename(file_path)
+        file_entry = {
+            "filename": filename,
+            "path": os.path.abspath(file_path),
+            "size": os.path.getsize(file_path),
+            "sha256": sha256 or download_worker.file_sha256(file_path),
+            "format": output_format,
+            "metadata": {key: metadata.get(key) for key in ("title", "artist", "album", "source_url")},
+            "created_at": time.time(),
+        }
+        with self._locked() as data:
+            data["files"][filename] = file_entry
+            self._reserved.add(filename)
+            self._save()
+        return file_entry
+
+    def relocate(self, moved_paths):
+        """Обновляет пути файлов, перенесённых между уровнями хранения."""
+        if not moved_paths:
+            return
+        with self._locked() as data:
+            for file_entry in data["files"].values():
+                new_path = moved_paths.get(file_entry["path"])
+                if new_path:
+                    file_entry["path"] = os.path.abspath(new_path)
+            self._save()
+
+    def get(self, filename):
+        return self.data["files"].get(filename)
+
+    def set_open(self, is_open):
+        """Помечает сессию как пополняемую: пока она открыта, отдача последнего файла не удаляет её папку. Возвращает число файлов."""
+        with self._locked() as data:
+            data["open"] = is_open
+            self._save()
+            return len(data["files"])
+
+    def remove_file(self, filename):
+        """Убирает файл из манифеста. Возвращает число оставшихся файлов."""
+        with self._locked() as data:
+            data["files"].pop(filename, None)
+            self._save()
+            return len(data["files"])
+
+
+# --- Общее состояние сессий ---
+class SQLiteSessionStateBackend:
+    """
+    Хранит владельцев файлов сессий в SQLite: общее состояние для воркеров одного хоста.
+    Соединение открывается на одну операцию: потоки запросов и пулов приходят и уходят, и постоянные соединения на поток копились бы.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS session_files ("
+                "session_id TEXT NOT NULL, filename TEXT NOT NULL, node_id TEXT NOT NULL, node_url TEXT, "
+                "public_url TEXT, created_at REAL NOT NULL, PRIMARY KEY (session_id, filename))"
+            )
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(session_files)")}
+            if 'public_url' not in columns:
+                connection.execute("ALTER TABLE session_files ADD COLUMN public_url TEXT")
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def register_file(self, session_id, filename, node_id, node_url, public_url=None):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("DELETE FROM session_files WHERE created_at < ?", (now - self.ttl_seconds,))
+            connection.execute(
+                "INSERT OR REPLACE INTO session_files (session_id, filename, node_id, node_url, public_url, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, filename, node_id, node_url, public_url, now)
+            )
+
+    def lookup_file(self, session_id, filename):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT node_id, node_url, public_url FROM session_files WHERE session_id = ? AND filename = ? AND created_at >= ?",
+                (session_id, filename, time.time() - self.ttl_seconds)
+            ).fetchone()
+        return {"node_id": row[0], "node_url": row[1], "public_url": row[2]} if row else None
+
+    def forget_file(self, session_id, filename):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM session_files WHERE session_id = ? AND filename = ?", (session_id, filename))
+
+
+class RedisSessionStateBackend:
+    """Хранит владельцев файлов сессий в Redis (или совместимом хранилище): общее состояние для нескольких хостов."""
+
+    def __init__(self, url, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._client = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(session_id):
+        return f"musicjacker:session:{session_id}"
+
+    def register_file(self, session_id, filename, node_id, node_url, public_url=None):
+        key = self._key(session_id)
+        pipeline = self._client.pipeline()
+        pipeline.hset(key, filename, json.dumps({"node_id": node_id, "node_url": node_url, "public_url": public_url}))
+        pipeline.expire(key, self.ttl_seconds)
+        pipeline.execute()
+
+    def lookup_file(self, session_id, filename):
+        raw = self._client.hget(self._key(session_id), filename)
+        return json.loads(raw) if raw else None
+
+    def forget_file(self, session_id, filename):
+        self._client.hdel(self._key(session_id), filename)
+
+
+def create_session_state_backend():
+    """Создаёт хранилище состояния сессий по SESSION_STATE_BACKEND."""
+    if SESSION_STATE_BACKEND == 'redis':
+        if REDIS_AVAILABLE:
+            logger.info(f"Состояние сессий хранится в Redis: {SESSION_STATE_REDIS_URL}")
+            return RedisSessionStateBackend(SESSION_STATE_REDIS_URL, SESSION_STATE_TTL_SECONDS)
+        logger.error("SESSION_STATE_BACKEND=redis, но библиотека redis не установлена. Используется SQLite.")
+    elif SESSION_STATE_BACKEND != 'sqlite':
+        logger.warning(f"Неизвестный SESSION_STATE_BACKEND '{SESSION_STATE_BACKEND}'. Используется SQLite.")
+    return SQLiteSessionStateBackend(SESSION_STATE_SQLITE_PATH, SESSION_STATE_TTL_SECONDS)
+
+
+SESSION_STATE = create_session_state_backend()
+
+# Лимиты запросов, контроль нагрузки, очереди загрузок и ffmpeg, кеши и предохранители живут в памяти процесса:
+# с несколькими воркерами gunicorn каждый из них умножается на их число
+if int(os.getenv('WEB_CONCURRENCY', '1')) > 1:
+    logger.warning(
+        "WEB_CONCURRENCY > 1: лимиты запросов, MAX_ACTIVE_DOWNLOADS, DOWNLOAD_WORKER_SLOTS и FFMPEG_MAX_CONCURRENT_JOBS "
+        "действуют в каждом воркере отдельно. Оставьте WEB_CONCURRENCY=1 и масштабируйтесь потоками или узлами."
+    )
+
+
+def register_session_files(session_id, files):
+    """Записывает этот узел владельцем файлов сессии, чтобы другие узлы могли переслать на него /serve_file."""
+    for file_info in files:
+        try:
+            SESSION_STATE.register_file(session_id, file_info["filename"], NODE_ID, NODE_URL, NODE_PUBLIC_URL or None)
+        except Exception as state_error:
+            logger.warning(f"Не удалось записать владельца файла '{file_info.get('filename')}' сессии {session_id}: {state_error}")
+
+
+def forget_session_file(session_id, filename):
+    try:
+        SESSION_STATE.forget_file(session_id, filename)
+    except Exception as state_error:
+        logger.warning(f"Не удалось удалить запись о файле '{filename}' сессии {session_id}: {state_error}")
+
+
+def forward_to_owner_node(session_id, filename):
+    """
+    Отдаёт файл, лежащий на другом узле: проксирует его или перенаправляет клиента (SERVE_FILE_FORWARD_MODE).
+    Перенаправление идёт только на публичный адрес узла (NODE_PUBLIC_URL): NODE_URL — внутренний адрес,
+    браузеру он недоступен, поэтому без публичного адреса файл проксируется.
+    Возвращает None, если файл не принадлежит другому известному узлу.
+    """
+    if request.headers.get(FORWARDED_BY_NODE_HEADER):
+        return None
+    try:
+        owner = SESSION_STATE.lookup_file(session_id, filename)
+    except Exception as state_error:
+        logger.warning(f"Не удалось узнать владельца файла '{filename}' сессии {session_id}: {state_error}")
+        return None
+    if not owner or owner.get("node_id") == NODE_ID or not owner.get("node_url"):
+        return None
+
+    file_path = f"/serve_file/{quote(session_id)}/{quote(filename)}"
+    if SERVE_FILE_FORWARD_MODE == 'redirect':
+        if owner.get("public_url"):
+            redirect_url = f"{owner['public_url']}{file_path}"
+            logger.info(f"Файл '{filename}' принадлежит узлу {owner['node_id']}. Перенаправление на {redirect_url}")
+            return redirect(redirect_url, code=307)
+        logger.warning(f"У узла {owner['node_id']} не задан NODE_PUBLIC_URL: файл '{filename}' проксируется вместо перенаправления.")
+
+    target_url = f"{owner['node_url']}{file_path}"
+
+    logger.info(f"Файл '{filename}' принадлежит узлу {owner['node_id']}. Проксирование с {target_url}")
+    try:
+        upstream = urlopen(Request(target_url, headers={FORWARDED_BY_NODE_HEADER: NODE_ID}), timeout=SERVE_FILE_PROXY_TIMEOUT_SECONDS)
+    except HTTPError as proxy_error:
+        logger.warning(f"Узел {owner['node_id']} ответил {proxy_error.code} на запрос файла '{filename}'.")
+        return None
+    except (URLError, socket.timeout) as proxy_error:
+        logger.error(f"Узел {owner['node_id']} недоступен для отдачи файла '{filename}': {proxy_error}")
+        return None
+
+    def stream_upstream():
+        with upstream:
+            while True:
+                chunk = upstream.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+
+    headers = {name: upstream.headers[name] for name in ('Content-Type', 'Content-Length', 'Content-Disposition') if upstream.headers.get(name)}
+    return Response(stream_upstream(), status=upstream.status, headers=headers)
+
+
 # --- Работа с названиями треков ---
 FILENAME_INVALID_CHARS = '<>:"/\\|?*\n\r\t'
 FILENAME_STRIP_TRANS = str.maketrans('', '', FILENAME_INVALID_CHARS)
 DEFAULT_TRACK_TITLE = "Track"
+RENAME_LOCK = threading.Lock()
 
 
 def extract_track_metadata(entry):
@@ -146,8 +1315,14 @@ def normalize_title_for_filename(raw_title):
     return normalized if normalized else DEFAULT_TRACK_TITLE
 
 
-def ensure_unique_filename(directory, desired_name, current_path=None):
-    """Гарантирует уникальность файла в директории, добавляя счётчик при необходимости."""
+def ensure_unique_filename(directory, desired_name, current_path=None, manifest=None):
+    """
+    Гарантирует уникальность файла в директории, добавляя счётчик при необходимости.
+    С манифестом сессии занятые имена и последний счётчик берутся из него, а диск проверяется только для выбранного кандидата.
+    """
+    if manifest is not None:
+        return manifest.reserve_filename(directory, desired_name, current_path)
+
     base, ext = os.path.splitext(desired_name)
     candidate = desired_name
     counter = 1
@@ -331,11 +1506,8 @@ def download_thumbnail_data(url):
             content_type = response.headers.get('Content-Type')
             if content_type:
                 content_type = content_type.split(';')[0].strip()
-            if not content_type:
-                detected = imghdr.what(None, h=data)
-                if detected:
-                    content_type = f"image/{detected.lower()}"
-            mime = content_type or guess_mime_from_url(url)
+            # Если тип не передан, его определит process_cover_image по содержимому
+            mime = content_type or guess_mime_from_url(url, default=None)
             return data, mime
     except (HTTPError, URLError, socket.timeout) as thumb_error:
         logger.warning(f"Не удалось скачать превью '{url}': {thumb_error}")
@@ -345,6 +1517,107 @@ def download_thumbnail_data(url):
     return None, None
 
 
+class CoverCache:
+    """
+    LRU-кэш обработанных обложек, ограниченный суммарным размером изображений.
+    Каждое изображение хранится один раз (по SHA-1 исходника), URL источника лишь ссылается на него;
+    base64 для превью и блок картинки Opus строятся из него при необходимости.
+    """
+
+    def __init__(self, max_bytes, max_aliases=4096):
+        self.max_bytes = max(0, max_bytes)
+        self.max_aliases = max(1, max_aliases)
+        self._lock = threading.Lock()
+        self._covers = OrderedDict()
+        self._url_digests = OrderedDict()
+        self._bytes = 0
+
+    def get(self, digest):
+        with self._lock:
+            cover = self._covers.get(digest)
+            if cover is not None:
+                self._covers.move_to_end(digest)
+            return cover
+
+    def get_by_url(self, url):
+        with self._lock:
+            digest = self._url_digests.get(url)
+        return self.get(digest) if digest else None
+
+    def put(self, digest, cover, url=None):
+        size = len(cover["data"])
+        with self._lock:
+            if url:
+                self._url_digests[url] = digest
+                self._url_digests.move_to_end(url)
+                while len(self._url_digests) > self.max_aliases:
+                    self._url_digests.popitem(last=False)
+            if size > self.max_bytes:
+                return
+            previous = self._covers.pop(digest, None)
+            if previous is not None:
+                self._bytes -= len(previous["data"])
+            self._covers[digest] = cover
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._covers.popitem(last=False)
+                self._bytes -= len(evicted["data"])
+
+    def stats(self):
+        with self._lock:
+            return {"covers": len(self._covers), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+COVER_CACHE = CoverCache(COVER_CACHE_MAX_BYTES)
+_cover_pool = None
+_cover_pool_lock = threading.Lock()
+
+
+def process_cover_image(data, mime=None):
+    """Обрабатывает обложку с настройками COVER_ART_SIZE и COVER_ART_JPEG_QUALITY (см. cover_worker)."""
+    return cover_worker.process_cover_image(data, mime, COVER_ART_SIZE, COVER_ART_JPEG_QUALITY)
+
+
+def get_cover_pool():
+    """Лениво создаёт пул процессов для обложек (spawn — безопасно для многопоточного сервера)."""
+    global _cover_pool
+    with _cover_pool_lock:
+        if _cover_pool is None:
+            # Процессы импортируют только лёгкий cover_worker, а не app
+            _cover_pool = ProcessPoolExecutor(
+                max_workers=max(1, COVER_PROCESS_WORKERS),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _cover_pool
+
+
+def get_processed_cover(url):
+    """Скачивает и обрабатывает обложку, запоминая результат для URL и для самого изображения."""
+    global _cover_pool
+    cached = COVER_CACHE.get_by_url(url)
+    if cached is not None:
+        return cached
+
+    data, mime = download_thumbnail_data(url)
+    if not data:
+        return None
+
+    digest = hashlib.sha1(data).hexdigest()
+    processed = COVER_CACHE.get(digest)
+    if processed is None:
+        try:
+            processed = get_cover_pool().submit(cover_worker.process_cover_image, data, mime, COVER_ART_SIZE, COVER_ART_JPEG_QUALITY).result()
+        except Exception as pool_error:
+            logger.warning(f"Пул обработки обложек недоступен, обработка в текущем потоке: {pool_error}")
+            with _cover_pool_lock:
+                if _cover_pool is not None:
+                    _cover_pool.shutdown(wait=False)
+                _cover_pool = None
+            processed = process_cover_image(data, mime)
+    COVER_CACHE.put(digest, processed, url)
+    return processed
+
+
 def build_track_metadata(entry, track_name, artist_name):
     """Формирует структуру метаданных и при необходимости скачивает обложку."""
     entry = entry or {}
@@ -419,29 +1692,20 @@ def build_track_metadata(entry, track_name, artist_name):
 
     if MUTAGEN_AVAILABLE and cover_candidates:
         for candidate_url in cover_candidates:
-            cover_data, cover_mime = download_thumbnail_data(candidate_url)
-            if cover_data:
-                metadata["cover_data"] = cover_data
-                metadata["cover_mime"] = cover_mime
+            with profile_phase('cover'):
+                cover = get_processed_cover(candidate_url)
+            if cover:
+                metadata["cover_data"] = cover["data"]
+                metadata["cover_mime"] = cover["mime"]
+                metadata["cover_width"] = cover["width"]
+                metadata["cover_height"] = cover["height"]
                 metadata["cover_url"] = candidate_url
                 break
 
     return metadata
 
 
-def build_thumbnail_preview(metadata):
-    """Возвращает data URI для встроенной обложки или исходный URL, если встроенных данных нет."""
-    if not metadata:
-        return None
-    cover_data = metadata.get('cover_data')
-    if cover_data:
-        cover_mime = metadata.get('cover_mime') or 'image/jpeg'
-        encoded = base64.b64encode(cover_data).decode('ascii')
-        return f"data:{cover_mime};base64,{encoded}"
-    return metadata.get('cover_url')
-
-
-def prepare_readable_download(actual_filepath, entry_title):
+def prepare_readable_download(actual_filepath, entry_title, manifest=None):
     """Переименовывает скачанный файл в более дружелюбный вариант с пробелами."""
     if not actual_filepath or not os.path.exists(actual_filepath):
         return actual_filepath, os.path.basename(actual_filepath) if actual_filepath else None, normalize_title_for_filename(entry_title)
@@ -450,109 +1714,48 @@ def prepare_readable_download(actual_filepath, entry_title):
     _, ext = os.path.splitext(actual_filepath)
     clean_title = normalize_title_for_filename(entry_title or os.path.basename(actual_filepath))
     desired_filename = f"{clean_title}{ext}"
-    desired_filename = ensure_unique_filename(directory, desired_filename, actual_filepath)
-    new_path = os.path.join(directory, desired_filename)
+    # Параллельные задачи одной сессии не должны выбрать одно и то же свободное имя
+    with RENAME_LOCK:
+        desired_filename = ensure_unique_filename(directory, desired_filename, actual_filepath, manifest)
+        new_path = os.path.join(directory, desired_filename)
 
-    if os.path.abspath(actual_filepath) != os.path.abspath(new_path):
-        try:
-            os.rename(actual_filepath, new_path)
-            logger.debug(f"Файл переименован в '{new_path}' для сохранения читаемого названия.")
-            actual_filepath = new_path
-        except OSError as rename_error:
-            logger.warning(f"Не удалось переименовать файл '{actual_filepath}' в '{new_path}': {rename_error}")
-            desired_filename = os.path.basename(actual_filepath)
+        if os.path.abspath(actual_filepath) != os.path.abspath(new_path):
+            try:
+                os.rename(actual_filepath, new_path)
+                logger.debug(f"Файл переименован в '{new_path}' для сохранения читаемого названия.")
+                actual_filepath = new_path
+            except OSError as rename_error:
+                logger.warning(f"Не удалось переименовать файл '{actual_filepath}' в '{new_path}': {rename_error}")
+                desired_filename = os.path.basename(actual_filepath)
 
     return actual_filepath, desired_filename, clean_title
 
 
-def apply_metadata_tags(file_path, metadata):
-    """Записывает расширенные теги (включая обложку) в итоговый аудиофайл."""
-    if not MUTAGEN_AVAILABLE or not file_path or not os.path.exists(file_path):
-        return
-
+def resolve_tag_metadata(metadata):
+    """Значения тегов для download_worker.tag_file_job: с подстановкой значений по умолчанию и без лишних полей."""
     metadata = metadata or {}
-    title = metadata.get('title') or DEFAULT_TRACK_TITLE
-    artist = metadata.get('artist') or GLOBAL_ARTIST_NAME
-    album = metadata.get('album') or DEFAULT_ALBUM_NAME
-    comment = metadata.get('comment') or ""
-    cover_data = metadata.get('cover_data')
-    cover_mime = metadata.get('cover_mime') or (guess_mime_from_url(metadata.get('cover_url')) if metadata.get('cover_url') else 'image/jpeg')
+    return {
+        "title": metadata.get('title') or DEFAULT_TRACK_TITLE,
+        "artist": metadata.get('artist') or GLOBAL_ARTIST_NAME,
+        "album": metadata.get('album') or DEFAULT_ALBUM_NAME,
+        "comment": metadata.get('comment') or "",
+        "cover_data": metadata.get('cover_data'),
+        "cover_mime": metadata.get('cover_mime') or (guess_mime_from_url(metadata.get('cover_url')) if metadata.get('cover_url') else 'image/jpeg'),
+        "cover_width": metadata.get('cover_width'),
+        "cover_height": metadata.get('cover_height'),
+        "cover_url": metadata.get('cover_url'),
+    }
 
-    try:
-        lowercase_path = file_path.lower()
-        if lowercase_path.endswith('.mp3'):
-            try:
-                audio = EasyID3(file_path)
-            except ID3NoHeaderError:
-                audio_file = MP3(file_path)
-                audio_file.add_tags()
-                audio_file.save()
-                audio = EasyID3(file_path)
-
-            audio['title'] = [title]
-            audio['artist'] = [artist]
-            audio['albumartist'] = [artist]
-            if album:
-                audio['album'] = [album]
-            audio['comment'] = [comment]
-            audio.save()
-
-            if cover_data:
-                mp3_binary = MP3(file_path)
-                if mp3_binary.tags is None:
-                    mp3_binary.add_tags()
-                mp3_binary.tags.delall('APIC')
-                mp3_binary.tags.add(APIC(
-                    encoding=3,
-                    mime=cover_mime or 'image/jpeg',
-                    type=3,
-                    desc='Cover',
-                    data=cover_data
-                ))
-                mp3_binary.save()
-
-        elif lowercase_path.endswith(('.m4a', '.mp4', '.m4v', '.aac')):
-            audio = MP4(file_path)
-            audio['\xa9nam'] = [title]
-            audio['\xa9ART'] = [artist]
-            audio['aART'] = [artist]
-            audio['\xa9alb'] = [album]
-            audio['desc'] = [comment]
-            audio['\xa9cmt'] = [comment]
-
-            if cover_data and cover_mime:
-                lower_mime = cover_mime.lower()
-                if 'png' in lower_mime:
-                    cover = MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_PNG)
-                    audio['covr'] = [cover]
-                elif 'jpg' in lower_mime or 'jpeg' in lower_mime:
-                    cover = MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)
-                    audio['covr'] = [cover]
-                else:
-                    logger.debug(f"Пропущена обложка для '{file_path}': неподдерживаемый MIME {cover_mime}")
-
-            audio.save()
-        elif lowercase_path.endswith(('.opus', '.ogg')):
-            audio = OggOpus(file_path)
-            audio['title'] = [title]
-            audio['artist'] = [artist]
-            audio['albumartist'] = [artist]
-            audio['album'] = [album]
-            audio['comment'] = [comment]
-            if cover_data:
-                picture = Picture()
-                picture.data = cover_data
-                picture.type = 3
-                picture.mime = cover_mime or 'image/jpeg'
-                picture.desc = 'Cover'
-                picture.width = 0
-                picture.height = 0
-                picture.depth = 24
-                encoded_data = base64.b64encode(picture.write()).decode('ascii')
-                audio['metadata_block_picture'] = [encoded_data]
-            audio.save()
-    except Exception as tag_error:
-        logger.warning(f"Не удалось записать теги для '{file_path}': {tag_error}")
+
+def tag_and_register_file(file_path, metadata, manifest, output_format):
+    """
+    Записывает теги, считает контрольную сумму и строит превью обложки в задаче download_worker
+    (в ASGI — в процессе пула 'tag'), затем вносит файл в манифест. Возвращает превью обложки.
+    """
+    with profile_phase('tags'):
+        tagged = run_job('tag', download_worker.tag_file_job, file_path, resolve_tag_metadata(metadata))
+    manifest.add_file(file_path, output_format, metadata, sha256=tagged["sha256"])
+    return tagged["thumbnail"]
 
 # --- Вспомогательные функции ---
 def is_valid_url(url):
@@ -582,36 +1785,187 @@ def is_tiktok_url(url):
     """Проверка, является ли URL ссылкой на TikTok."""
     return "tiktok.com/" in url.lower() or "vt.tiktok.com/" in url.lower()
 
-def blocking_yt_dlp_download(ydl_opts, url_to_download):
+def extractor_for_url(url):
+    """Имя источника для предохранителя: youtube, soundcloud, tiktok или домен ссылки."""
+    if is_youtube_url(url) or is_ytmusic_url(url):
+        return 'youtube'
+    if is_soundcloud_url(url):
+        return 'soundcloud'
+    if is_tiktok_url(url):
+        return 'tiktok'
+    return (urlparse(url).hostname or 'generic').lower()
+
+# --- Профили загрузки ---
+MEGABYTE = 1024 * 1024
+HTTP_CHUNK_SIZE_LIMITS = (1 * MEGABYTE, 64 * MEGABYTE)
+DOWNLOAD_PROFILES = {
+    # YouTube ограничивает скорость одного непрерывного запроса: качаем кусками и DASH-фрагментами параллельно
+    'youtube': {'concurrent_fragment_downloads': 4, 'http_chunk_size': 10 * MEGABYTE, 'buffersize': MEGABYTE, 'retries': 10, 'fragment_retries': 10},
+    # SoundCloud отдаёт HLS из множества мелких фрагментов
+    'soundcloud': {'concurrent_fragment_downloads': 4, 'http_chunk_size': None, 'buffersize': 256 * 1024, 'retries': 5, 'fragment_retries': 10},
+    # TikTok — один небольшой файл
+    'tiktok': {'concurrent_fragment_downloads': 1, 'http_chunk_size': None, 'buffersize': 256 * 1024, 'retries': 5, 'fragment_retries': 5},
+    'default': {'concurrent_fragment_downloads': 2, 'http_chunk_size': None, 'buffersize': 512 * 1024, 'retries': 5, 'fragment_retries': 5},
+}
+
+
+# Экспоненциальная пауза перед повтором n (с нуля) для retry_sleep_functions yt-dlp; объект передаётся в процессы пула
+retry_backoff_seconds = RetryBackoff(DOWNLOAD_RETRY_BACKOFF_MAX_SECONDS)
+
+
+class DownloadTuner:
+    """
+    Профили загрузки по источникам с подстройкой по измеренной скорости.
+    Для фрагментированных загрузок (DASH/HLS) подбирается число параллельных фрагментов, для обычных HTTP — размер куска:
+    пока скорость растёт, шаг повторяется в ту же сторону, при заметном падении направление меняется.
+    """
+
+    ADAPT_THRESHOLD = 0.1  # изменение скорости меньше 10% считается шумом
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, profiles, max_fragments, adaptive, min_bytes):
+        self.profiles = profiles
+        self.max_fragments = max_fragments
+        self.adaptive = adaptive
+        self.min_bytes = min_bytes
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def _state_for(self, extractor):
+        state = self._state.get(extractor)
+        if state is None:
+            profile = self.profiles.get(extractor) or self.profiles['default']
+            state = self._state[extractor] = {"options": dict(profile), "rate": {}, "direction": {}}
+        return state
+
+    def options_for(self, extractor):
+        """Текущие опции yt-dlp для источника."""
+        with self._lock:
+            options = dict(self._state_for(extractor)["options"])
+        options['retry_sleep_functions'] = {'http': retry_backoff_seconds, 'fragment': retry_backoff_seconds}
+        return {key: value for key, value in options.items() if value is not None}
+
+    def _step(self, knob, value, direction):
+        if knob == 'concurrent_fragment_downloads':
+            return min(max(1, value + direction), max(1, self.max_fragments))
+        low, high = HTTP_CHUNK_SIZE_LIMITS
+        return min(max(low, value * 2 if direction > 0 else value // 2), high)
+
+    def record(self, extractor, meter, used_options, title):
+        """Логирует скорость задачи и сдвигает настройку источника."""
+        if meter.downloaded_bytes <= 0 or meter.elapsed <= 0:
+            return
+        rate = meter.downloaded_bytes / meter.elapsed
+        chunk_size = used_options.get('http_chunk_size')
+        logger.info(
+            f"Загрузка '{title}' [{extractor}]: {meter.downloaded_bytes / MEGABYTE:.1f} МБ за {meter.elapsed:.1f} с — {rate / MEGABYTE:.2f} МБ/с "
+            f"(фрагментов параллельно: {used_options.get('concurrent_fragment_downloads', 1)}, "
+            f"кусок HTTP: {f'{chunk_size // MEGABYTE} МБ' if chunk_size else 'целиком'})."
+        )
+        if not self.adaptive or meter.downloaded_bytes < self.min_bytes:
+            return
+
+        knob = 'concurrent_fragment_downloads' if meter.fragmented else 'http_chunk_size'
+        with self._lock:
+            state = self._state_for(extractor)
+            current = state["options"].get(knob)
+            if not current:
+                return
+            previous_rate = state["rate"].get(knob)
+            direction = state["direction"].get(knob, 1)
+            state["rate"][knob] = rate if previous_rate is None else self.EWMA_ALPHA * rate + (1 - self.EWMA_ALPHA) * previous_rate
+            if previous_rate is not None:
+                change = (rate - previous_rate) / previous_rate
+                if abs(change) < self.ADAPT_THRESHOLD:
+                    return
+                if change < 0:
+                    direction = -direction
+            state["direction"][knob] = direction
+            new_value = self._step(knob, current, direction)
+            if new_value != current:
+                state["options"][knob] = new_value
+                logger.info(f"Профиль загрузки [{extractor}]: {knob} {current} → {new_value}.")
+
+
+DOWNLOAD_TUNER = DownloadTuner(DOWNLOAD_PROFILES, DOWNLOAD_MAX_CONCURRENT_FRAGMENTS, DOWNLOAD_ADAPTIVE_TUNING, DOWNLOAD_TUNING_MIN_BYTES)
+
+
+# Исполнители задач download_worker по видам: 'download' — загрузки (уже допущенные DOWNLOAD_SCHEDULER),
+# 'probe' — проверки и поиск, 'tag' — теги, контрольная сумма и превью готовых файлов.
+# None — задача выполняется в вызывающем потоке (Flask); asgi.py подставляет пулы процессов.
+JOB_EXECUTORS = {'download': None, 'probe': None, 'tag': None}
+
+
+def set_job_executors(**executors):
+    """Задаёт исполнители задач download_worker (concurrent.futures.Executor или None)."""
+    unknown = set(executors) - set(JOB_EXECUTORS)
+    if unknown:
+        raise ValueError(f"Неизвестные виды задач: {', '.join(sorted(unknown))}")
+    JOB_EXECUTORS.update(executors)
+
+
+def run_job(kind, func, *args):
+    """Выполняет задачу download_worker в исполнителе своего вида и ждёт результат."""
+    executor = JOB_EXECUTORS.get(kind)
+    if executor is None:
+        return func(*args)
+    return executor.submit(func, *args).result()
+
+
+def blocking_yt_dlp_download(ydl_opts, url_to_download, prefetched_info=None):
     """
     Выполняет блокирующую загрузку с помощью yt-dlp.
     Возвращает info_dict при успехе, None при определенных ошибках yt-dlp,
     или выбрасывает исключение для критических ошибок.
+    prefetched_info — уже полученный info_dict: извлечение пропускается, сразу выбор формата и загрузка.
     """
+    cached_error = NEGATIVE_RESULT_CACHE.get(canonical_media_key(url_to_download))
+    if cached_error:
+        logger.info(f"Загрузка '{url_to_download}' пропущена: недавно завершилась ошибкой '{cached_error['error_class']}'.")
+        raise Exception(cached_error["message"])
+    extractor = extractor_for_url(url_to_download)
+    breaker = acquire_circuit_breaker(extractor)
+    provider_failed = False
+
+    # Постпроцессоры создаются в исполнителе задачи, чтобы запуски ffmpeg шли через планировщик транскодирования.
+    # Хуки вызывающего кода остаются в этом процессе: post_hooks получают итоговые файлы после задачи.
+    ydl_opts = dict(ydl_opts, ignoreerrors=False)
+    postprocessors = ydl_opts.pop('postprocessors', None) or []
+    post_hooks = ydl_opts.pop('post_hooks', None) or []
+    ydl_opts.pop('progress_hooks', None)
+    tuned_options = DOWNLOAD_TUNER.options_for(extractor)
+    ydl_opts.update(tuned_options)
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url_to_download, download=True)
+        result = run_job('download', download_worker.run_download_job, ydl_opts, url_to_download, postprocessors, prefetched_info)
+        for produced_file in result["produced_files"]:
+            for post_hook in post_hooks:
+                post_hook(produced_file)
+        info_dict = result["info"]
+        DOWNLOAD_TUNER.record(extractor, result["meter"], tuned_options, (info_dict or {}).get('title') or url_to_download)
         return info_dict
     except yt_dlp.utils.DownloadError as e:
         logger.error(f"yt-dlp DownloadError: {e}")
-        error_message = str(e).lower()
-        if "private video" in error_message or "login required" in error_message:
-            raise Exception("Это приватное видео/трек или для доступа требуется вход.")
-        if "video unavailable" in error_message or "track unavailable" in error_message:
-            raise Exception("Контент недоступен.")
-        if "ffmpeg is not installed" in error_message or "ffmpeg command not found" in error_message:
+        error_class = classify_download_error(e)
+        provider_failed = error_class in PROVIDER_FAILURE_ERROR_CLASSES
+        if error_class in NEGATIVE_CACHE_ERROR_CLASSES:
+            NEGATIVE_RESULT_CACHE.put(canonical_media_key(url_to_download), error_class, DOWNLOAD_ERROR_MESSAGES[error_class])
+        if error_class == 'ffmpeg_missing':
             logger.error("FFmpeg не найден yt-dlp во время выполнения download().")
-            raise Exception("Ошибка конвертации: FFmpeg не найден на сервере.")
-        if "requested format is not available" in error_message:
+        if error_class == 'format_unavailable':
             logger.warning(f"Запрошенный формат аудио/видео недоступен для URL '{url_to_download}'. Попытка загрузить лучший доступный формат.")
             return None
-        if "unsupported url" in error_message or "unable to extract" in error_message:
-            raise Exception("Неподдерживаемый URL или не удалось извлечь информацию. Убедитесь, что ссылка корректна и поддерживается (YouTube, SoundCloud, TikTok).")
+        if DOWNLOAD_ERROR_MESSAGES.get(error_class):
+            raise Exception(DOWNLOAD_ERROR_MESSAGES[error_class])
         logger.error(f"Неспецифичная ошибка загрузки yt-dlp для URL '{url_to_download}': {e}")
         return None
     except Exception as e:
         logger.error(f"Неожиданная ошибка в blocking_yt_dlp_download для URL '{url_to_download}': {e}", exc_info=True)
         return None
+    finally:
+        if provider_failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
 
 def build_info_extractor_opts(url):
     """Формирует набор опций для предварительного получения информации и проверки длительности."""
@@ -633,34 +1987,158 @@ def build_info_extractor_opts(url):
     return opts
 
 
-def get_info_and_check_duration(url):
-    """Получает информацию о контенте и проверяет его длительность."""
-    logger.info(f"Получаю информацию о контенте: {url}")
-    info_extractor_opts = build_info_extractor_opts(url)
+class RequestValidationError(ValueError):
+    """Ошибка во входных данных запроса (время фрагмента, длительность): клиенту отдаётся 400 с её текстом."""
+
+
+def parse_timestamp(value):
+    """Переводит время в секунды: число или строка вида СС, ММ:СС, ЧЧ:ММ:СС (допускаются доли секунды)."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        parts = str(value).strip().split(':')
+        if len(parts) > 3:
+            raise ValueError(value)
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(value)
+    return seconds
+
+
+def parse_clip_range(data):
+    """
+    Читает start/end из тела запроса. Возвращает None, если фрагмент не запрошен, иначе (start, end),
+    где end может быть None (до конца). Выбрасывает RequestValidationError с сообщением для пользователя.
+    """
     try:
-        with yt_dlp.YoutubeDL(info_extractor_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if info and info.get('_type') == 'playlist':
-                entries = info.get('entries') or []
-                for idx, entry in enumerate(entries, start=1):
-                    if entry and entry.get('duration') and entry['duration'] > DURATION_LIMIT_SECONDS:
-                        raise ValueError(f"Плейлист содержит контент длиннее {DURATION_LIMIT_SECONDS/60} минут: {entry.get('title', 'Без названия')}")
-                if PLAYLIST_DURATION_CHECK_LIMIT and entries:
-                    total = info.get('playlist_count') or len(entries)
-                    checked = min(len(entries), PLAYLIST_DURATION_CHECK_LIMIT)
-                    if total > checked:
-                        logger.debug(f"Проверено первых {checked} элементов из плейлиста (всего заявлено: {total}).")
-                return {"status": "success", "info": info}
-            elif info and info.get('duration') and info['duration'] > DURATION_LIMIT_SECONDS:
-                raise ValueError(f"Контент длиннее {DURATION_LIMIT_SECONDS/60} минут не может быть скачан: {info.get('title', 'Без названия')}")
-            return {"status": "success", "info": info}
+        clip_start = parse_timestamp(data.get('start'))
+        clip_end = parse_timestamp(data.get('end'))
+    except (TypeError, ValueError):
+        raise RequestValidationError("Некорректное время start/end. Укажите секунды или формат ЧЧ:ММ:СС.")
+    if clip_start is None and clip_end is None:
+        return None
+    clip_start = clip_start or 0.0
+    if clip_end is not None and clip_end <= clip_start:
+        raise RequestValidationError("Время end должно быть больше start.")
+    return clip_start, clip_end
+
+
+def resolve_clip_range(info, clip_range):
+    """Проверяет фрагмент по данным контента и возвращает его границы (start, end); ограничение длительности действует на длину фрагмента."""
+    if info and info.get('_type') == 'playlist':
+        raise RequestValidationError("Фрагмент по времени можно выбрать только для одиночного трека, не для плейлиста.")
+    clip_start, clip_end = clip_range
+    source_duration = (info or {}).get('duration')
+    if source_duration:
+        if clip_start >= source_duration:
+            raise RequestValidationError("Время start больше длительности контента.")
+        clip_end = min(clip_end, source_duration) if clip_end is not None else source_duration
+    elif clip_end is None:
+        raise RequestValidationError("Длительность контента неизвестна: укажите время end.")
+    if clip_end - clip_start > DURATION_LIMIT_SECONDS:
+        raise RequestValidationError(f"Фрагмент длиннее {DURATION_LIMIT_SECONDS/60} минут не может быть скачан.")
+    return clip_start, clip_end
+
+
+def clip_probe_info(probe_info, clip_range):
+    """Копия данных проверки с длительностью и размером фрагмента — для очереди загрузок и оценки места."""
+    clip_start, clip_end = clip_range
+    clipped = dict(probe_info or {})
+    source_duration = clipped.get('duration')
+    clipped['duration'] = clip_end - clip_start
+    if source_duration:
+        ratio = clipped['duration'] / source_duration
+        for size_key in ('filesize', 'filesize_approx'):
+            if clipped.get(size_key):
+                clipped[size_key] = int(clipped[size_key] * ratio)
+    return clipped
+
+
+def run_probe_job(url, record_outcome, func, *args):
+    """
+    Выполняет задачу проверки download_worker для url (в ASGI — в пуле 'probe') с учётом отрицательного кеша
+    и предохранителя источника. Ошибки yt-dlp классифицируются и превращаются в ValueError с сообщением для клиента,
+    разомкнутый источник — в ProviderUnavailableError.
+    record_outcome=False — фоновый запрос: он не обращается к разомкнутому источнику, не занимает пробный запрос
+    и не меняет состояние предохранителя.
+    """
+    media_key = canonical_media_key(url)
+    cached_error = NEGATIVE_RESULT_CACHE.get(media_key)
+    if cached_error:
+        logger.info(f"Проверка '{url}' пропущена: недавно завершилась ошибкой '{cached_error['error_class']}'.")
+        raise ValueError(f"Не удалось получить информацию о контенте: {cached_error['message']}")
+    if record_outcome:
+        breaker = acquire_circuit_breaker(extractor_for_url(url))
+    else:
+        breaker = get_circuit_breaker(extractor_for_url(url))
+        if breaker.is_open():
+            raise ProviderUnavailableError(breaker.name, breaker.retry_after())
+    provider_failed = False
+
+    try:
+        return run_job('probe', func, *args)
     except yt_dlp.utils.DownloadError as e:
         logger.error(f"Ошибка yt-dlp при получении информации: {e}")
+        error_class = classify_download_error(e)
+        provider_failed = error_class in PROVIDER_FAILURE_ERROR_CLASSES
+        if error_class in NEGATIVE_CACHE_ERROR_CLASSES:
+            NEGATIVE_RESULT_CACHE.put(media_key, error_class, DOWNLOAD_ERROR_MESSAGES[error_class])
+            raise ValueError(f"Не удалось получить информацию о контенте: {DOWNLOAD_ERROR_MESSAGES[error_class]}")
         raise ValueError(f"Не удалось получить информацию о контенте: {e}")
     except Exception as e:
         logger.error(f"Неожиданная ошибка при проверке длительности: {e}")
         raise ValueError(f"Произошла внутренняя ошибка при проверке длительности: {e}")
+    finally:
+        if record_outcome and provider_failed:
+            breaker.record_failure()
+        elif record_outcome:
+            breaker.record_success()
+
+
+def fetch_content_info(url, record_outcome=True):
+    """Получает info_dict контента без загрузки (с учётом отрицательного кеша и предохранителя источника, см. run_probe_job)."""
+    logger.info(f"Получаю информацию о контенте: {url}")
+    return run_probe_job(url, record_outcome, download_worker.extract_info_job, url, build_info_extractor_opts(url))
+
+
+def check_content_info(info, clip_range=None):
+    """Проверяет длительность контента (или фрагмента clip_range) и возвращает результат проверки."""
+    if clip_range:
+        return {"status": "success", "info": info, "clip_range": resolve_clip_range(info, clip_range)}
+    if info and info.get('_type') == 'playlist':
+        entries = info.get('entries') or []
+        for idx, entry in enumerate(entries, start=1):
+            if entry and entry.get('duration') and entry['duration'] > DURATION_LIMIT_SECONDS:
+                raise RequestValidationError(f"Плейлист содержит контент длиннее {DURATION_LIMIT_SECONDS/60} минут: {entry.get('title', 'Без названия')}")
+        if PLAYLIST_DURATION_CHECK_LIMIT and entries:
+            total = info.get('playlist_count') or len(entries)
+            checked = min(len(entries), PLAYLIST_DURATION_CHECK_LIMIT)
+            if total > checked:
+                logger.debug(f"Проверено первых {checked} элементов из плейлиста (всего заявлено: {total}).")
+        return {"status": "success", "info": info}
+    elif info and info.get('duration') and info['duration'] > DURATION_LIMIT_SECONDS:
+        raise RequestValidationError(f"Контент длиннее {DURATION_LIMIT_SECONDS/60} минут не может быть скачан: {info.get('title', 'Без названия')}")
+    return {"status": "success", "info": info}
+
+
+def get_info_and_check_duration(url, clip_range=None):
+    """
+    Получает информацию о контенте и проверяет его длительность.
+    Если задан фрагмент clip_range, ограничение применяется к его длине, а в ответе возвращаются его границы.
+    Метаданные, заранее полученные после поиска, берутся из SEARCH_PREFETCHER и помечаются ключом "prefetched_info".
+    """
+    prefetched_info = SEARCH_PREFETCHER.get(canonical_media_key(url))
+    if prefetched_info is not None:
+        logger.info(f"Использую предзагруженные метаданные: {url}")
+        return dict(check_content_info(prefetched_info, clip_range), prefetched_info=prefetched_info)
+    return check_content_info(fetch_content_info(url), clip_range)
+
 
 def normalize_supported_url(url):
     """
@@ -682,59 +2160,21 @@ def normalize_supported_url(url):
 
     return url
 
-# --- Маршруты Flask ---
-@app.route('/')
-def index():
-    """Рендерит главную страницу приложения."""
-    try:
-        return render_template('index.html')
-    except Exception as e:
-        logger.error(f"Ошибка при рендеринге index.html: {e}. Убедитесь, что templates/index.html существует.", exc_info=True)
-        return "Ошибка: Шаблон не найден. Обратитесь к администратору.", 500
-
-@app.route('/api/download_audio', methods=['POST'])
-def download_audio_route():
-    """Обрабатывает запрос на загрузку аудио/видео."""
-    data = request.get_json()
-    url = data.get('url')
-    requested_format = data.get('format', 'mp3').lower()
-
-    if not url or not is_valid_url(url):
-        return jsonify({"status": "error", "message": "Некорректный или отсутствующий URL."}), 400
-
-    normalized_url = normalize_supported_url(url)
-    if normalized_url != url:
-        logger.info("Обнаружен YouTube Music URL. Выполняю загрузку через стандартный YouTube эндпоинт.")
-        url = normalized_url
-
-    session_id = str(uuid.uuid4())
-    session_download_path = os.path.join(USER_DOWNLOADS_DIR, session_id)
-    os.makedirs(session_download_path, exist_ok=True)
-    logger.info(f"Запрос на скачивание: URL='{url}', Формат='{requested_format}', Сессия='{session_id}'")
-
-    # --- Проверка ограничения по длительности перед фактической загрузкой ---
-    try:
-        duration_check_result = get_info_and_check_duration(url)
-        if duration_check_result["status"] == "error":
-            shutil.rmtree(session_download_path)
-            return jsonify(duration_check_result), 400
-    except Exception as e:
-        logger.error(f"Ошибка при проверке длительности: {e}", exc_info=True)
-        if os.path.exists(session_download_path):
-            shutil.rmtree(session_download_path)
-        return jsonify({"status": "error", "message": f"Произошла ошибка при проверке длительности: {e}"}), 500
-
-    output_template = os.path.join(session_download_path, "%(title).75B.%(ext)s")
+def build_download_opts(url, requested_format, session_download_path, filename_template="%(title).75B.%(ext)s"):
+    """Формирует опции yt-dlp для загрузки в нужном формате. Возвращает None для неподдерживаемого формата."""
+    output_template = os.path.join(session_download_path, filename_template)
 
     ydl_opts = {
         'outtmpl': output_template,
         'restrictfilenames': True,
         'noplaylist': False,
-        'ignoreerrors': True,
+        # Плейлисты скачиваются по одному элементу на задачу: ошибка должна дойти до классификации, а не стать None
+        'ignoreerrors': False,
         'nocheckcertificate': True,
         'quiet': True,
         'no_warnings': True,
         'ffmpeg_location': FFMPEG_PATH if FFMPEG_IS_AVAILABLE else None,
+        'postprocessor_args': {'default': TRANSCODE_SCHEDULER.ffmpeg_args()} if FFMPEG_IS_AVAILABLE else None,
         'extract_flat': 'in_playlist',
         'skip_download': False,
     }
@@ -797,9 +2237,7 @@ def download_audio_route():
             logger.warning("FFmpeg не найден. Попытка скачать лучшее видео (может быть не MP4 720p).")
             ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
     else:
-        if os.path.exists(session_download_path):
-            shutil.rmtree(session_download_path)
-        return jsonify({"status": "error", "message": "Неподдерживаемый формат. Выберите MP3, M4A, Opus или MP4."}), 400
+        return None
 
     ydl_opts_cleaned = {k: v for k, v in ydl_opts.items() if v is not None}
     if 'postprocessors' in ydl_opts_cleaned and not ydl_opts_cleaned['postprocessors']:
@@ -808,80 +2246,606 @@ def download_audio_route():
         del ydl_opts_cleaned['postprocessor_args']
     elif 'postprocessor_args' in ydl_opts_cleaned and not ydl_opts_cleaned['postprocessor_args']:
         del ydl_opts_cleaned['postprocessor_args']
+    return ydl_opts_cleaned
+
+
+def apply_clip_range(ydl_opts, clip_range):
+    """Ограничивает загрузку фрагментом: yt-dlp запрашивает только его байты и фрагменты, ffmpeg обрабатывает только его."""
+    clip_start, clip_end = clip_range
+    ydl_opts['download_ranges'] = yt_dlp.utils.download_range_func(None, [(clip_start, clip_end)])
+    return ydl_opts
 
-    logger.debug(f"Финальные опции yt-dlp: {json.dumps(ydl_opts_cleaned, indent=2, ensure_ascii=False)}")
+
+def locate_downloaded_file(entry, produced_files=None):
+    """
+    Возвращает путь к файлу, скачанному yt-dlp для записи, или None.
+    produced_files — итоговые пути, о которых сообщил post_hook yt-dlp; с ними проверка диска не нужна.
+    """
+    candidates = [req_download.get('filepath') for req_download in entry.get('requested_downloads') or [] if req_download]
+    candidates.append(entry.get('filepath'))
+    for candidate in candidates:
+        if not candidate:
+            continue
+        if produced_files is not None:
+            if candidate in produced_files:
+                return candidate
+        elif os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def finalize_output_file(actual_filepath, display_title, metadata, manifest, output_format=None):
+    """Переименовывает файл в читаемый вид, записывает теги, вносит его в манифест и возвращает описание файла для ответа."""
+    actual_filepath, filename, _ = prepare_readable_download(actual_filepath, display_title, manifest)
+    if not actual_filepath or not os.path.exists(actual_filepath):
+        logger.warning(f"Файл '{filename}' (ожидаемый путь: '{actual_filepath}') не найден в папке сессии. Проверьте outtmpl и права на запись.")
+        return None
+
+    output_format = output_format or os.path.splitext(filename)[1].lstrip('.').lower()
+    thumbnail_preview = tag_and_register_file(actual_filepath, metadata, manifest, output_format)
+    response_metadata = {
+        "title": metadata.get("title"),
+        "artist": metadata.get("artist"),
+        "original_artist": metadata.get("original_artist"),
+        "album": metadata.get("album"),
+        "thumbnail": thumbnail_preview,
+        "source_url": metadata.get("source_url")
+    }
+    return {
+        "filename": filename,
+        "title": display_title,
+        "artist": metadata.get("artist", GLOBAL_ARTIST_NAME),
+        "format": output_format,
+        "thumbnail": thumbnail_preview,
+        "metadata": response_metadata,
+        "download_url": f"/serve_file/{manifest.session_id}/{filename.replace('%', '%25')}"
+    }
+
+
+def finalize_downloaded_entry(entry, manifest, requested_formats=None, produced_files=None):
+    """
+    Переименовывает и тегирует файлы скачанной записи. Возвращает список описаний файлов для ответа.
+    Если запрошено несколько форматов, они получаются из скачанного исходника одним запуском ffmpeg.
+    """
+    if not entry:
+        logger.warning(f"Пропущена пустая или ошибочная запись в плейлисте (ID: {entry.get('id', 'N/A') if entry else 'N/A'})")
+        return []
+
+    actual_filepath = locate_downloaded_file(entry, produced_files)
+    if not actual_filepath:
+        logger.warning(f"Не удалось определить путь к скачанному файлу для записи: '{entry.get('title', 'ID: '+str(entry.get('id')))}'. Возможно, элемент не был скачан или произошла ошибка при загрузке конкретного элемента плейлиста.")
+        return []
+
+    track_name, artist_name = extract_track_metadata(entry)
+    display_title = compose_full_title(track_name, artist_name)
+    metadata = build_track_metadata(entry, track_name, artist_name)
+
+    if not requested_formats or len(requested_formats) < 2:
+        # Формат берётся из расширения: без FFmpeg файл может прийти не в запрошенном формате
+        file_info = finalize_output_file(actual_filepath, display_title, metadata, manifest)
+        return [file_info] if file_info else []
 
     try:
-        info_dict = blocking_yt_dlp_download(ydl_opts_cleaned, url)
+        with profile_phase('transcode'):
+            outputs = transcode_to_formats(actual_filepath, requested_formats, entry.get('acodec'))
+    finally:
+        if os.path.exists(actual_filepath):
+            os.remove(actual_filepath)
+
+    files = []
+    for output_format in requested_formats:
+        if output_format not in outputs:
+            logger.warning(f"FFmpeg не создал файл в формате {output_format} для '{display_title}'.")
+            continue
+        file_info = finalize_output_file(outputs[output_format], display_title, metadata, manifest, output_format)
+        if file_info:
+            files.append(file_info)
+    return files
+
+
+def parse_requested_formats(raw_format):
+    """Возвращает список запрошенных форматов без повторов: принимает строку, строку через запятую или список."""
+    if isinstance(raw_format, str):
+        values = raw_format.split(',')
+    elif isinstance(raw_format, (list, tuple)):
+        values = raw_format
+    else:
+        values = []
+    formats = []
+    for value in values:
+        output_format = str(value).strip().lower()
+        if output_format and output_format not in formats:
+            formats.append(output_format)
+    return formats or ['mp3']
+
+
+def build_multi_format_download_opts(url, requested_formats, session_download_path):
+    """Опции yt-dlp для загрузки одного исходника, из которого затем получаются все запрошенные форматы."""
+    if any(output_format not in SUPPORTED_FORMATS for output_format in requested_formats):
+        return None
+    source_format = 'mp4' if 'mp4' in requested_formats else requested_formats[0]
+    ydl_opts = build_download_opts(url, source_format, session_download_path, "%(title).75B.source.%(ext)s")
+    # Конвертация выполняется позже, одним запуском ffmpeg для всех форматов
+    ydl_opts.pop('postprocessors', None)
+    if source_format == 'mp4':
+        ydl_opts['merge_output_format'] = 'mp4'
+    return ydl_opts
+
+
+def build_ffmpeg_output_args(output_format, source_ext, source_acodec):
+    """Аргументы ffmpeg для одного выхода; кодек копируется без перекодирования, если исходник уже подходит."""
+    acodec = (source_acodec or '').lower()
+    if output_format == 'mp3':
+        return ['-map', '0:a:0', '-vn', '-c:a', 'libmp3lame', '-b:a', '192k']
+    if output_format == 'm4a':
+        codec_args = ['-c:a', 'copy'] if acodec.startswith(('mp4a', 'aac')) else ['-c:a', 'aac', '-b:a', '192k']
+        return ['-map', '0:a:0', '-vn', *codec_args]
+    if output_format == 'opus':
+        codec_args = ['-c:a', 'copy'] if acodec == 'opus' else ['-c:a', 'libopus', '-b:a', '192k']
+        return ['-map', '0:a:0', '-vn', *codec_args]
+    if output_format == 'mp4':
+        if source_ext == 'mp4':
+            return ['-map', '0:v:0?', '-map', '0:a:0?', '-c', 'copy', '-movflags', '+faststart']
+        return ['-map', '0:v:0?', '-map', '0:a:0?', '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac', '-b:a', '192k', '-movflags', '+faststart']
+    raise ValueError(f"Неподдерживаемый формат: {output_format}")
+
+
+def transcode_to_formats(source_path, output_formats, source_acodec=None):
+    """Получает все форматы из одного исходника одним запуском ffmpeg с несколькими выходами. Возвращает {формат: путь}."""
+    base, source_ext = os.path.splitext(source_path)
+    source_ext = source_ext.lstrip('.').lower()
+    if base.endswith('.source'):
+        base = base[:-len('.source')]
+
+    command = [FFMPEG_PATH, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', '-i', source_path]
+    outputs = {}
+    for output_format in output_formats:
+        output_path = f"{base}.{output_format}"
+        command += [*build_ffmpeg_output_args(output_format, source_ext, source_acodec), *TRANSCODE_SCHEDULER.ffmpeg_args(), output_path]
+        outputs[output_format] = output_path
+
+    logger.info(f"Конвертация '{os.path.basename(source_path)}' в форматы {', '.join(output_formats)} одним запуском FFmpeg.")
+    result = TRANSCODE_SCHEDULER.run(subprocess.run, command, capture_output=True, text=True)
+    if result.returncode != 0:
+        stderr_tail = (result.stderr or '').strip()[-500:]
+        raise Exception(f"Ошибка конвертации FFmpeg (код {result.returncode}): {stderr_tail}")
+    return {output_format: path for output_format, path in outputs.items() if os.path.exists(path)}
+
+
+def download_playlist_entries(playlist_info, ydl_opts, client_key):
+    """
+    Скачивает элементы плейлиста по одному, каждый через DOWNLOAD_SCHEDULER.
+    Так длинный плейлист не занимает слоты целиком и чередуется с одиночными запросами других клиентов.
+    """
+    entry_opts = dict(ydl_opts, noplaylist=True)
+    downloaded_entries = []
+    for entry in playlist_info.get('entries') or []:
+        if not entry:
+            continue
+        entry_url = entry.get('webpage_url') or entry.get('original_url') or entry.get('url')
+        if not entry_url:
+            logger.warning(f"Пропущен элемент плейлиста без URL: '{entry.get('title', 'ID: ' + str(entry.get('id')))}'")
+            continue
 
-        if info_dict is None:
-            logger.error(f"Не удалось получить info_dict для URL '{url}'. blocking_yt_dlp_download вернул None.")
-            if os.path.exists(session_download_path):
-                shutil.rmtree(session_download_path)
-                logger.info(f"Удалена проблемная папка сессии: {session_download_path}")
-            return jsonify({"status": "error", "message": "Не удалось загрузить или получить информацию о контенте. Возможно, контент недоступен, защищен или возникла внутренняя ошибка."}), 500
+        try:
+            with DOWNLOAD_SCHEDULER.slot(client_key, entry.get('duration')):
+                entry_info = blocking_yt_dlp_download(entry_opts, entry_url)
+        except Exception as entry_error:
+            logger.warning(f"Не удалось скачать элемент плейлиста '{entry_url}': {entry_error}")
+            continue
+        if not entry_info:
+            logger.warning(f"Элемент плейлиста не скачан: '{entry_url}'")
+            continue
+
+        # Отдельная загрузка элемента теряет контекст плейлиста, нужный для названия альбома
+        playlist_context = {
+            'playlist': playlist_info.get('title'),
+            'playlist_title': playlist_info.get('title'),
+            'playlist_id': playlist_info.get('id'),
+            'playlist_type': playlist_info.get('playlist_type'),
+        }
+        for key in PLAYLIST_CONTEXT_KEYS:
+            value = entry.get(key) or playlist_context.get(key)
+            if value and not entry_info.get(key):
+                entry_info[key] = value
+        downloaded_entries.append(entry_info)
+    return downloaded_entries
+
+
+def download_entries(url, ydl_opts, client_key, probe_info, prefetched_info=None):
+    """
+    Скачивает контент через DOWNLOAD_SCHEDULER и возвращает список info_dict скачанных записей.
+    Возвращает None, если yt-dlp не смог загрузить одиночный контент.
+    С prefetched_info одиночный контент скачивается без повторного извлечения; при неудаче — с ним.
+    """
+    probe_info = probe_info or {}
+    if probe_info.get('_type') == 'playlist':
+        logger.info(f"Обработка плейлиста: {probe_info.get('title', 'Без названия')}")
+        return download_playlist_entries(probe_info, ydl_opts, client_key)
+
+    with DOWNLOAD_SCHEDULER.slot(client_key, probe_info.get('duration')):
+        info_dict = blocking_yt_dlp_download(ydl_opts, url, prefetched_info)
+        if info_dict is None and prefetched_info is not None:
+            # Ссылки на форматы в предзагруженных данных могли устареть
+            logger.warning(f"Загрузка по предзагруженным метаданным не удалась, повторяю с извлечением: {url}")
+            SEARCH_PREFETCHER.discard(canonical_media_key(url))
+            info_dict = blocking_yt_dlp_download(ydl_opts, url)
+
+    if info_dict is None:
+        return None
+    if info_dict.get('_type') == 'playlist':
+        logger.info(f"Обработка плейлиста: {info_dict.get('title', 'Без названия')}")
+        return info_dict.get('entries', []) or []
+    return [info_dict]
+
+
+def describe_download_error(error):
+    """Преобразует исключение загрузки в сообщение для пользователя."""
+    user_message = "Произошла ошибка на сервере при обработке вашего запроса."
+    if isinstance(error, yt_dlp.utils.DownloadError) and ("Unsupported URL" in str(error) or "Unable to extract" in str(error)):
+        user_message = "Неподдерживаемый URL или не удалось извлечь информацию. Убедитесь, что ссылка корректна."
+    elif "FFmpeg" in str(error):
+        user_message = "Ошибка конвертации. Возможно, проблема с FFmpeg на сервере. (Хотя FFmpeg найден, могла быть проблема с его использованием)"
+    elif "private video" in str(error).lower() or "login required" in str(error).lower():
+        user_message = "Это приватное видео или для доступа требуется вход."
+    elif "video unavailable" in str(error).lower() or "track unavailable" in str(error).lower():
+        user_message = "Контент недоступен или был удален."
+    return user_message
+
+
+def canonical_media_key(url, info=None):
+    """
+    Возвращает канонический идентификатор контента для дедупликации запросов.
+    После проверки это extractor:id из info_dict, до неё — ID YouTube или нормализованный URL.
+    """
+    if info and info.get('id'):
+        extractor = (info.get('extractor_key') or info.get('extractor') or 'generic').lower()
+        return f"{extractor}:{info['id']}"
 
-        downloaded_files_list = []
-        entries_to_check = []
-        if '_type' in info_dict and info_dict['_type'] == 'playlist':
-            logger.info(f"Обработка плейлиста: {info_dict.get('title', 'Без названия')}")
-            entries_to_check = info_dict.get('entries', []) or []
-        else:
-            entries_to_check = [info_dict]
+    try:
+        parsed = urlparse(url)
+    except Exception:
+        return url
+    video_id = extract_youtube_video_id_from_url(url)
+    if video_id and 'list' not in parse_qs(parsed.query or ''):
+        return f"youtube:{video_id}"
+    return urlunparse(parsed._replace(scheme=parsed.scheme.lower(), netloc=parsed.netloc.lower(), fragment='')).rstrip('/')
 
-        for entry in entries_to_check:
-            if not entry:
-                logger.warning(f"Пропущена пустая или ошибочная запись в плейлисте (ID: {entry.get('id', 'N/A') if entry else 'N/A'})")
-                continue
 
-            track_name, artist_name = extract_track_metadata(entry)
-            display_title = compose_full_title(track_name, artist_name)
-            metadata = build_track_metadata(entry, track_name, artist_name)
-            actual_filepath = None
-            if entry.get('requested_downloads'):
-                for req_download in entry['requested_downloads']:
-                    if req_download and req_download.get('filepath') and os.path.exists(req_download['filepath']):
-                        actual_filepath = req_download['filepath']
-                        break
-            if not actual_filepath and entry.get('filepath') and os.path.exists(entry['filepath']):
-                actual_filepath = entry['filepath']
-
-            if actual_filepath:
-                actual_filepath, filename, _ = prepare_readable_download(actual_filepath, display_title)
-                if actual_filepath and os.path.exists(actual_filepath):
-                    apply_metadata_tags(actual_filepath, metadata)
-                    thumbnail_preview = build_thumbnail_preview(metadata)
-                    response_metadata = {
-                        "title": metadata.get("title"),
-                        "artist": metadata.get("artist"),
-                        "original_artist": metadata.get("original_artist"),
-                        "album": metadata.get("album"),
-                        "thumbnail": thumbnail_preview,
-                        "source_url": metadata.get("source_url")
-                    }
-                    downloaded_files_list.append({
-                        "filename": filename,
-                        "title": display_title,
-                        "artist": metadata.get("artist", GLOBAL_ARTIST_NAME),
-                        "thumbnail": thumbnail_preview,
-                        "metadata": response_metadata,
-                        "download_url": f"/serve_file/{session_id}/{filename.replace('%', '%25')}"
-                    })
-                else:
-                    logger.warning(f"Файл '{filename}' (ожидаемый путь: '{actual_filepath}') не найден в папке сессии. Проверьте outtmpl и права на запись.")
-            else:
-                logger.warning(f"Не удалось определить путь к скачанному файлу для записи: '{entry.get('title', 'ID: '+str(entry.get('id')))}'. Возможно, элемент не был скачан или произошла ошибка при загрузке конкретного элемента плейлиста.")
+def clone_session_file(manifest, file_info):
+    """
+    Создаёт для повторного элемента пакета собственный файл (жёсткую ссылку или копию) с отдельной ссылкой на отдачу:
+    отданный файл удаляется, поэтому общая ссылка сработала бы только для первого элемента.
+    """
+    source_entry = manifest.get(file_info["filename"])
+    source_path = source_entry["path"]
+    directory = os.path.dirname(source_path)
+    filename = manifest.reserve_filename(directory, file_info["filename"])
+    target_path = os.path.join(directory, filename)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copy2(source_path, target_path)
+    manifest.add_file(target_path, file_info["format"], file_info["metadata"], sha256=source_entry.get("sha256"))
+    return {**file_info, "filename": filename, "download_url": f"/serve_file/{manifest.session_id}/{filename.replace('%', '%25')}"}
+
+
+def batch_request_cost(data):
+    """Стоимость пакетного запроса для BATCH_RATE_LIMITER — число элементов в нём."""
+    items = data.get('items') if isinstance(data, dict) else None
+    return len(items) if isinstance(items, list) and items else 1
+
+
+# --- Маршруты Flask ---
+# --- Статические ресурсы ---
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def compress_asset(data, encoding):
+    """Сжимает данные с максимальным уровнем: сборка выполняется один раз, а отдаётся много раз."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=11) if BROTLI_AVAILABLE else None
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+
+def build_static_assets(static_dir=STATIC_DIR, build_dir=ASSET_BUILD_DIR):
+    """
+    Копирует статику в build_dir под именами с хешем содержимого, заранее сжимает текстовые файлы
+    и записывает манифест {исходный путь: описание ресурса}, который читают воркеры. Пути вариантов — относительно build_dir.
+    Уже собранные файлы не пересобираются. Запуск: python -m app build-assets. Возвращает манифест.
+    """
+    manifest = {}
+    for dirpath, _, filenames in os.walk(static_dir):
+        for name in filenames:
+            source_path = os.path.join(dirpath, name)
+            relative_path = os.path.relpath(source_path, static_dir).replace(os.sep, '/')
+            with open(source_path, 'rb') as source_file:
+                data = source_file.read()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            base, ext = os.path.splitext(relative_path)
+            hashed_path = f"{base}.{digest}{ext}"
+
+            identity_path = os.path.join(build_dir, hashed_path)
+            if not os.path.exists(identity_path):
+                _write_file_atomic(identity_path, data)
+            variants = {'identity': hashed_path}
+            if ext.lower() in ASSET_COMPRESSIBLE_EXTENSIONS:
+                for encoding, suffix in ASSET_ENCODINGS:
+                    compressed_path = identity_path + suffix
+                    if not os.path.exists(compressed_path):
+                        compressed = compress_asset(data, encoding)
+                        if compressed is None or len(compressed) >= len(data):
+                            continue
+                        _write_file_atomic(compressed_path, compressed)
+                    variants[encoding] = hashed_path + suffix
+
+            manifest[relative_path] = {
+                "path": hashed_path,
+                "etag": digest,
+                "mimetype": mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                "variants": variants,
+            }
+    _write_file_atomic(os.path.join(build_dir, ASSET_MANIFEST_FILENAME), json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+    return manifest
+
+
+def load_static_assets(build_dir=ASSET_BUILD_DIR):
+    """
+    Читает манифест заранее собранной статики. Сборка при импорте не выполняется: без манифеста
+    (сборку не запускали или отпечатки отключены) страницы ссылаются на обычный /static.
+    """
+    if not STATIC_FINGERPRINT_ENABLED:
+        return {}
+    try:
+        with open(os.path.join(build_dir, ASSET_MANIFEST_FILENAME), encoding='utf-8') as manifest_file:
+            assets = json.load(manifest_file)
+    except FileNotFoundError:
+        logger.warning("Манифест статики не найден, используется обычная отдача /static. Соберите его: python -m app build-assets")
+        return {}
+    except (OSError, ValueError) as manifest_error:
+        logger.error(f"Не удалось прочитать манифест статики, используется обычная отдача /static: {manifest_error}")
+        return {}
+    logger.info(f"Загружен манифест статики: {len(assets)} ресурсов.")
+    return assets
+
+
+_STATIC_ASSETS = None
+_HASHED_ASSETS = None
+_STATIC_ASSETS_LOCK = threading.Lock()
+
+
+def get_static_assets():
+    """Манифест статики, прочитанный при первом обращении (процессы загрузок его не читают)."""
+    global _STATIC_ASSETS, _HASHED_ASSETS
+    if _STATIC_ASSETS is None:
+        with _STATIC_ASSETS_LOCK:
+            if _STATIC_ASSETS is None:
+                assets = load_static_assets()
+                _HASHED_ASSETS = {asset["path"]: asset for asset in assets.values()}
+                _STATIC_ASSETS = assets
+    return _STATIC_ASSETS
+
+
+def get_hashed_asset(hashed_path):
+    get_static_assets()
+    return _HASHED_ASSETS.get(hashed_path)
+
+
+RENDERED_PAGES = {}
+RENDERED_PAGES_LOCK = threading.Lock()
+
+
+@app.template_global()
+def asset_url(filename):
+    """URL ресурса с хешем содержимого; без сборки — обычный /static."""
+    asset = get_static_assets().get(filename)
+    if asset:
+        return url_for('serve_hashed_asset', hashed_path=asset["path"])
+    return url_for('static', filename=filename)
+
+
+@app.template_global()
+def locale_asset_urls():
+    """Адреса файлов локализации для main.js: {код языка: URL}."""
+    return {
+        os.path.splitext(filename[len('i18n/'):])[0]: asset_url(filename)
+        for filename in get_static_assets()
+        if filename.startswith('i18n/') and filename.endswith('.json')
+    }
+
+
+def select_content_encoding(variants):
+    """Выбирает лучший доступный вариант сжатия из принимаемых клиентом."""
+    for encoding, _ in ASSET_ENCODINGS:
+        if encoding in variants and request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return 'identity'
+
+
+def get_rendered_page(template_name):
+    """Рендерит шаблон один раз и хранит его сжатые варианты; в режиме отладки рендерит заново."""
+    with RENDERED_PAGES_LOCK:
+        page = RENDERED_PAGES.get(template_name)
+        if page is None or app.debug:
+            body = render_template(template_name).encode('utf-8')
+            variants = {'identity': body}
+            for encoding, _ in ASSET_ENCODINGS:
+                compressed = compress_asset(body, encoding)
+                if compressed is not None and len(compressed) < len(body):
+                    variants[encoding] = compressed
+            page = {"etag": hashlib.sha256(body).hexdigest()[:16], "variants": variants}
+            RENDERED_PAGES[template_name] = page
+    return page
+
+
+@app.route('/')
+def index():
+    """Рендерит главную страницу приложения."""
+    try:
+        page = get_rendered_page('index.html')
+    except Exception as e:
+        logger.error(f"Ошибка при рендеринге index.html: {e}. Убедитесь, что templates/index.html существует.", exc_info=True)
+        return "Ошибка: Шаблон не найден. Обратитесь к администратору.", 500
+
+    # Страница ссылается на ресурсы с хешем, поэтому её саму браузер перепроверяет по ETag при каждом визите
+    encoding = select_content_encoding(page["variants"])
+    response = Response(page["variants"][encoding], mimetype='text/html')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.set_etag(f"{page['etag']}-{encoding}")
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+
+@app.route('/hashed/<path:hashed_path>')
+def serve_hashed_asset(hashed_path):
+    """Отдаёт ресурс с хешем в имени: заранее сжатый вариант и бессрочное кеширование."""
+    asset = get_hashed_asset(hashed_path)
+    if not asset:
+        return "Файл не найден.", 404
+    encoding = select_content_encoding(asset["variants"])
+    response = send_file(
+        os.path.join(ASSET_BUILD_DIR, asset["variants"][encoding]),
+        mimetype=asset["mimetype"],
+        etag=f"{asset['etag']}-{encoding}",
+        max_age=ASSET_MAX_AGE_SECONDS,
+        conditional=True,
+    )
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = f"public, max-age={ASSET_MAX_AGE_SECONDS}, immutable"
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/healthz')
+def healthz():
+    """Проверка готовности для балансировщика: 503, если свободной мощности не осталось."""
+    capacity = DOWNLOAD_ADMISSION.capacity()
+    ready = capacity["remaining"] > 0
+    with CIRCUIT_BREAKERS_LOCK:
+        breakers = list(CIRCUIT_BREAKERS.values())
+    open_circuits = sorted(breaker.name for breaker in breakers if breaker.is_open())
+    return jsonify({"status": "ok" if ready else "busy", "capacity": capacity, "open_circuits": open_circuits}), 200 if ready else 503
+
+
+def validate_download_request(data):
+    """
+    Проверяет тело запроса на загрузку (обычной и ленивой). Возвращает (url, форматы, фрагмент или None),
+    где url уже приведён к поддерживаемому виду; выбрасывает RequestValidationError с сообщением для пользователя.
+    """
+    url = data.get('url')
+    requested_formats = parse_requested_formats(data.get('formats') or data.get('format', 'mp3'))
+
+    if not url or not is_valid_url(url):
+        raise RequestValidationError("Некорректный или отсутствующий URL.")
+
+    normalized_url = normalize_supported_url(url)
+    if normalized_url != url:
+        logger.info("Обнаружен YouTube Music URL. Выполняю загрузку через стандартный YouTube эндпоинт.")
+        url = normalized_url
 
-        if not downloaded_files_list and os.path.exists(session_download_path) and any(os.scandir(session_download_path)):
-            logger.warning("Файлы не извлечены из info_dict, сканируем директорию сессии (запасной вариант).")
-            for f_name in os.listdir(session_download_path):
-                file_path_check = os.path.join(session_download_path, f_name)
+    if any(output_format not in SUPPORTED_FORMATS for output_format in requested_formats):
+        raise RequestValidationError("Неподдерживаемый формат. Выберите MP3, M4A, Opus или MP4.")
+    if len(requested_formats) > 1 and not FFMPEG_IS_AVAILABLE:
+        raise RequestValidationError("Для получения нескольких форматов за один запрос на сервере нужен FFmpeg.")
+
+    clip_range = parse_clip_range(data)
+    if clip_range and not FFMPEG_IS_AVAILABLE:
+        raise RequestValidationError("Для загрузки фрагмента по времени на сервере нужен FFmpeg.")
+    return url, requested_formats, clip_range
+
+
+def process_download_request(data, client_key):
+    """Выполняет запрос на загрузку аудио/видео. Возвращает (тело ответа, HTTP-код); не зависит от Flask."""
+    try:
+        url, requested_formats, clip_range = validate_download_request(data or {})
+    except RequestValidationError as e:
+        return {"status": "error", "message": str(e)}, 400
+    requested_format = requested_formats[0]
+    multi_format = len(requested_formats) > 1
+
+    session_id = str(uuid.uuid4())
+    logger.info(f"Запрос на скачивание: URL='{url}', Формат='{', '.join(requested_formats)}', Сессия='{session_id}'")
+
+    # --- Проверка ограничения по длительности перед фактической загрузкой ---
+    try:
+        with profile_phase('probe'):
+            duration_check_result = get_info_and_check_duration(url, clip_range)
+        if duration_check_result["status"] == "error":
+            return duration_check_result, 400
+    except RequestValidationError as e:
+        logger.info(f"Запрос отклонён проверкой: {e}")
+        return {"status": "error", "message": str(e)}, 400
+    except ProviderUnavailableError as e:
+        logger.warning(str(e))
+        return {"status": "error", "message": str(e), "retry_after": e.retry_after}, 503
+    except Exception as e:
+        logger.error(f"Ошибка при проверке длительности: {e}", exc_info=True)
+        return {"status": "error", "message": f"Произошла ошибка при проверке длительности: {e}"}, 500
+
+    probe_info = duration_check_result.get("info") or {}
+    clip_range = duration_check_result.get("clip_range")
+    if clip_range:
+        logger.info(f"Запрошен фрагмент {clip_range[0]:.1f}–{clip_range[1]:.1f} с, Сессия='{session_id}'")
+        # Очередь загрузок и оценка места считаются по длине фрагмента, а не исходника
+        probe_info = clip_probe_info(probe_info, clip_range)
+    try:
+        session_download_path = SESSION_STORAGE.allocate(session_id, estimate_session_bytes(probe_info, requested_formats))
+    except OSError as e:
+        logger.error(f"Не удалось создать папку сессии {session_id}: {e}", exc_info=True)
+        return {"status": "error", "message": "Не удалось подготовить место для загрузки. Попробуйте повторить запрос позже."}, 500
+    manifest = SessionManifest(session_id, session_download_path)
+
+    if multi_format:
+        ydl_opts_cleaned = build_multi_format_download_opts(url, requested_formats, session_download_path)
+    else:
+        ydl_opts_cleaned = build_download_opts(url, requested_format, session_download_path)
+    if ydl_opts_cleaned is None:
+        SESSION_STORAGE.discard(session_id)
+        return {"status": "error", "message": "Неподдерживаемый формат. Выберите MP3, M4A, Opus или MP4."}, 400
+    if clip_range:
+        apply_clip_range(ydl_opts_cleaned, clip_range)
+
+    # Итоговые пути файлов сообщает сам yt-dlp — без поиска по папке сессии
+    produced_files = []
+    ydl_opts_cleaned['post_hooks'] = [produced_files.append]
+
+    logger.debug(f"Финальные опции yt-dlp: {json.dumps(ydl_opts_cleaned, indent=2, ensure_ascii=False, default=str)}")
+
+    try:
+        with profile_phase('download'):
+            entries_to_check = download_entries(url, ydl_opts_cleaned, client_key, probe_info, duration_check_result.get("prefetched_info"))
+        if entries_to_check is None:
+            logger.error(f"Не удалось получить info_dict для URL '{url}'. blocking_yt_dlp_download вернул None.")
+            SESSION_STORAGE.discard(session_id)
+            logger.info(f"Удалена проблемная папка сессии: {session_download_path}")
+            return {"status": "error", "message": "Не удалось загрузить или получить информацию о контенте. Возможно, контент недоступен, защищен или возникла внутренняя ошибка."}, 500
+
+        downloaded_files_list = []
+        with profile_phase('finalize'):
+            for entry in entries_to_check:
+                downloaded_files_list.extend(finalize_downloaded_entry(entry, manifest, requested_formats, set(produced_files)))
+
+        if not downloaded_files_list and produced_files:
+            logger.warning("Файлы не сопоставлены с записями info_dict, используем пути из post_hook yt-dlp (запасной вариант).")
+            for file_path_check in produced_files:
+                f_name = os.path.basename(file_path_check)
                 if os.path.isfile(file_path_check) and f_name.lower().endswith(('.mp3', '.m4a', '.mp4', '.ogg', '.opus')):
                     base_name_for_title = os.path.splitext(f_name)[0]
                     title_part = base_name_for_title.strip()
                     if '[' in title_part and title_part.endswith(']'):
                         title_part = title_part.rsplit('[', 1)[0].strip()
-                    prepared_path, prepared_name, prepared_title = prepare_readable_download(file_path_check, title_part)
+                    prepared_path, prepared_name, prepared_title = prepare_readable_download(file_path_check, title_part, manifest)
                     target_name = prepared_name if prepared_name else f_name
                     title_value = title_part if title_part else prepared_title
                     metadata_target_path = prepared_path if prepared_path else os.path.join(session_download_path, target_name)
@@ -896,8 +2860,9 @@ def download_audio_route():
                         "cover_url": None,
                         "source_url": None
                     }
-                    apply_metadata_tags(metadata_target_path, fallback_metadata)
-                    fallback_thumbnail = build_thumbnail_preview(fallback_metadata)
+                    fallback_thumbnail = tag_and_register_file(
+                        metadata_target_path, fallback_metadata, manifest, os.path.splitext(target_name)[1].lstrip('.').lower()
+                    )
                     downloaded_files_list.append({
                         "filename": target_name,
                         "title": title_value if title_value else target_name,
@@ -917,62 +2882,498 @@ def download_audio_route():
 
         if not downloaded_files_list:
             logger.error(f"Файлы не найдены в {session_download_path} после попытки скачивания для URL: {url}.")
-            if os.path.exists(session_download_path):
-                shutil.rmtree(session_download_path)
-                logger.info(f"Удалена пустая или проблемная папка сессии: {session_download_path}")
-            return jsonify({"status": "error", "message": "Не удалось скачать или найти файлы. Проверьте URL, формат или логи сервера для подробностей."}), 500
-
-        return jsonify({"status": "success", "files": downloaded_files_list})
-
+            SESSION_STORAGE.discard(session_id)
+            logger.info(f"Удалена пустая или проблемная папка сессии: {session_download_path}")
+            return {"status": "error", "message": "Не удалось скачать или найти файлы. Проверьте URL, формат или логи сервера для подробностей."}, 500
+
+    except ProviderUnavailableError as e:
+        logger.warning(str(e))
+        SESSION_STORAGE.discard(session_id)
+        return {"status": "error", "message": str(e), "retry_after": e.retry_after}, 503
     except Exception as e:
         logger.error(f"Ошибка при обработке запроса на скачивание URL '{url}': {e}", exc_info=True)
-        if os.path.exists(session_download_path):
-            shutil.rmtree(session_download_path)
-            logger.info(f"Удалена папка сессии из-за ошибки: {session_download_path}")
-        user_message = "Произошла ошибка на сервере при обработке вашего запроса."
-        if isinstance(e, yt_dlp.utils.DownloadError) and ("Unsupported URL" in str(e) or "Unable to extract" in str(e)):
-            user_message = "Неподдерживаемый URL или не удалось извлечь информацию. Убедитесь, что ссылка корректна."
-        elif "FFmpeg" in str(e):
-            user_message = "Ошибка конвертации. Возможно, проблема с FFmpeg на сервере. (Хотя FFmpeg найден, могла быть проблема с его использованием)"
-        elif "private video" in str(e).lower() or "login required" in str(e).lower():
-            user_message = "Это приватное видео или для доступа требуется вход."
-        elif "video unavailable" in str(e).lower() or "track unavailable" in str(e).lower():
-            user_message = "Контент недоступен или был удален."
-
-        return jsonify({"status": "error", "message": user_message}), 500
+        SESSION_STORAGE.discard(session_id)
+        logger.info(f"Удалена папка сессии из-за ошибки: {session_download_path}")
+        return {"status": "error", "message": describe_download_error(e)}, 500
+
+    # Файлы уже готовы: сбой переноса из RAM не должен стоить клиенту успешной загрузки
+    settle_session(session_id, manifest)
+    register_session_files(session_id, downloaded_files_list)
+    return {"status": "success", "files": downloaded_files_list}, 200
+
+
+def process_lazy_playlist_request(data, client_key):
+    """
+    Ленивый режим загрузки плейлиста. Возвращает (генератор событий, 200) или (тело ошибки, HTTP-код).
+    Элементы читаются из yt-dlp по одному (extract_info с process=False), каждый скачивается, тегируется
+    и регистрируется сразу, а его info_dict отбрасывается — память не растёт с длиной плейлиста,
+    и первые файлы можно забирать, пока остальные ещё скачиваются.
+    """
+    try:
+        url, requested_formats, clip_range = validate_download_request(data or {})
+    except RequestValidationError as e:
+        return {"status": "error", "message": str(e)}, 400
+    if clip_range:
+        return {"status": "error", "message": "Фрагмент по времени нельзя выбрать в ленивом режиме плейлиста."}, 400
+    return iter_lazy_playlist(url, requested_formats, client_key), 200
+
+
+def wait_for_item_capacity(client_key, charge_token):
+    """
+    Для очередного элемента ленивого плейлиста ждёт токен клиента (если charge_token) и место в DOWNLOAD_ADMISSION.
+    Генератор: пока ждёт, отдаёт события waiting с оценкой паузы; после завершения место занято — его нужно освободить.
+    Сам он не спит: паузу выдерживает потребитель событий (stream_ndjson или asgi.iterate_lazy_events),
+    чтобы ожидание не занимало поток.
+    """
+    while charge_token:
+        allowed, retry_after = RATE_LIMITER.try_acquire(client_key)
+        if allowed:
+            break
+        yield {"type": "waiting", "reason": "rate_limit", "retry_after": retry_after}
+    while not DOWNLOAD_ADMISSION.try_enter():
+        yield {"type": "waiting", "reason": "busy", "retry_after": LAZY_PLAYLIST_ADMISSION_POLL_SECONDS}
+
+
+def iter_lazy_playlist(url, requested_formats, client_key):
+    """
+    Генератор событий ленивого режима: session, file, skipped, error, waiting и завершающее done.
+    Каждый элемент — отдельная загрузка: он списывает токен клиента (первый оплачен самим запросом),
+    занимает место в DOWNLOAD_ADMISSION только на время своей загрузки и слот DOWNLOAD_SCHEDULER.
+    Чтение плейлиста проходит те же проверки, что и fetch_content_info (отрицательный кеш, предохранитель источника);
+    оно и загрузки — задачи download_worker (в ASGI — в процессах пулов).
+    """
+    session_id = str(uuid.uuid4())
+    # Размер плейлиста заранее неизвестен, поэтому сессия всегда на диске
+    session_download_path = SESSION_STORAGE.allocate(session_id)
+    manifest = SessionManifest(session_id, session_download_path)
+    manifest.set_open(True)
+    logger.info(f"Ленивая загрузка плейлиста: URL='{url}', Формат='{', '.join(requested_formats)}', Сессия='{session_id}'")
+
+    if len(requested_formats) > 1:
+        base_opts = build_multi_format_download_opts(url, requested_formats, session_download_path)
+    else:
+        base_opts = build_download_opts(url, requested_formats[0], session_download_path, "%(title).60B [%(id)s].%(ext)s")
+    # Длительность элементов без неё в плоском списке проверяет сам yt-dlp перед загрузкой
+    base_opts['match_filter'] = DurationMatchFilter(DURATION_LIMIT_SECONDS)
+
+    files_count = 0
+    skipped_count = 0
+    # Токен, списанный при допуске запроса, оплачивает первый скачиваемый элемент
+    request_token_available = True
+    try:
+        yield {"type": "session", "session_id": session_id}
+        listing_opts = build_info_extractor_opts(url)
+        listing_opts.pop('playlist_items', None)
+        try:
+            with profile_phase('listing'):
+                listing = run_probe_job(url, True, download_worker.list_playlist_job, url, listing_opts, LAZY_PLAYLIST_MAX_ITEMS)
+        except ProviderUnavailableError as e:
+            logger.warning(str(e))
+            yield {"type": "error", "message": str(e), "retry_after": e.retry_after}
+            return
+        except ValueError as e:
+            logger.error(f"Не удалось прочитать плейлист '{url}': {e}")
+            yield {"type": "error", "message": str(e)}
+            return
+        playlist_context = listing["context"]
+        entries = listing["entries"]
+        listing = None
+
+        for index, entry in enumerate(entries, start=1):
+            # Уже обработанные элементы не держат память
+            entries[index - 1] = None
+            if not entry:
+                continue
+            entry_url = entry.get('webpage_url') or entry.get('original_url') or entry.get('url')
+            entry_title = entry.get('title') or entry.get('id')
+            if not entry_url:
+                skipped_count += 1
+                yield {"type": "skipped", "index": index, "title": entry_title, "message": "Элемент плейлиста без URL."}
+                continue
+            if (entry.get('duration') or 0) > DURATION_LIMIT_SECONDS:
+                skipped_count += 1
+                yield {"type": "skipped", "index": index, "title": entry_title, "message": f"Контент длиннее {DURATION_LIMIT_SECONDS/60} минут."}
+                continue
+
+            yield from wait_for_item_capacity(client_key, charge_token=not request_token_available)
+            request_token_available = False
+            produced_files = []
+            entry_opts = dict(base_opts, noplaylist=True, post_hooks=[produced_files.append])
+            entry_info = None
+            try:
+                with DOWNLOAD_SCHEDULER.slot(client_key, entry.get('duration')):
+                    entry_info = blocking_yt_dlp_download(entry_opts, entry_url)
+                files = []
+                if entry_info:
+                    for key in PLAYLIST_CONTEXT_KEYS:
+                        value = entry.get(key) or playlist_context.get(key)
+                        if value and not entry_info.get(key):
+                            entry_info[key] = value
+                    files = finalize_downloaded_entry(entry_info, manifest, requested_formats, set(produced_files))
+            except Exception as entry_error:
+                logger.warning(f"Не удалось скачать элемент плейлиста '{entry_url}': {entry_error}")
+                yield {"type": "error", "index": index, "url": entry_url, "message": str(entry_error)}
+                continue
+            finally:
+                DOWNLOAD_ADMISSION.leave()
+                # info_dict элемента больше не нужен
+                entry = entry_info = None
+
+            if not files:
+                skipped_count += 1
+                yield {"type": "skipped", "index": index, "url": entry_url, "title": entry_title, "message": "Элемент не скачан."}
+                continue
+            register_session_files(session_id, files)
+            files_count += len(files)
+            for file_info in files:
+                yield {"type": "file", "index": index, **file_info}
+
+        yield {"type": "done", "session_id": session_id, "files": files_count, "skipped": skipped_count}
+        logger.info(f"Ленивая загрузка {session_id} завершена: файлов {files_count}, пропущено {skipped_count}.")
+    finally:
+        # Выполняется и при обрыве соединения клиентом: сессия закрывается, пустая — удаляется
+        if manifest.set_open(False) == 0:
+            SESSION_STORAGE.discard(session_id)
+
+
+def ndjson_line(event):
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+def stream_ndjson(events):
+    """
+    Сериализует события в NDJSON: по одному JSON-объекту на строку.
+    После события waiting выдерживает его паузу перед следующим шагом генератора.
+    """
+    for event in events:
+        yield ndjson_line(event)
+        if event["type"] == 'waiting':
+            time.sleep(event["retry_after"])
+
+
+@app.route('/api/download_audio', methods=['POST'])
+@admission_controlled
+@profiled('download_audio')
+def download_audio_route():
+    """Обрабатывает запрос на загрузку аудио/видео."""
+    data = request.get_json()
+    if isinstance(data, dict) and data.get('lazy'):
+        result, status_code = process_lazy_playlist_request(data, get_client_key())
+        if status_code != 200:
+            return jsonify(result), status_code
+        return Response(stream_ndjson(result), mimetype='application/x-ndjson')
+
+    payload, status_code = process_download_request(data, get_client_key())
+    with profile_phase('json'):
+        return jsonify(payload), status_code, retry_after_headers(payload)
+
+
+def process_batch_request(data, client_key):
+    """
+    Обрабатывает пакет элементов {url, format} в одной сессии. Возвращает (тело ответа, HTTP-код).
+    Повторы одного контента скачиваются один раз, проверки идут параллельно,
+    загрузки — через общий DOWNLOAD_SCHEDULER. Результат возвращается по каждому элементу.
+    """
+    data = data if isinstance(data, dict) else {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return {"status": "error", "message": "Передайте непустой список items с элементами {url, format}."}, 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return {"status": "error", "message": f"Слишком много элементов в пакете (максимум {BATCH_MAX_ITEMS})."}, 400
+
+    results = [None] * len(items)
+    pending_items = []
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        url = item.get('url')
+        requested_format = str(item.get('format') or 'mp3').lower()
+        if not url or not isinstance(url, str) or not is_valid_url(url):
+            results[index] = {"url": url, "format": requested_format, "status": "error", "message": "Некорректный или отсутствующий URL."}
+            continue
+        if requested_format not in SUPPORTED_FORMATS:
+            results[index] = {"url": url, "format": requested_format, "status": "error", "message": "Неподдерживаемый формат. Выберите MP3, M4A, Opus или MP4."}
+            continue
+        pending_items.append((index, item['url'], normalize_supported_url(url), requested_format))
+
+    session_id = str(uuid.uuid4())
+    # Размер пакета заранее неизвестен, поэтому он всегда размещается на диске
+    session_download_path = SESSION_STORAGE.allocate(session_id)
+    manifest = SessionManifest(session_id, session_download_path)
+    logger.info(f"Пакетный запрос: {len(items)} элементов ({len(pending_items)} корректных), Сессия='{session_id}'")
+
+    # Проверка длительности: один раз на уникальный контент, параллельно
+    probe_urls = {}
+    for _, _, url, _ in pending_items:
+        probe_urls.setdefault(canonical_media_key(url), url)
+    probe_results = {}
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_PROBE_CONCURRENCY), thread_name_prefix='batch-probe') as probe_pool:
+        probe_futures = {key: probe_pool.submit(get_info_and_check_duration, url) for key, url in probe_urls.items()}
+        for key, future in probe_futures.items():
+            try:
+                probe_results[key] = future.result().get("info") or {}
+            except Exception as probe_error:
+                probe_results[key] = probe_error
+
+    # Задачи загрузки: одна на пару (канонический ID после проверки, формат)
+    jobs = {}
+    item_jobs = {}
+    for index, original_url, url, requested_format in pending_items:
+        probe_info = probe_results[canonical_media_key(url)]
+        if isinstance(probe_info, Exception):
+            results[index] = {"url": original_url, "format": requested_format, "status": "error", "message": str(probe_info)}
+            continue
+        job_key = (canonical_media_key(url, probe_info), requested_format)
+        jobs.setdefault(job_key, (url, requested_format, probe_info))
+        item_jobs[index] = job_key
+
+    def run_batch_job(url, requested_format, probe_info):
+        ydl_opts = build_download_opts(url, requested_format, session_download_path, "%(title).60B [%(id)s].%(ext)s")
+        produced_files = []
+        ydl_opts['post_hooks'] = [produced_files.append]
+        entries = download_entries(url, ydl_opts, client_key, probe_info)
+        if entries is None:
+            raise Exception("Не удалось загрузить или получить информацию о контенте.")
+        files = [file_info for entry in entries for file_info in finalize_downloaded_entry(entry, manifest, [requested_format], set(produced_files))]
+        if not files:
+            raise Exception("Не удалось скачать или найти файлы.")
+        return files
+
+    job_outcomes = {}
+    if jobs:
+        # Место в контроле нагрузки считается на каждую одновременную загрузку: одно уже занято самим запросом,
+        # остальные берутся, пока они свободны, и пакет идёт параллельно ровно настолько, сколько мест получено
+        extra_slots = 0
+        while extra_slots < min(BATCH_DOWNLOAD_CONCURRENCY, len(jobs)) - 1 and DOWNLOAD_ADMISSION.try_enter():
+            extra_slots += 1
+        try:
+            with ThreadPoolExecutor(max_workers=1 + extra_slots, thread_name_prefix='batch-download') as download_pool:
+                job_futures = {job_key: download_pool.submit(run_batch_job, *job) for job_key, job in jobs.items()}
+                for job_key, future in job_futures.items():
+                    try:
+                        job_outcomes[job_key] = {"status": "success", "files": future.result()}
+                    except Exception as job_error:
+                        logger.error(f"Ошибка пакетной загрузки '{jobs[job_key][0]}' ({job_key[1]}): {job_error}", exc_info=True)
+                        job_outcomes[job_key] = {"status": "error", "message": describe_download_error(job_error) if isinstance(job_error, yt_dlp.utils.DownloadError) else str(job_error)}
+        finally:
+            for _ in range(extra_slots):
+                DOWNLOAD_ADMISSION.leave()
+
+    all_files = []
+    served_jobs = set()
+    for index, original_url, _, requested_format in pending_items:
+        if results[index] is not None:
+            continue
+        job_key = item_jobs[index]
+        outcome = job_outcomes[job_key]
+        if outcome["status"] == "success":
+            if job_key in served_jobs:
+                # Повтор скачан один раз, но получает свои файлы: у каждого элемента своя одноразовая ссылка
+                try:
+                    outcome = {"status": "success", "files": [clone_session_file(manifest, file_info) for file_info in outcome["files"]]}
+                except OSError as clone_error:
+                    logger.error(f"Не удалось подготовить файл для повторного элемента '{original_url}': {clone_error}")
+                    outcome = {"status": "error", "message": "Не удалось подготовить файл для повторного элемента."}
+            served_jobs.add(job_key)
+            all_files.extend(outcome.get("files", []))
+        results[index] = {"url": original_url, "format": requested_format, **outcome}
+    if not all_files:
+        SESSION_STORAGE.discard(session_id)
+        return {"status": "error", "message": "Ни один элемент пакета не был скачан.", "results": results}, 500
+
+    settle_session(session_id, manifest)
+    register_session_files(session_id, all_files)
+    logger.info(f"Пакет {session_id}: скачано {len(all_files)} файлов, уникальных задач {len(jobs)} из {len(items)} элементов.")
+    return {"status": "success", "session_id": session_id, "results": results}, 200
+
+
+@app.route('/api/download_batch', methods=['POST'])
+@admission_controlled(cost=batch_request_cost, limit='batch')
+def download_batch_route():
+    """Обрабатывает пакетный запрос на загрузку нескольких URL."""
+    payload, status_code = process_batch_request(request.get_json(silent=True), get_client_key())
+    return jsonify(payload), status_code
+
+
+def resolve_session_file(session_id, filename):
+    """Возвращает путь к файлу сессии на этом узле по манифесту или None, если файл в нём не записан или уже удалён."""
+    manifest = SessionManifest.load(session_id)
+    file_entry = manifest.get(filename) if manifest else None
+    if not file_entry:
+        return None
+    file_path = file_entry.get("path")
+    if not file_path or not any(file_path.startswith(root + os.sep) for root in SESSION_STORAGE.roots()) or not os.path.isfile(file_path):
+        return None
+    return file_path
+
+
+def cleanup_served_file(session_id, filename, file_path):
+    """Удаляет отданный файл и убирает его из манифеста; сессия без файлов удаляется целиком."""
+    forget_session_file(session_id, filename)
+    try:
+        os.remove(file_path)
+        logger.info(f"Файл удален: {file_path}")
+        manifest = SessionManifest.load(session_id)
+        if manifest is None or (manifest.remove_file(filename) == 0 and not manifest.data.get("open")):
+            SESSION_STORAGE.discard(session_id)
+            logger.info(f"Папка сессии {session_id} удалена: все файлы отданы.")
+    except Exception as e_cleanup:
+        logger.error(f"Ошибка при удалении файла или папки сессии {session_id}: {e_cleanup}", exc_info=True)
 
 
 @app.route('/serve_file/<session_id>/<path:filename>')
 def serve_file(session_id, filename):
-    directory = os.path.join(USER_DOWNLOADS_DIR, session_id)
-    file_path = os.path.join(directory, filename)
-    logger.info(f"Запрос на отдачу файла: {filename} из директории {directory}")
-
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
-        logger.error(f"Файл не найден по пути: {file_path}")
+    logger.info(f"Запрос на отдачу файла: {filename} из сессии {session_id}")
+
+    file_path = resolve_session_file(session_id, filename)
+    if not file_path:
+        forwarded_response = forward_to_owner_node(session_id, filename)
+        if forwarded_response is not None:
+            return forwarded_response
+        logger.error(f"Файл не найден: {filename} (сессия {session_id})")
         return jsonify({"status": "error", "message": "Файл не найден или был удален."}), 404
 
     @after_this_request
     def cleanup(response):
-        try:
-            os.remove(file_path)
-            logger.info(f"Файл удален: {file_path}")
-            if os.path.exists(directory) and not os.listdir(directory):
-                os.rmdir(directory)
-                logger.info(f"Пустая папка сессии удалена: {directory}")
-        except Exception as e_cleanup:
-            logger.error(f"Ошибка при удалении файла или папки сессии '{directory}': {e_cleanup}", exc_info=True)
+        cleanup_served_file(session_id, filename, file_path)
         return response
 
-    return send_from_directory(directory, filename, as_attachment=True)
+    return send_file(file_path, as_attachment=True)
 
-@app.route('/api/search', methods=['POST'])
-def search_content_route():
-    data = request.get_json()
+
+# --- Предзагрузка результатов поиска ---
+class SearchPrefetcher:
+    """
+    После поиска в фоне получает полные метаданные и обложку первых результатов, чтобы клик по ним
+    не начинался с холодного извлечения. Пул ограничен, новый поиск клиента отменяет его ещё не начатые задачи,
+    результаты живут ttl_seconds. Хранилище своё у каждого процесса.
+    Предзагрузка — необязательная работа: очередь ограничена workers * top_n задачами на процесс, каждая задача
+    занимает место в DOWNLOAD_ADMISSION и пропускается, если свободных мест не больше workers,
+    а предохранители источников она не меняет.
+    """
+
+    def __init__(self, top_n, workers, ttl_seconds, max_entries):
+        self.top_n = top_n
+        self.workers = workers
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._executor = None
+        self._entries = OrderedDict()
+        self._in_flight = set()
+        self._pending = {}
+        # RLock: колбэк уже завершённой задачи вызывается сразу, ещё под блокировкой schedule()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry["info"]
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _put(self, key, info):
+        with self._lock:
+            self._entries[key] = {"info": info, "expires_at": time.monotonic() + self.ttl_seconds}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def schedule(self, client_key, urls):
+        """Ставит в очередь предзагрузку первых top_n ссылок и отменяет прежние неначатые задачи клиента."""
+        if self.top_n <= 0 or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            for future in self._pending.pop(client_key, []):
+                future.cancel()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='search-prefetch')
+            futures = []
+            for url in urls[:self.top_n]:
+                key = canonical_media_key(url)
+                # get() заодно удаляет истёкшую запись, чтобы её можно было загрузить заново
+                if key in self._in_flight or self.get(key) is not None:
+                    continue
+                if len(self._in_flight) >= max(1, self.workers) * self.top_n:
+                    logger.debug("Очередь предзагрузки заполнена, оставшиеся результаты поиска пропущены.")
+                    break
+                self._in_flight.add(key)
+                future = self._executor.submit(self._prefetch, key, url)
+                future.add_done_callback(lambda _, done_key=key: self._finish(done_key))
+                futures.append(future)
+            self._pending = {pending_key: [future for future in pending if not future.done()] for pending_key, pending in self._pending.items()}
+            self._pending = {pending_key: pending for pending_key, pending in self._pending.items() if pending}
+            if futures:
+                self._pending[client_key] = futures
+
+    def _finish(self, key):
+        with self._lock:
+            self._in_flight.discard(key)
+
+    def _prefetch(self, key, url):
+        # Места берутся только из запаса: workers мест остаются настоящим загрузкам даже при занятом пуле предзагрузки
+        if DOWNLOAD_ADMISSION.capacity()["remaining"] <= self.workers or not DOWNLOAD_ADMISSION.try_enter():
+            logger.debug(f"Предзагрузка '{url}' пропущена: сервер занят загрузками.")
+            return
+        try:
+            try:
+                info = fetch_content_info(url, record_outcome=False)
+            except Exception as prefetch_error:
+                logger.debug(f"Предзагрузка '{url}' не удалась: {prefetch_error}")
+                return
+            if not info or info.get('_type') == 'playlist':
+                return
+            # Обложка обрабатывается и попадает в COVER_CACHE — при загрузке она берётся оттуда
+            track_name, artist_name = extract_track_metadata(info)
+            build_track_metadata(info, track_name, artist_name)
+            self._put(key, info)
+            logger.debug(f"Предзагружены метаданные: {url}")
+        finally:
+            DOWNLOAD_ADMISSION.leave()
+
+
+SEARCH_PREFETCHER = SearchPrefetcher(SEARCH_PREFETCH_TOP_N, SEARCH_PREFETCH_WORKERS, SEARCH_PREFETCH_TTL_SECONDS, SEARCH_PREFETCH_MAX_ENTRIES)
+
+
+def run_search_provider(source, search_query, search_opts):
+    """
+    Выполняет поиск у одного источника через его предохранитель. Возвращает записи с URL;
+    при ошибке или разомкнутом предохранителе — пустой список, чтобы остальные источники не ждали.
+    """
+    try:
+        breaker = acquire_circuit_breaker(f"search:{source}")
+    except ProviderUnavailableError as e:
+        logger.warning(f"Поиск на {source} пропущен: {e}")
+        return []
+    try:
+        with profile_phase(source):
+            search_info = run_job('probe', download_worker.extract_info_job, search_query, search_opts)
+    except Exception as e:
+        if classify_download_error(e) in PROVIDER_FAILURE_ERROR_CLASSES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        logger.error(f"Ошибка при поиске на {source}: {e}")
+        return []
+    breaker.record_success()
+    return [entry for entry in (search_info or {}).get('entries') or [] if entry and entry.get('url')]
+
+
+def perform_search(data, client_key=None):
+    """
+    Ищет контент на YouTube, YouTube Music, SoundCloud и TikTok. Возвращает (тело ответа, HTTP-код).
+    Если известен клиент, первые результаты предзагружаются в фоне через SEARCH_PREFETCHER.
+    """
+    data = data or {}
     query = data.get('query')
 
     if not query:
-        return jsonify({"status": "error", "message": "Поисковый запрос не указан."}), 400
+        return {"status": "error", "message": "Поисковый запрос не указан."}, 400
 
     search_results = []
     search_opts = {
@@ -986,79 +3387,74 @@ def search_content_route():
         'dump_single_json': True, 
     }
 
-    try:
-        with yt_dlp.YoutubeDL(search_opts) as ydl:
-            yt_info = ydl.extract_info(f"ytsearch{SEARCH_RESULTS_LIMIT}:{query}", download=False)
-            if yt_info and 'entries' in yt_info:
-                for entry in yt_info['entries']:
-                    if entry and entry.get('url'):
-                        search_results.append({
-                            "source": "YouTube",
-                            "title": entry.get('title', 'Без названия'),
-                            "url": entry.get('webpage_url'),
-                            "duration": entry.get('duration'),
-                            "thumbnail": entry.get('thumbnail'),
-                            "uploader": entry.get('uploader'),
-                            "id": entry.get('id')
-                        })
-    except Exception as e:
-        logger.error(f"Ошибка при поиске на YouTube: {e}")
-    try:
-        with yt_dlp.YoutubeDL(search_opts) as ydl:
-            ytm_info = ydl.extract_info(f"ytmusicsearch{SEARCH_RESULTS_LIMIT}:{query}", download=False)
-            if ytm_info and 'entries' in ytm_info:
-                for entry in ytm_info['entries']:
-                    if entry and entry.get('url'):
-                        search_results.append({
-                            "source": "YouTube Music",
-                            "title": entry.get('title', 'Без названия'),
-                            "url": entry.get('webpage_url') or entry.get('url'),
-                            "duration": entry.get('duration'),
-                            "thumbnail": entry.get('thumbnail'),
-                            "uploader": entry.get('uploader') or entry.get('artist'),
-                            "id": entry.get('id')
-                        })
-    except Exception as e:
-        logger.error(f"Ошибка при поиске на YouTube Music: {e}")
+    for entry in run_search_provider("YouTube", f"ytsearch{SEARCH_RESULTS_LIMIT}:{query}", search_opts):
+        search_results.append({
+            "source": "YouTube",
+            "title": entry.get('title', 'Без названия'),
+            "url": entry.get('webpage_url'),
+            "duration": entry.get('duration'),
+            "thumbnail": entry.get('thumbnail'),
+            "uploader": entry.get('uploader'),
+            "id": entry.get('id')
+        })
+
+    for entry in run_search_provider("YouTube Music", f"ytmusicsearch{SEARCH_RESULTS_LIMIT}:{query}", search_opts):
+        search_results.append({
+            "source": "YouTube Music",
+            "title": entry.get('title', 'Без названия'),
+            "url": entry.get('webpage_url') or entry.get('url'),
+            "duration": entry.get('duration'),
+            "thumbnail": entry.get('thumbnail'),
+            "uploader": entry.get('uploader') or entry.get('artist'),
+            "id": entry.get('id')
+        })
+
+    for entry in run_search_provider("SoundCloud", f"scsearch{SEARCH_RESULTS_LIMIT}:{query}", search_opts):
+        search_results.append({
+            "source": "SoundCloud",
+            "title": entry.get('title', 'Без названия'),
+            "url": entry.get('webpage_url'),
+            "duration": entry.get('duration'),
+            "thumbnail": entry.get('thumbnail'),
+            "uploader": entry.get('uploader'),
+            "id": entry.get('id')
+        })
+
+    for entry in run_search_provider("TikTok", f"tiktoksearch5:{query}", search_opts):
+        search_results.append({
+            "source": "TikTok",
+            "title": entry.get('title', 'Без названия'),
+            "url": entry.get('webpage_url'),
+            "duration": entry.get('duration'),
+            "thumbnail": entry.get('thumbnail'),
+            "uploader": entry.get('uploader'),
+            "id": entry.get('id')
+        })
+
+    if client_key:
+        SEARCH_PREFETCHER.schedule(client_key, [result["url"] for result in search_results if result.get("url")])
+    return {"status": "success", "results": search_results}, 200
+
+
+@app.route('/api/search', methods=['POST'])
+@profiled('search')
+def search_content_route():
+    payload, status_code = perform_search(request.get_json(), get_client_key())
+    with profile_phase('json'):
+        return jsonify(payload), status_code
 
-    try:
-        with yt_dlp.YoutubeDL(search_opts) as ydl:
-            sc_info = ydl.extract_info(f"scsearch{SEARCH_RESULTS_LIMIT}:{query}", download=False)
-            if sc_info and 'entries' in sc_info:
-                for entry in sc_info['entries']:
-                    if entry and entry.get('url'):
-                        search_results.append({
-                            "source": "SoundCloud",
-                            "title": entry.get('title', 'Без названия'),
-                            "url": entry.get('webpage_url'),
-                            "duration": entry.get('duration'),
-                            "thumbnail": entry.get('thumbnail'),
-                            "uploader": entry.get('uploader'),
-                            "id": entry.get('id')
-                        })
-    except Exception as e:
-        logger.error(f"Ошибка при поиске на SoundCloud: {e}")
-    
-    try:
-        with yt_dlp.YoutubeDL(search_opts) as ydl:
-            tiktok_info = ydl.extract_info(f"tiktoksearch5:{query}", download=False)
-            if tiktok_info and 'entries' in tiktok_info:
-                for entry in tiktok_info['entries']:
-                    if entry and entry.get('url'):
-                        search_results.append({
-                            "source": "TikTok",
-                            "title": entry.get('title', 'Без названия'),
-                            "url": entry.get('webpage_url'),
-                            "duration": entry.get('duration'),
-                            "thumbnail": entry.get('thumbnail'),
-                            "uploader": entry.get('uploader'),
-                            "id": entry.get('id')
-                        })
-    except Exception as e:
-        logger.error(f"Ошибка при поиске на TikTok: {e}")
 
-    return jsonify({"status": "success", "results": search_results})
+def build_assets_command():
+    """Собирает статику с хешами и сжатием; запускается при сборке образа, а не при старте воркеров."""
+    assets = build_static_assets()
+    logger.info(f"Собрано статических ресурсов: {len(assets)} в {ASSET_BUILD_DIR} (brotli: {'да' if BROTLI_AVAILABLE else 'нет'}).")
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['build-assets']:
+        build_assets_command()
+        sys.exit(0)
+    # Локальный запуск: статика собирается перед стартом, чтобы правки в static/ сразу получали новые хеши
+    if STATIC_FINGERPRINT_ENABLED and os.path.isdir(STATIC_DIR):
+        build_static_assets()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
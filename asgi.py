@@ -0,0 +1,251 @@
+"""
+ASGI-режим Music Jacker: те же /api/download_audio, /api/download_batch, /api/search и /serve_file,
+но поток не блокируется на всё время загрузки. Разбор запроса, очередь DOWNLOAD_SCHEDULER, контроль нагрузки
+и предохранители работают в потоках этого процесса (свой пул ASGI_HANDLER_THREADS), как во Flask;
+отдельные задачи yt-dlp (загрузка, проверка, поиск) и завершение готовых файлов (теги, контрольная сумма,
+превью обложки) уходят в процессы пулов download_worker. Лимит ffmpeg общий для всех процессов,
+поэтому контроль нагрузки видит очередь транскодирования целиком.
+
+Запуск: uvicorn asgi:app --host 0.0.0.0 --port 8080 --proxy-headers
+Остальные маршруты (главная страница, статика, /healthz) обслуживает Flask-приложение через WSGI-адаптер.
+"""
+import contextlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import anyio
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import app as web
+import download_worker
+
+# Процессы для проверок контента и поиска; загрузок одновременно не больше DOWNLOAD_WORKER_SLOTS, столько же и процессов
+ASGI_PROBE_PROCESSES = int(os.getenv('ASGI_PROBE_PROCESSES', '2'))
+# Процессы для тегов, контрольных сумм и превью обложек готовых файлов
+ASGI_TAG_PROCESSES = int(os.getenv('ASGI_TAG_PROCESSES', '2'))
+# Потоки для блокирующих обработчиков app (загрузки, пакеты, поиск, шаги ленивого режима).
+# Отдельно от общего лимитера anyio, на котором работают FileResponse и WSGI-адаптер: занятые обработчики
+# не задерживают отдачу файлов.
+ASGI_HANDLER_THREADS = int(os.getenv('ASGI_HANDLER_THREADS', '16'))
+
+flask_wsgi = WSGIMiddleware(web.app)
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+_handler_limiter = None
+_STREAM_END = object()
+
+
+def start_worker_pools():
+    """
+    Создаёт пулы процессов (spawn — без унаследованных потоков и блокировок) и подключает их к app.run_job.
+    Процессы получают настройки через initializer, а лимит ffmpeg — общий семафор со счётчиками,
+    к которому подключается и TRANSCODE_SCHEDULER этого процесса.
+    """
+    with _worker_pools_lock:
+        if _worker_pools:
+            return
+        mp_context = multiprocessing.get_context('spawn')
+        config = {
+            "log_level": web.LOG_LEVEL,
+            "transcode": web.TRANSCODE_SCHEDULER.share_across_processes(mp_context),
+        }
+        sizes = {'download': web.DOWNLOAD_WORKER_SLOTS, 'probe': ASGI_PROBE_PROCESSES, 'tag': ASGI_TAG_PROCESSES}
+        for kind, size in sizes.items():
+            _worker_pools[kind] = ProcessPoolExecutor(
+                max_workers=max(1, size),
+                mp_context=mp_context,
+                initializer=download_worker.init_worker,
+                initargs=(config,),
+            )
+        web.set_job_executors(**_worker_pools)
+
+
+def stop_worker_pools():
+    with _worker_pools_lock:
+        web.set_job_executors(**{kind: None for kind in _worker_pools})
+        for pool in _worker_pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _worker_pools.clear()
+
+
+def handler_limiter():
+    """Лимитер потоков обработчиков; создаётся при первом вызове внутри цикла событий."""
+    global _handler_limiter
+    if _handler_limiter is None:
+        _handler_limiter = anyio.CapacityLimiter(max(1, ASGI_HANDLER_THREADS))
+    return _handler_limiter
+
+
+async def run_blocking(func, *args):
+    """Выполняет блокирующую функцию app в потоке из ASGI_HANDLER_THREADS."""
+    return await anyio.to_thread.run_sync(func, *args, limiter=handler_limiter())
+
+
+def get_client_key(request):
+    return web.client_key_from(request.headers.get('X-API-Key'), request.client.host if request.client else None)
+
+
+def reject_request(status_code, message, retry_after):
+    return JSONResponse(
+        {"status": "error", "message": message, "retry_after": retry_after},
+        status_code=status_code,
+        headers={'Retry-After': str(retry_after)},
+    )
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return {}
+
+
+async def run_admitted(request, handler, cost=1, limit=None):
+    """Тот же контроль нагрузки, что и admission_controlled во Flask: 429 при превышении лимита, 503 при перегрузке."""
+    client_key = get_client_key(request)
+    limiter = web.rate_limiter_for(limit)
+    allowed, retry_after = limiter.try_acquire(client_key, cost)
+    if not allowed and retry_after is None:
+        return JSONResponse({"status": "error", "message": web.oversized_request_message(limiter)}, status_code=400)
+    if not allowed:
+        web.logger.warning(f"Превышен лимит запросов для клиента {client_key}.")
+        return reject_request(429, "Слишком много запросов. Попробуйте повторить запрос позже.", retry_after)
+    if not web.DOWNLOAD_ADMISSION.try_enter():
+        web.logger.warning("Запрос на загрузку отклонён: сервер перегружен.")
+        return reject_request(503, "Сервер перегружен. Попробуйте повторить запрос позже.", web.ADMISSION_RETRY_AFTER_SECONDS)
+    # Потоковый ответ (ленивый плейлист) освобождает место сразу: дальше каждый элемент сам занимает место и токен
+    try:
+        return await handler(client_key)
+    finally:
+        web.DOWNLOAD_ADMISSION.leave()
+
+
+async def run_request(request, route_name, func, *args):
+    """
+    Выполняет обработчик app в потоке этого процесса; задачи yt-dlp внутри него уходят в пулы процессов.
+    Как и @profiled во Flask, при включённом профилировании снимает профиль и возвращает его имя в заголовках.
+    Возвращает (тело ответа, HTTP-код, заголовки).
+    """
+    if not web.profiling_requested(request.headers):
+        payload, status_code = await run_blocking(func, *args)
+        return payload, status_code, {}
+    (payload, status_code), profile_name = await run_blocking(web.call_profiled, route_name, func, *args)
+    return payload, status_code, {'X-Profile-Id': profile_name} if profile_name else {}
+
+
+async def iterate_lazy_events(events):
+    """
+    Отдаёт события ленивого режима строками NDJSON. Каждый шаг генератора выполняется в потоке из ASGI_HANDLER_THREADS,
+    паузы событий waiting выдерживаются асинхронно, без занятого потока.
+    При обрыве соединения генератор закрывается, освобождая место загрузки и сессию.
+    """
+    try:
+        while True:
+            event = await run_blocking(next, events, _STREAM_END)
+            if event is _STREAM_END:
+                return
+            yield web.ndjson_line(event)
+            if event["type"] == 'waiting':
+                await anyio.sleep(event["retry_after"])
+    finally:
+        with anyio.CancelScope(shield=True):
+            await run_blocking(events.close)
+
+
+async def stream_lazy_playlist(request, data, client_key):
+    """
+    Ленивый режим отдаёт события по мере загрузки: шаги генератора выполняются в потоках этого процесса,
+    задачи yt-dlp каждого элемента — в процессах пулов. Профиль охватывает весь поток и завершается при его закрытии.
+    """
+    result, status_code = await run_blocking(web.process_lazy_playlist_request, data, client_key)
+    if status_code != 200:
+        return JSONResponse(result, status_code=status_code)
+    if not web.profiling_requested(request.headers):
+        return StreamingResponse(iterate_lazy_events(result), media_type='application/x-ndjson')
+    # Сэмплирование начнётся с первого шага генератора, в том потоке, где он выполняется
+    profile = web.start_profile('download_audio')
+    profile.detach()
+    return StreamingResponse(
+        iterate_lazy_events(profile.stream(result)),
+        media_type='application/x-ndjson',
+        headers={'X-Profile-Id': profile.profile_name},
+        background=BackgroundTask(run_blocking, profile.finish),
+    )
+
+
+async def download_audio(request):
+    data = await read_json(request)
+
+    async def handle(client_key):
+        if isinstance(data, dict) and data.get('lazy'):
+            return await stream_lazy_playlist(request, data, client_key)
+        payload, status_code, headers = await run_request(request, 'download_audio', web.process_download_request, data, client_key)
+        return JSONResponse(payload, status_code=status_code, headers={**web.retry_after_headers(payload), **headers})
+
+    return await run_admitted(request, handle)
+
+
+async def download_batch(request):
+    data = await read_json(request)
+
+    async def handle(client_key):
+        payload, status_code = await run_blocking(web.process_batch_request, data, client_key)
+        return JSONResponse(payload, status_code=status_code)
+
+    return await run_admitted(request, handle, web.batch_request_cost(data), limit='batch')
+
+
+async def search(request):
+    payload, status_code, headers = await run_request(request, 'search', web.perform_search, await read_json(request), get_client_key(request))
+    return JSONResponse(payload, status_code=status_code, headers=headers)
+
+
+class ServeFileEndpoint:
+    """Отдаёт файл сессии асинхронно; если файла на узле нет, запрос передаётся Flask (пересылка на узел-владелец или 404)."""
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        session_id = request.path_params['session_id']
+        filename = request.path_params['filename']
+        file_path = web.resolve_session_file(session_id, filename)
+        if not file_path:
+            await flask_wsgi(scope, receive, send)
+            return
+
+        web.logger.info(f"Запрос на отдачу файла: {filename} из сессии {session_id}")
+        response = FileResponse(
+            file_path,
+            filename=os.path.basename(filename),
+            background=BackgroundTask(web.cleanup_served_file, session_id, filename, file_path),
+        )
+        await response(scope, receive, send)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    start_worker_pools()
+    yield
+    stop_worker_pools()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/download_audio', download_audio, methods=['POST']),
+        Route('/api/download_batch', download_batch, methods=['POST']),
+        Route('/api/search', search, methods=['POST']),
+        Route('/serve_file/{session_id}/{filename:path}', ServeFileEndpoint()),
+        Mount('/', app=flask_wsgi),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,155 @@
+"""
+Локальный стенд для сравнения профилей загрузки yt-dlp без обращения к внешним сервисам.
+
+Поднимает HTTP-сервер с искусственным ограничением скорости на каждое соединение (как у YouTube):
+- /media.mp3 — обычный файл с поддержкой Range (на нём проверяется http_chunk_size);
+- /playlist.m3u8 — HLS из множества фрагментов (на нём проверяется concurrent_fragment_downloads).
+Затем скачивает оба ресурса с каждой комбинацией настроек и печатает достигнутую скорость.
+
+Пример: python bench_downloads.py --size-mb 32 --rate-kb 2048 --fragments 1,4,8 --chunks-mb 0,4,16
+Профиль из app.DOWNLOAD_PROFILES: python bench_downloads.py --profile youtube
+"""
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yt_dlp
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+WRITE_BLOCK_BYTES = 64 * 1024
+MEGABYTE = 1024 * 1024
+
+
+def make_fixture_handler(media, fragments, rate_bytes_per_second):
+    """Создаёт обработчик запросов с заданными данными и ограничением скорости на соединение."""
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send_throttled(self, payload):
+            started = time.monotonic()
+            sent = 0
+            for offset in range(0, len(payload), WRITE_BLOCK_BYTES):
+                block = payload[offset:offset + WRITE_BLOCK_BYTES]
+                self.wfile.write(block)
+                sent += len(block)
+                if rate_bytes_per_second:
+                    delay = sent / rate_bytes_per_second - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+        def _send_body(self, body, content_type):
+            status = 200
+            start, end = 0, len(body) - 1
+            range_match = RANGE_PATTERN.fullmatch(self.headers.get('Range', ''))
+            if range_match:
+                start = int(range_match.group(1) or 0)
+                end = min(int(range_match.group(2)) if range_match.group(2) else end, len(body) - 1)
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range', f"bytes {start}-{end}/{len(body)}")
+            self.end_headers()
+            if self.command != 'HEAD':
+                self._send_throttled(body[start:end + 1])
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            if self.path == '/media.mp3':
+                self._send_body(media, 'audio/mpeg')
+            elif self.path == '/playlist.m3u8':
+                lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:10', '#EXT-X-MEDIA-SEQUENCE:0']
+                for index in range(len(fragments)):
+                    lines += ['#EXTINF:10.0,', f"/fragment{index}.ts"]
+                lines.append('#EXT-X-ENDLIST')
+                self._send_body(('\n'.join(lines) + '\n').encode(), 'application/vnd.apple.mpegurl')
+            elif self.path.startswith('/fragment') and self.path.endswith('.ts'):
+                index = int(self.path[len('/fragment'):-len('.ts')])
+                self._send_body(fragments[index], 'video/mp2t')
+            else:
+                self.send_error(404)
+
+    return FixtureHandler
+
+
+def start_fixture_server(size_bytes, fragment_count, rate_bytes_per_second):
+    media = os.urandom(size_bytes)
+    fragment_size = max(1, size_bytes // fragment_count)
+    fragments = [media[offset:offset + fragment_size] for offset in range(0, size_bytes, fragment_size)]
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_fixture_handler(media, fragments, rate_bytes_per_second))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_download(url, options, work_dir):
+    """Скачивает url с опциями yt-dlp и возвращает (байт, секунд)."""
+    output_dir = tempfile.mkdtemp(dir=work_dir)
+    ydl_opts = {
+        'outtmpl': os.path.join(output_dir, '%(id)s.%(ext)s'),
+        'quiet': True,
+        'no_warnings': True,
+        'fixup': 'never',
+        'noprogress': True,
+        **options,
+    }
+    started = time.monotonic()
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl.download([url])
+    elapsed = time.monotonic() - started
+    downloaded = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir))
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return downloaded, elapsed
+
+
+def parse_int_list(raw):
+    return [int(value) for value in raw.split(',') if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение профилей загрузки yt-dlp на локальном стенде.")
+    parser.add_argument('--size-mb', type=int, default=32, help="размер тестового файла, МБ")
+    parser.add_argument('--rate-kb', type=int, default=2048, help="ограничение скорости на соединение, КБ/с (0 — без ограничения)")
+    parser.add_argument('--fragment-count', type=int, default=64, help="число фрагментов HLS")
+    parser.add_argument('--fragments', default='1,2,4,8', help="значения concurrent_fragment_downloads через запятую")
+    parser.add_argument('--chunks-mb', default='0,1,4,16', help="значения http_chunk_size в МБ через запятую (0 — без деления)")
+    parser.add_argument('--profile', help="вместо перебора проверить профиль из app.DOWNLOAD_PROFILES (youtube, soundcloud, tiktok, default)")
+    args = parser.parse_args()
+
+    server = start_fixture_server(args.size_mb * MEGABYTE, args.fragment_count, args.rate_kb * 1024)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    work_dir = tempfile.mkdtemp(prefix='bench-downloads-')
+
+    if args.profile:
+        from app import DOWNLOAD_PROFILES
+        profile = {key: value for key, value in DOWNLOAD_PROFILES[args.profile].items() if value is not None}
+        cases = [('media.mp3', profile), ('playlist.m3u8', profile)]
+    else:
+        cases = [('media.mp3', {'http_chunk_size': chunk * MEGABYTE} if chunk else {}) for chunk in parse_int_list(args.chunks_mb)]
+        cases += [('playlist.m3u8', {'concurrent_fragment_downloads': fragments}) for fragments in parse_int_list(args.fragments)]
+
+    print(f"Стенд {base_url}: {args.size_mb} МБ, ограничение {args.rate_kb or '∞'} КБ/с на соединение")
+    try:
+        for resource, options in cases:
+            downloaded, elapsed = run_download(f"{base_url}/{resource}", options, work_dir)
+            print(f"{resource:<14} {str(options):<60} {downloaded / MEGABYTE:7.1f} МБ {elapsed:7.2f} с {downloaded / MEGABYTE / elapsed:8.2f} МБ/с")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
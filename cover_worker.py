@@ -0,0 +1,45 @@
+"""
+Обработка обложек в процессах пула app.get_cover_pool().
+Модуль намеренно лёгкий: процессы пула запускаются через spawn и импортируют только его,
+а не app с его сборкой состояния, SQLite и фоновыми потоками.
+"""
+import imghdr
+import io
+import logging
+
+try:
+    from PIL import Image, ImageOps
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def process_cover_image(data, mime=None, size=600, jpeg_quality=88):
+    """
+    Обрезает обложку до квадрата по центру, уменьшает до size и перекодирует в JPEG.
+    Возвращает {"data", "mime", "width", "height"}; без Pillow или при ошибке — исходное изображение.
+    """
+    width = height = 0
+    if PILLOW_AVAILABLE:
+        try:
+            with Image.open(io.BytesIO(data)) as source_image:
+                image = ImageOps.exif_transpose(source_image)
+                side = min(min(image.size), size)
+                resample = getattr(Image, 'Resampling', Image).LANCZOS
+                image = ImageOps.fit(image, (side, side), method=resample, centering=(0.5, 0.5))
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=jpeg_quality, optimize=True)
+                data, mime = buffer.getvalue(), 'image/jpeg'
+                width = height = side
+        except Exception as image_error:
+            logger.warning(f"Не удалось обработать обложку, используется исходное изображение: {image_error}")
+
+    if not mime:
+        detected = imghdr.what(None, h=data)
+        mime = f"image/{detected.lower()}" if detected else 'image/jpeg'
+
+    return {"data": data, "mime": mime, "width": width, "height": height}
@@ -0,0 +1,420 @@
+"""
+Задачи yt-dlp, ffmpeg и тегов готовых файлов, которые app выполняет либо в своём потоке (Flask),
+либо в процессах пула (ASGI, см. asgi.py).
+Модуль намеренно лёгкий: процессы пула запускаются через spawn и импортируют только его, а не app.
+Очереди, справедливое распределение слотов, контроль нагрузки и предохранители остаются в app:
+сюда приходит уже допущенная задача, результат возвращается в виде, пригодном для передачи между процессами.
+"""
+import base64
+import hashlib
+import itertools
+import logging
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yt_dlp
+from yt_dlp.postprocessor import FFmpegPostProcessor, get_postprocessor
+
+try:
+    from mutagen.easyid3 import EasyID3
+    try:
+        EasyID3.RegisterTextKey('comment', 'COMM')
+    except Exception:
+        pass
+    from mutagen.id3 import ID3NoHeaderError, APIC
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4, MP4Cover
+    from mutagen.oggopus import OggOpus
+    from mutagen.flac import Picture
+    MUTAGEN_AVAILABLE = True
+except ImportError:
+    MUTAGEN_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+CPU_COUNT = os.cpu_count() or 1
+
+
+# --- Планировщик транскодирования ---
+class TranscodeScheduler:
+    """
+    Ограничивает число одновременных процессов ffmpeg и ставит лишние задачи в очередь.
+    После share_across_processes() лимит и счётчики общие для всех процессов, получивших shared_state().
+    """
+
+    def __init__(self, max_jobs, threads_per_job=0, nice_level=0, shared=None):
+        self.max_jobs = max(1, max_jobs)
+        self.threads_per_job = threads_per_job if threads_per_job > 0 else max(1, CPU_COUNT // self.max_jobs)
+        self.nice_level = nice_level
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._shared = shared
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_jobs,
+            thread_name_prefix='ffmpeg-worker',
+            initializer=self._init_worker_thread,
+        )
+
+    def share_across_processes(self, mp_context):
+        """Переводит лимит и счётчики в разделяемую память, чтобы процессы пула и этот процесс делили одни и те же места."""
+        self._shared = {
+            "slots": mp_context.BoundedSemaphore(self.max_jobs),
+            "active": mp_context.Value('i', 0),
+            "queued": mp_context.Value('i', 0),
+        }
+        return self.shared_state()
+
+    def shared_state(self):
+        """Параметры для TranscodeScheduler в процессе пула (передаются через initializer)."""
+        return {"max_jobs": self.max_jobs, "threads_per_job": self.threads_per_job, "nice_level": self.nice_level, "shared": self._shared}
+
+    def _init_worker_thread(self):
+        """Понижает приоритет рабочего потока: в Linux nice задаётся на поток и наследуется запущенным ffmpeg."""
+        if self.nice_level <= 0 or not sys.platform.startswith('linux'):
+            return
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice_level)
+        except OSError as nice_error:
+            logger.warning(f"Не удалось установить nice={self.nice_level} для потока транскодирования: {nice_error}")
+
+    def _add(self, counter, delta):
+        """Меняет счётчик active/queued и возвращает новые значения (queued, active)."""
+        if self._shared is None:
+            with self._lock:
+                setattr(self, f"_{counter}", getattr(self, f"_{counter}") + delta)
+                return self._queued, self._active
+        with self._shared[counter].get_lock():
+            self._shared[counter].value += delta
+        return self._shared["queued"].value, self._shared["active"].value
+
+    def _run_job(self, func, args, kwargs):
+        if self._shared is not None:
+            self._shared["slots"].acquire()
+        self._add("queued", -1)
+        self._add("active", 1)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._add("active", -1)
+            if self._shared is not None:
+                self._shared["slots"].release()
+
+    def run(self, func, *args, **kwargs):
+        """Выполняет задачу в пуле транскодирования и блокирует вызывающий поток до её завершения."""
+        queued, active = self._add("queued", 1)
+        if active >= self.max_jobs:
+            logger.debug(f"Задача ffmpeg поставлена в очередь (ожидают: {queued}, активно: {active}).")
+        return self._executor.submit(self._run_job, func, args, kwargs).result()
+
+    def ffmpeg_args(self):
+        """Аргументы ffmpeg, ограничивающие число потоков одной задачи."""
+        return ['-threads', str(self.threads_per_job)]
+
+    def stats(self):
+        if self._shared is None:
+            with self._lock:
+                active, queued = self._active, self._queued
+        else:
+            active, queued = self._shared["active"].value, self._shared["queued"].value
+        return {
+            "max_jobs": self.max_jobs,
+            "active": active,
+            "queued": queued,
+            "threads_per_job": self.threads_per_job,
+        }
+
+
+_transcode_scheduler = None
+
+
+def use_transcode_scheduler(scheduler):
+    """Задаёт планировщик, через который идут ffmpeg-постпроцессоры задач этого процесса."""
+    global _transcode_scheduler
+    _transcode_scheduler = scheduler
+
+
+def init_worker(config):
+    """initializer процесса пула: настройки приходят аргументом, а не через окружение."""
+    logging.basicConfig(level=config.get("log_level", 'INFO'), format='%(asctime)s - %(levelname)s - %(message)s')
+    transcode = config.get("transcode")
+    if transcode:
+        use_transcode_scheduler(TranscodeScheduler(**transcode))
+
+
+def schedule_ffmpeg_postprocessor(postprocessor):
+    """Направляет запуск ffmpeg-постпроцессора yt-dlp через планировщик транскодирования."""
+    if _transcode_scheduler is None or not isinstance(postprocessor, FFmpegPostProcessor):
+        return postprocessor
+
+    original_run = postprocessor.run
+    scheduler = _transcode_scheduler
+
+    def scheduled_run(info):
+        return scheduler.run(original_run, info)
+
+    postprocessor.run = scheduled_run
+    return postprocessor
+
+
+# --- Передаваемые между процессами части опций yt-dlp ---
+class DownloadMeter:
+    """progress_hook yt-dlp: суммирует объём и время загрузки всех файлов одной задачи."""
+
+    def __init__(self):
+        self.downloaded_bytes = 0
+        self.elapsed = 0.0
+        self.fragmented = False
+
+    def hook(self, progress):
+        if progress.get('fragment_count'):
+            self.fragmented = True
+        if progress.get('status') == 'finished':
+            self.downloaded_bytes += progress.get('total_bytes') or progress.get('downloaded_bytes') or 0
+            self.elapsed += progress.get('elapsed') or 0.0
+
+
+class RetryBackoff:
+    """Экспоненциальная пауза перед повтором n (с нуля) для retry_sleep_functions yt-dlp."""
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+
+    def __call__(self, n):
+        return min(self.max_seconds, 0.5 * 2 ** n)
+
+
+class DurationMatchFilter:
+    """match_filter yt-dlp: пропускает записи без длительности или не длиннее limit_seconds."""
+
+    def __init__(self, limit_seconds):
+        self.limit_seconds = limit_seconds
+
+    def __call__(self, info_dict, incomplete=False):
+        duration = info_dict.get('duration')
+        if duration and duration > self.limit_seconds:
+            return f"Контент длиннее {self.limit_seconds / 60} минут."
+        return None
+
+
+# --- Ошибки ---
+def is_network_failure(error):
+    """Ошибка yt-dlp вызвана сетью, таймаутом или ответом 5xx/429 — по исходному исключению, без разбора текста."""
+    if getattr(error, 'network_failure', False):
+        return True
+    cause = (getattr(error, 'exc_info', None) or (None, None))[1] or error
+    if isinstance(cause, (TimeoutError, ConnectionError, socket.timeout)):
+        return True
+    status = getattr(cause, 'status', None)
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+def portable_download_error(error):
+    """
+    DownloadError без exc_info: исходное исключение с трассировкой не передаётся между процессами,
+    поэтому признак сетевого сбоя сохраняется отдельным атрибутом.
+    """
+    portable = yt_dlp.utils.DownloadError(str(error))
+    portable.network_failure = is_network_failure(error)
+    return portable
+
+
+# --- Задачи ---
+def extract_info_job(url, ydl_opts):
+    """Извлекает info_dict без загрузки (проверка контента, поиск). Возвращает его в JSON-совместимом виде."""
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info) if info else info
+    except yt_dlp.utils.DownloadError as e:
+        raise portable_download_error(e) from None
+
+
+def run_download_job(ydl_opts, url, postprocessors, prefetched_info=None):
+    """
+    Одна загрузка yt-dlp с постпроцессорами через планировщик транскодирования.
+    prefetched_info — уже полученный info_dict: извлечение пропускается, сразу выбор формата и загрузка.
+    Возвращает {"info": info_dict, "produced_files": итоговые пути файлов, "meter": DownloadMeter}.
+    """
+    produced_files = []
+    meter = DownloadMeter()
+    ydl_opts = dict(ydl_opts, progress_hooks=[meter.hook], post_hooks=[produced_files.append])
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            for pp_def_raw in postprocessors:
+                pp_def = dict(pp_def_raw)
+                when = pp_def.pop('when', 'post_process')
+                postprocessor = get_postprocessor(pp_def.pop('key'))(ydl, **pp_def)
+                ydl.add_post_processor(schedule_ffmpeg_postprocessor(postprocessor), when=when)
+            if prefetched_info is not None:
+                info = ydl.process_ie_result(ydl.sanitize_info(prefetched_info, remove_private_keys=True), download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+            info = ydl.sanitize_info(info) if info else info
+    except yt_dlp.utils.DownloadError as e:
+        raise portable_download_error(e) from None
+    return {"info": info, "produced_files": produced_files, "meter": meter}
+
+
+PLAYLIST_CONTEXT_KEYS = ('playlist', 'playlist_title', 'playlist_id', 'playlist_index', 'playlist_type')
+LISTED_ENTRY_KEYS = ('webpage_url', 'original_url', 'url', 'id', 'title', 'duration', *PLAYLIST_CONTEXT_KEYS)
+
+
+def list_playlist_job(url, ydl_opts, max_items):
+    """
+    Читает элементы плейлиста без их обработки (extract_info с process=False), не больше max_items.
+    Страницы плейлиста запрашиваются по мере чтения, от каждого элемента остаются только поля для загрузки,
+    так что объём ответа ограничен max_items короткими записями. Одиночная ссылка даёт список из одного элемента.
+    Возвращает {"context": поля плейлиста для тегов, "entries": [...]}.
+    """
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            playlist_info = ydl.extract_info(url, download=False, process=False)
+            if playlist_info.get('_type') in ('playlist', 'multi_video'):
+                entries = playlist_info.get('entries') or []
+            else:
+                entries = [dict(playlist_info, webpage_url=playlist_info.get('webpage_url') or url)]
+            listed = [
+                {key: entry.get(key) for key in LISTED_ENTRY_KEYS if entry.get(key) is not None} if entry else None
+                for entry in itertools.islice(entries, max_items)
+            ]
+    except yt_dlp.utils.DownloadError as e:
+        raise portable_download_error(e) from None
+    context = {
+        'playlist': playlist_info.get('title'),
+        'playlist_title': playlist_info.get('title'),
+        'playlist_id': playlist_info.get('id'),
+        'playlist_type': playlist_info.get('playlist_type'),
+    }
+    return {"context": context, "entries": listed}
+
+
+# --- Теги и контрольная сумма готового файла ---
+def build_opus_picture(cover_data, cover_mime, width=0, height=0):
+    """Блок METADATA_BLOCK_PICTURE для Opus в base64."""
+    picture = Picture()
+    picture.data = cover_data
+    picture.type = 3
+    picture.mime = cover_mime or 'image/jpeg'
+    picture.desc = 'Cover'
+    picture.width = width
+    picture.height = height
+    picture.depth = 24
+    return base64.b64encode(picture.write()).decode('ascii')
+
+
+def write_metadata_tags(file_path, metadata):
+    """
+    Записывает теги (включая обложку) в аудиофайл. Значения по умолчанию подставляет app:
+    metadata уже содержит title, artist, album, comment и cover_mime.
+    """
+    if not MUTAGEN_AVAILABLE or not file_path or not os.path.exists(file_path):
+        return
+
+    title = metadata['title']
+    artist = metadata['artist']
+    album = metadata['album']
+    comment = metadata['comment']
+    cover_data = metadata.get('cover_data')
+    cover_mime = metadata.get('cover_mime')
+
+    try:
+        lowercase_path = file_path.lower()
+        if lowercase_path.endswith('.mp3'):
+            try:
+                audio = EasyID3(file_path)
+            except ID3NoHeaderError:
+                audio_file = MP3(file_path)
+                audio_file.add_tags()
+                audio_file.save()
+                audio = EasyID3(file_path)
+
+            audio['title'] = [title]
+            audio['artist'] = [artist]
+            audio['albumartist'] = [artist]
+            if album:
+                audio['album'] = [album]
+            audio['comment'] = [comment]
+            audio.save()
+
+            if cover_data:
+                mp3_binary = MP3(file_path)
+                if mp3_binary.tags is None:
+                    mp3_binary.add_tags()
+                mp3_binary.tags.delall('APIC')
+                mp3_binary.tags.add(APIC(
+                    encoding=3,
+                    mime=cover_mime or 'image/jpeg',
+                    type=3,
+                    desc='Cover',
+                    data=cover_data
+                ))
+                mp3_binary.save()
+
+        elif lowercase_path.endswith(('.m4a', '.mp4', '.m4v', '.aac')):
+            audio = MP4(file_path)
+            audio['\xa9nam'] = [title]
+            audio['\xa9ART'] = [artist]
+            audio['aART'] = [artist]
+            audio['\xa9alb'] = [album]
+            audio['desc'] = [comment]
+            audio['\xa9cmt'] = [comment]
+
+            if cover_data and cover_mime:
+                lower_mime = cover_mime.lower()
+                if 'png' in lower_mime:
+                    cover = MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_PNG)
+                    audio['covr'] = [cover]
+                elif 'jpg' in lower_mime or 'jpeg' in lower_mime:
+                    cover = MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)
+                    audio['covr'] = [cover]
+                else:
+                    logger.debug(f"Пропущена обложка для '{file_path}': неподдерживаемый MIME {cover_mime}")
+
+            audio.save()
+        elif lowercase_path.endswith(('.opus', '.ogg')):
+            audio = OggOpus(file_path)
+            audio['title'] = [title]
+            audio['artist'] = [artist]
+            audio['albumartist'] = [artist]
+            audio['album'] = [album]
+            audio['comment'] = [comment]
+            if cover_data:
+                audio['metadata_block_picture'] = [
+                    build_opus_picture(cover_data, cover_mime, metadata.get('cover_width') or 0, metadata.get('cover_height') or 0)
+                ]
+            audio.save()
+    except Exception as tag_error:
+        logger.warning(f"Не удалось записать теги для '{file_path}': {tag_error}")
+
+
+def file_sha256(file_path):
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as media_file:
+        for chunk in iter(lambda: media_file.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def cover_data_uri(metadata):
+    """Возвращает data URI для встроенной обложки или исходный URL, если встроенных данных нет."""
+    if not metadata:
+        return None
+    cover_data = metadata.get('cover_data')
+    if cover_data:
+        cover_mime = metadata.get('cover_mime') or 'image/jpeg'
+        encoded = base64.b64encode(cover_data).decode('ascii')
+        return f"data:{cover_mime};base64,{encoded}"
+    return metadata.get('cover_url')
+
+
+def tag_file_job(file_path, metadata):
+    """
+    Завершает готовый файл вне потока запроса: записывает теги, считает SHA-256 для манифеста
+    и строит превью обложки для ответа. Возвращает {"sha256", "thumbnail"}.
+    """
+    write_metadata_tags(file_path, metadata)
+    return {"sha256": file_sha256(file_path), "thumbnail": cover_data_uri(metadata)}
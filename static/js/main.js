@@ -17,7 +17,8 @@ async function loadLocale(lang) {
         return translations[normalized];
     }
     if (!localeLoadPromises[normalized]) {
-        localeLoadPromises[normalized] = fetch(`/static/i18n/${normalized}.json`)
+        const localeUrls = window.MUSICJACKER_LOCALE_URLS || {};
+        localeLoadPromises[normalized] = fetch(localeUrls[normalized] || `/static/i18n/${normalized}.json`)
             .then((response) => {
                 if (!response.ok) {
                     throw new Error(`Failed to load locale ${normalized}`);
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Импорт app создаёт файлы состояния: направляем их во временную папку до первого импорта
+_STATE_DIR = tempfile.mkdtemp(prefix='musicjacker-tests-')
+os.environ.setdefault('SESSION_STATE_SQLITE_PATH', os.path.join(_STATE_DIR, 'session_state.sqlite3'))
+os.environ.setdefault('MEMORY_STORE_ENABLED', 'false')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    session_storage = app.SessionStorage(str(tmp_path / 'disk'), None, 0, 0, 0)
+    monkeypatch.setattr(app, 'SESSION_STORAGE', session_storage)
+    monkeypatch.setattr(app, 'register_session_files', lambda session_id, files: None)
+    monkeypatch.setattr(app, 'DOWNLOAD_ADMISSION', app.DownloadAdmission(max_active=10, max_transcode_queue=10))
+    return session_storage
+
+
+@pytest.fixture
+def fake_downloads(monkeypatch):
+    downloads = []
+
+    def fake_probe(url):
+        return {"info": {"id": url.rsplit('=', 1)[-1], "extractor_key": "Youtube", "duration": 60}}
+
+    def fake_download_entries(url, ydl_opts, client_key, probe_info):
+        downloads.append(url)
+        directory = os.path.dirname(ydl_opts['outtmpl']['default'] if isinstance(ydl_opts['outtmpl'], dict) else ydl_opts['outtmpl'])
+        path = os.path.join(directory, f"{probe_info['id']}.mp3")
+        with open(path, 'wb') as media_file:
+            media_file.write(b'audio')
+        return [{"id": probe_info['id'], "title": probe_info['id'], "filepath": path}]
+
+    def fake_finalize(entry, manifest, requested_formats, produced_files):
+        path = entry["filepath"]
+        manifest.add_file(path, 'mp3', {"title": entry["title"]})
+        filename = os.path.basename(path)
+        return [{"filename": filename, "format": 'mp3', "metadata": {"title": entry["title"]},
+                 "download_url": f"/serve_file/{manifest.session_id}/{filename}"}]
+
+    monkeypatch.setattr(app, 'get_info_and_check_duration', fake_probe)
+    monkeypatch.setattr(app, 'download_entries', fake_download_entries)
+    monkeypatch.setattr(app, 'finalize_downloaded_entry', fake_finalize)
+    return downloads
+
+
+def test_duplicate_items_download_once_but_get_own_files(storage, fake_downloads):
+    url = 'https://www.youtube.com/watch?v=abcdefghijk'
+    payload, status_code = app.process_batch_request({"items": [{"url": url}, {"url": url}, {"url": url}]}, 'ip:test')
+    assert status_code == 200
+    assert len(fake_downloads) == 1
+    download_urls = [result["files"][0]["download_url"] for result in payload["results"]]
+    assert len(set(download_urls)) == 3
+    manifest = app.SessionManifest.load(payload["session_id"])
+    for result in payload["results"]:
+        assert os.path.isfile(manifest.get(result["files"][0]["filename"])["path"])
+
+
+def test_batch_releases_extra_admission_slots(storage, fake_downloads):
+    items = [{"url": f'https://www.youtube.com/watch?v=video{index:06d}'} for index in range(3)]
+    payload, status_code = app.process_batch_request({"items": items}, 'ip:test')
+    assert status_code == 200
+    assert app.DOWNLOAD_ADMISSION.capacity()["active_downloads"] == 0
+
+
+def test_batch_larger_than_burst_is_rejected_not_undercharged():
+    limiter = app.TokenBucketLimiter(rate_per_minute=6, burst=3)
+    assert limiter.try_acquire('ip:1', 4) == (False, None)
+    assert limiter.try_acquire('ip:1', 3) == (True, 0)
+    allowed, retry_after = limiter.try_acquire('ip:1', 1)
+    assert not allowed and retry_after
+
+
+def test_batch_within_max_items_passes_default_limits(monkeypatch):
+    monkeypatch.setattr(app, 'RATE_LIMITER', app.TokenBucketLimiter(app.RATE_LIMIT_REQUESTS_PER_MINUTE, app.RATE_LIMIT_BURST))
+    monkeypatch.setattr(app, 'BATCH_RATE_LIMITER', app.TokenBucketLimiter(app.BATCH_RATE_LIMIT_ITEMS_PER_MINUTE, app.BATCH_MAX_ITEMS))
+    monkeypatch.setattr(app, 'process_batch_request', lambda data, client_key: ({"status": "success", "results": []}, 200))
+    client = app.app.test_client()
+    items = [{"url": "https://a"}] * max(4, app.RATE_LIMIT_BURST + 1)
+    assert client.post('/api/download_batch', json={"items": items}).status_code == 200
+    # Пакет не тратит токены обычных запросов
+    assert client.post('/api/download_audio', json={}).status_code == 400
+
+
+def test_oversized_batch_route_returns_400(monkeypatch):
+    monkeypatch.setattr(app, 'BATCH_RATE_LIMITER', app.TokenBucketLimiter(rate_per_minute=6, burst=2))
+    response = app.app.test_client().post('/api/download_batch', json={"items": [{"url": "https://a"}] * 3})
+    assert response.status_code == 400
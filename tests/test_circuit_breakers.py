@@ -0,0 +1,127 @@
+import socket
+import time
+
+import pytest
+import yt_dlp
+
+import app
+
+
+@pytest.mark.parametrize("message", [
+    "ERROR: [youtube] abc: Sign in to confirm your age. This video may be inappropriate for some users.",
+    "ERROR: [youtube] abc: Incomplete YouTube ID abc. URL https://youtu.be/abc looks truncated.",
+    "ERROR: [youtube] abc: This live event will begin in 3 hours.",
+    "ERROR: unable to download video data: HTTP Error 404: Not Found",
+    "ERROR: [youtube] abc: Unable to extract initial player response",
+    "ERROR: something nobody has seen before",
+])
+def test_per_link_errors_do_not_count_against_provider(message):
+    assert app.classify_download_error(yt_dlp.utils.DownloadError(message)) not in app.PROVIDER_FAILURE_ERROR_CLASSES
+
+
+@pytest.mark.parametrize("message", [
+    "ERROR: unable to download video data: HTTP Error 503: Service Unavailable",
+    "ERROR: unable to download webpage: HTTP Error 429: Too Many Requests",
+    "ERROR: Unable to download webpage: The read operation timed out",
+    "ERROR: Unable to download webpage: [Errno 104] Connection reset by peer",
+])
+def test_network_and_server_errors_count_against_provider(message):
+    assert app.classify_download_error(yt_dlp.utils.DownloadError(message)) in app.PROVIDER_FAILURE_ERROR_CLASSES
+
+
+def test_provider_failure_detected_from_wrapped_exception():
+    error = yt_dlp.utils.DownloadError("ERROR: download failed", exc_info=(TimeoutError, TimeoutError(), None))
+    assert app.classify_download_error(error) == 'provider'
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("ERROR: [youtube] abc: Private video. Sign in if you've been granted access", 'private'),
+    ("ERROR: [youtube] abc: Video unavailable. This video has been removed by the uploader", 'unavailable'),
+    ("ERROR: [youtube] abc: Video unavailable. The uploader has not made this video available in your country", 'geo_blocked'),
+    ("ERROR: Unsupported URL: https://example.com/", 'unsupported'),
+])
+def test_content_errors_are_negatively_cacheable(message, expected):
+    error_class = app.classify_download_error(yt_dlp.utils.DownloadError(message))
+    assert error_class == expected
+    assert error_class in app.NEGATIVE_CACHE_ERROR_CLASSES
+
+
+def test_breaker_opens_after_threshold_and_rejects():
+    breaker = app.CircuitBreaker('test', failure_threshold=3, reset_seconds=60)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert 1 <= breaker.retry_after() <= 60
+
+
+def test_success_resets_failure_count():
+    breaker = app.CircuitBreaker('test', failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open()
+
+
+def test_half_open_allows_single_probe_and_closes_on_success():
+    breaker = app.CircuitBreaker('test', failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # второй запрос ждёт исхода пробного
+    breaker.record_success()
+    assert not breaker.is_open()
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = app.CircuitBreaker('test', failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+
+def test_zero_threshold_disables_breaker():
+    breaker = app.CircuitBreaker('test', failure_threshold=0, reset_seconds=60)
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_negative_cache_expires():
+    cache = app.NegativeResultCache(ttl_seconds=0.05, max_entries=2)
+    cache.put('youtube:a', 'private', 'msg')
+    assert cache.get('youtube:a')["error_class"] == 'private'
+    time.sleep(0.06)
+    assert cache.get('youtube:a') is None
+
+
+def test_negative_cache_is_bounded():
+    cache = app.NegativeResultCache(ttl_seconds=60, max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, 'private', 'msg')
+    assert cache.get('a') is None
+    assert cache.get('c') is not None
+
+
+def test_refused_download_opens_breaker(tmp_path, monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    url = f"http://127.0.0.1:{port}/media.mp3"
+    breaker = app.CircuitBreaker('127.0.0.1', failure_threshold=2, reset_seconds=60)
+    monkeypatch.setitem(app.CIRCUIT_BREAKERS, '127.0.0.1', breaker)
+    monkeypatch.setattr(app, 'DOWNLOAD_TUNER', app.DownloadTuner({'default': {'retries': 0, 'fragment_retries': 0}}, 1, False, 0))
+    ydl_opts = app.build_download_opts(url, 'm4a', str(tmp_path))
+    for _ in range(2):
+        assert app.blocking_yt_dlp_download(ydl_opts, url) is None
+    assert breaker.is_open()
+    with pytest.raises(app.ProviderUnavailableError):
+        app.blocking_yt_dlp_download(ydl_opts, url)
@@ -0,0 +1,67 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ('', None),
+    (90, 90.0),
+    ('75.5', 75.5),
+    ('1:30', 90.0),
+    ('01:02:03', 3723.0),
+])
+def test_parse_timestamp(value, expected):
+    assert app.parse_timestamp(value) == expected
+
+
+@pytest.mark.parametrize("data, expected", [
+    ({}, None),
+    ({"start": "0:30"}, (30.0, None)),
+    ({"end": 45}, (0.0, 45.0)),
+    ({"start": 10, "end": "1:00"}, (10.0, 60.0)),
+])
+def test_parse_clip_range(data, expected):
+    assert app.parse_clip_range(data) == expected
+
+
+@pytest.mark.parametrize("data", [
+    {"start": "abc"},
+    {"start": -5},
+    {"start": True},
+    {"start": "1:2:3:4"},
+    {"start": 60, "end": 30},
+])
+def test_parse_clip_range_rejects_bad_input(data):
+    with pytest.raises(app.RequestValidationError):
+        app.parse_clip_range(data)
+
+
+def test_resolve_clip_range_clamps_end_to_duration():
+    assert app.resolve_clip_range({"duration": 120}, (100.0, None)) == (100.0, 120)
+    assert app.resolve_clip_range({"duration": 120}, (10.0, 500.0)) == (10.0, 120)
+
+
+@pytest.mark.parametrize("info, clip_range", [
+    ({"duration": 120}, (200.0, None)),
+    ({"_type": "playlist"}, (0.0, 10.0)),
+    ({}, (10.0, None)),
+    ({"duration": 10 * 3600}, (0.0, app.DURATION_LIMIT_SECONDS + 1.0)),
+])
+def test_resolve_clip_range_rejects_with_validation_error(info, clip_range):
+    with pytest.raises(app.RequestValidationError):
+        app.resolve_clip_range(info, clip_range)
+
+
+def test_clip_error_is_answered_with_400(monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_IS_AVAILABLE', True)
+    monkeypatch.setattr(app, 'fetch_content_info', lambda url: {"id": "abcdefghijk", "duration": 120})
+    payload, status_code = app.process_download_request({"url": "https://www.youtube.com/watch?v=abcdefghijk", "start": 300}, 'ip:test')
+    assert status_code == 400
+    assert payload["message"] == "Время start больше длительности контента."
+
+
+def test_clip_probe_info_scales_size():
+    clipped = app.clip_probe_info({"duration": 100, "filesize": 1000}, (10.0, 35.0))
+    assert clipped["duration"] == 25.0
+    assert clipped["filesize"] == 250
@@ -0,0 +1,64 @@
+import io
+
+import pytest
+
+import app
+import cover_worker
+import download_worker
+
+
+def make_cover(size):
+    return {"data": b'x' * size, "mime": 'image/jpeg', "width": 0, "height": 0}
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = app.CoverCache(max_bytes=100)
+    cache.put('a', make_cover(40))
+    cache.put('b', make_cover(40))
+    cache.put('c', make_cover(40))
+    assert cache.get('a') is None
+    assert cache.get('b') is not None and cache.get('c') is not None
+    assert cache.stats()["bytes"] == 80
+
+
+def test_lookup_refreshes_recency():
+    cache = app.CoverCache(max_bytes=100)
+    cache.put('a', make_cover(40))
+    cache.put('b', make_cover(40))
+    cache.get('a')
+    cache.put('c', make_cover(40))
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+
+
+def test_url_aliases_share_one_copy():
+    cache = app.CoverCache(max_bytes=100)
+    cover = make_cover(40)
+    cache.put('digest', cover, 'https://img/1.jpg')
+    cache.put('digest', cover, 'https://img/2.jpg')
+    assert cache.get_by_url('https://img/1.jpg') is cache.get_by_url('https://img/2.jpg')
+    assert cache.stats() == {"covers": 1, "bytes": 40, "max_bytes": 100}
+
+
+def test_oversized_cover_is_not_cached():
+    cache = app.CoverCache(max_bytes=10)
+    cache.put('a', make_cover(11), 'https://img/a.jpg')
+    assert cache.get_by_url('https://img/a.jpg') is None
+    assert cache.stats()["bytes"] == 0
+
+
+@pytest.mark.skipif(not cover_worker.PILLOW_AVAILABLE, reason="нужен Pillow")
+def test_worker_crops_to_square_jpeg():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGBA', (300, 200), (255, 0, 0, 128)).save(buffer, format='PNG')
+    cover = cover_worker.process_cover_image(buffer.getvalue(), 'image/png', size=100, jpeg_quality=80)
+    assert cover["mime"] == 'image/jpeg'
+    assert (cover["width"], cover["height"]) == (100, 100)
+    with Image.open(io.BytesIO(cover["data"])) as result:
+        assert result.size == (100, 100)
+
+
+def test_thumbnail_preview_is_derived_from_cover_data():
+    preview = download_worker.cover_data_uri({"cover_data": b'abc', "cover_mime": 'image/png'})
+    assert preview == 'data:image/png;base64,YWJj'
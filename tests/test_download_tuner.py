@@ -0,0 +1,59 @@
+import app
+from download_worker import DownloadMeter, RetryBackoff
+
+MB = app.MEGABYTE
+
+
+def make_tuner(adaptive=True, min_bytes=MB, max_fragments=6):
+    return app.DownloadTuner(app.DOWNLOAD_PROFILES, max_fragments, adaptive, min_bytes)
+
+
+def make_meter(megabytes, seconds, fragmented=False):
+    meter = DownloadMeter()
+    meter.hook({'status': 'finished', 'total_bytes': megabytes * MB, 'elapsed': seconds, 'fragment_count': 10 if fragmented else None})
+    return meter
+
+
+def test_options_follow_source_profile_without_unset_values():
+    options = make_tuner().options_for('soundcloud')
+    assert options['concurrent_fragment_downloads'] == 4
+    assert 'http_chunk_size' not in options
+    assert isinstance(options['retry_sleep_functions']['fragment'], RetryBackoff)
+    assert make_tuner().options_for('vimeo.com')['concurrent_fragment_downloads'] == app.DOWNLOAD_PROFILES['default']['concurrent_fragment_downloads']
+
+
+def test_retry_backoff_grows_exponentially_up_to_cap():
+    backoff = RetryBackoff(3)
+    assert [backoff(n) for n in range(5)] == [0.5, 1, 2, 3, 3]
+
+
+def test_fragment_count_climbs_while_faster_and_turns_back_when_slower():
+    tuner = make_tuner()
+    tuner.record('soundcloud', make_meter(8, 4, fragmented=True), {}, 'a')
+    assert tuner.options_for('soundcloud')['concurrent_fragment_downloads'] == 5
+    tuner.record('soundcloud', make_meter(8, 2, fragmented=True), {}, 'b')
+    assert tuner.options_for('soundcloud')['concurrent_fragment_downloads'] == 6
+    tuner.record('soundcloud', make_meter(8, 2, fragmented=True), {}, 'c')
+    assert tuner.options_for('soundcloud')['concurrent_fragment_downloads'] == 6  # шум и верхняя граница
+    tuner.record('soundcloud', make_meter(8, 8, fragmented=True), {}, 'd')
+    assert tuner.options_for('soundcloud')['concurrent_fragment_downloads'] == 5
+
+
+def test_chunk_size_is_tuned_for_plain_http_within_limits():
+    tuner = make_tuner()
+    tuner.record('youtube', make_meter(20, 10), {}, 'a')
+    assert tuner.options_for('youtube')['http_chunk_size'] == 20 * MB
+    for _ in range(5):
+        tuner.record('youtube', make_meter(20, 1), {}, 'faster')
+    assert tuner.options_for('youtube')['http_chunk_size'] == app.HTTP_CHUNK_SIZE_LIMITS[1]
+
+
+def test_small_or_non_adaptive_downloads_do_not_change_profile():
+    tuner = make_tuner(min_bytes=10 * MB)
+    tuner.record('youtube', make_meter(2, 1), {}, 'small')
+    assert tuner.options_for('youtube')['http_chunk_size'] == 10 * MB
+    fixed = make_tuner(adaptive=False)
+    fixed.record('youtube', make_meter(20, 1), {}, 'big')
+    assert fixed.options_for('youtube')['http_chunk_size'] == 10 * MB
+    tuner.record('youtube', DownloadMeter(), {}, 'nothing measured')
+    assert tuner.options_for('youtube')['http_chunk_size'] == 10 * MB
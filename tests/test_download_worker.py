@@ -0,0 +1,107 @@
+import hashlib
+import multiprocessing
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+import yt_dlp
+from mutagen.mp3 import MP3
+
+import app
+import download_worker
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def shared_schedulers():
+    main = download_worker.TranscodeScheduler(1, 1)
+    worker = download_worker.TranscodeScheduler(**main.share_across_processes(multiprocessing.get_context('spawn')))
+    return main, worker
+
+
+def test_transcode_limit_and_queue_are_shared(shared_schedulers):
+    main, worker = shared_schedulers
+    release = threading.Event()
+    order = []
+
+    def job(name):
+        order.append(name)
+        release.wait(5)
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(worker.run, job, 'worker')
+        wait_until(lambda: main.stats()["active"] == 1)
+        second = pool.submit(main.run, job, 'main')
+        wait_until(lambda: main.stats()["queued"] == 1)
+        assert order == ['worker']
+        release.set()
+        first.result(5)
+        second.result(5)
+    assert order == ['worker', 'main']
+    assert main.stats() == worker.stats() == {"max_jobs": 1, "active": 0, "queued": 0, "threads_per_job": 1}
+
+
+def test_admission_sees_transcode_queue_of_other_processes(shared_schedulers, monkeypatch):
+    main, worker = shared_schedulers
+    monkeypatch.setattr(app, 'TRANSCODE_SCHEDULER', main)
+    admission = app.DownloadAdmission(max_active=5, max_transcode_queue=0)
+    release = threading.Event()
+    with ThreadPoolExecutor(2) as pool:
+        pool.submit(worker.run, release.wait, 5)
+        pool.submit(worker.run, release.wait, 5)
+        wait_until(lambda: main.stats()["queued"] == 1)
+        assert not admission.try_enter()
+        release.set()
+    assert admission.try_enter()
+
+
+def test_portable_download_error_keeps_provider_failure():
+    error = yt_dlp.utils.DownloadError("ERROR: download failed", exc_info=(TimeoutError, TimeoutError(), None))
+    portable = pickle.loads(pickle.dumps(download_worker.portable_download_error(error)))
+    assert isinstance(portable, yt_dlp.utils.DownloadError)
+    assert portable.exc_info is None
+    assert app.classify_download_error(portable) == 'provider'
+
+
+def test_download_options_can_be_sent_to_worker_processes():
+    options = pickle.loads(pickle.dumps({
+        **app.DOWNLOAD_TUNER.options_for('youtube'),
+        'match_filter': download_worker.DurationMatchFilter(600),
+    }))
+    assert options['retry_sleep_functions']['http'](10) == app.DOWNLOAD_RETRY_BACKOFF_MAX_SECONDS
+    assert options['match_filter']({'duration': 601})
+    assert options['match_filter']({'duration': 600}) is None
+    assert options['match_filter']({}) is None
+
+
+def test_run_job_uses_executor_of_its_kind(monkeypatch):
+    with ThreadPoolExecutor(1, thread_name_prefix='probe-pool') as pool:
+        monkeypatch.setitem(app.JOB_EXECUTORS, 'probe', pool)
+        assert app.run_job('probe', lambda: threading.current_thread().name).startswith('probe-pool')
+    assert app.run_job('download', threading.current_thread) is threading.current_thread()
+    with pytest.raises(ValueError):
+        app.set_job_executors(upload=None)
+
+
+def test_tagging_and_checksum_run_in_tag_pool(tmp_path, monkeypatch):
+    path = tmp_path / 'track [video000001].mp3'
+    path.write_bytes((b'\xff\xfb\x90\x64' + b'\x00' * 413) * 10)  # несколько пустых кадров MPEG-1 Layer III
+    manifest = app.SessionManifest('session', str(tmp_path))
+    metadata = {"title": 'Song', "artist": 'Artist', "cover_data": b'abc', "cover_mime": 'image/png'}
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        monkeypatch.setitem(app.JOB_EXECUTORS, 'tag', pool)
+        file_info = app.finalize_output_file(str(path), 'Artist - Song', metadata, manifest)
+    assert file_info["thumbnail"] == 'data:image/png;base64,YWJj'
+    tagged_path = tmp_path / file_info["filename"]
+    tags = MP3(str(tagged_path)).tags
+    assert tags['TIT2'].text == ['Song'] and tags['TALB'].text == [app.DEFAULT_ALBUM_NAME]
+    assert tags.getall('APIC')[0].data == b'abc'
+    assert manifest.get(file_info["filename"])["sha256"] == hashlib.sha256(tagged_path.read_bytes()).hexdigest()
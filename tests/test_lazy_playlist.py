@@ -0,0 +1,156 @@
+import os
+
+import pytest
+
+import app
+import download_worker
+
+PLAYLIST_URL = 'https://www.youtube.com/playlist?list=PLtest'
+
+
+@pytest.fixture
+def lazy_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'SESSION_STORAGE', app.SessionStorage(str(tmp_path / 'disk'), None, 0, 0, 0))
+    monkeypatch.setattr(app, 'register_session_files', lambda session_id, files: None)
+    monkeypatch.setattr(app, 'DOWNLOAD_ADMISSION', app.DownloadAdmission(max_active=1, max_transcode_queue=10))
+    monkeypatch.setattr(app, 'RATE_LIMITER', app.TokenBucketLimiter(rate_per_minute=0, burst=1))
+    monkeypatch.setattr(app, 'LAZY_PLAYLIST_ADMISSION_POLL_SECONDS', 0)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    admission_during_download = []
+
+    def fake_listing(url, ydl_opts, max_items):
+        entries = [{"url": f"https://www.youtube.com/watch?v=video{index:06d}", "id": f"video{index:06d}", "duration": 60} for index in range(3)]
+        return {"context": {"playlist": "Test"}, "entries": entries[:max_items]}
+
+    def fake_download(ydl_opts, url):
+        admission_during_download.append(app.DOWNLOAD_ADMISSION.capacity()["active_downloads"])
+        path = os.path.join(os.path.dirname(ydl_opts['outtmpl']['default'] if isinstance(ydl_opts['outtmpl'], dict) else ydl_opts['outtmpl']), f"{url[-11:]}.mp3")
+        with open(path, 'wb') as media_file:
+            media_file.write(b'audio')
+        for post_hook in ydl_opts['post_hooks']:
+            post_hook(path)
+        return {"id": url[-11:], "title": url[-11:], "filepath": path}
+
+    def fake_finalize(entry, manifest, requested_formats, produced_files):
+        filename = os.path.basename(entry["filepath"])
+        manifest.add_file(entry["filepath"], 'mp3', {"title": entry["title"]})
+        return [{"filename": filename, "format": 'mp3', "metadata": {"title": entry["title"]}}]
+
+    monkeypatch.setattr(download_worker, 'list_playlist_job', fake_listing)
+    monkeypatch.setattr(app, 'blocking_yt_dlp_download', fake_download)
+    monkeypatch.setattr(app, 'finalize_downloaded_entry', fake_finalize)
+    return admission_during_download
+
+
+def test_lazy_request_is_validated_like_regular_download():
+    assert app.process_lazy_playlist_request({"url": "not a url", "lazy": True}, 'ip:test')[1] == 400
+    assert app.process_lazy_playlist_request({"url": PLAYLIST_URL, "format": "flac", "lazy": True}, 'ip:test')[1] == 400
+    payload, status_code = app.process_lazy_playlist_request({"url": PLAYLIST_URL, "start": "x", "lazy": True}, 'ip:test')
+    assert status_code == 400
+    assert payload == app.process_download_request({"url": PLAYLIST_URL, "start": "x"}, 'ip:test')[0]
+
+
+def test_each_item_takes_admission_only_while_downloading(lazy_env):
+    events, status_code = app.process_lazy_playlist_request({"url": PLAYLIST_URL, "lazy": True}, 'ip:test')
+    assert status_code == 200
+    events = list(events)
+    assert [event["type"] for event in events] == ['session', 'file', 'file', 'file', 'done']
+    assert lazy_env == [1, 1, 1]
+    assert app.DOWNLOAD_ADMISSION.capacity()["active_downloads"] == 0
+
+
+def test_items_after_the_first_pay_rate_limit_tokens(lazy_env, monkeypatch):
+    limiter = app.TokenBucketLimiter(rate_per_minute=60, burst=1)
+    monkeypatch.setattr(app, 'RATE_LIMITER', limiter)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: pytest.fail('генератор не должен спать сам'))
+    assert limiter.try_acquire('ip:test') == (True, 0)  # токен самого запроса
+    events = []
+    for event in app.process_lazy_playlist_request({"url": PLAYLIST_URL, "lazy": True}, 'ip:test')[0]:
+        events.append(event)
+        if event["type"] == 'waiting':
+            assert event["retry_after"] > 0
+            limiter._buckets['ip:test'] = (1.0, app.time.monotonic())  # пауза потребителя истекла
+    waiting = [event for event in events if event["type"] == 'waiting']
+    assert [event["reason"] for event in waiting] == ['rate_limit', 'rate_limit']
+    assert events[-1]["files"] == 3
+
+
+def test_flask_stream_sleeps_after_waiting_event(monkeypatch):
+    pauses = []
+    monkeypatch.setattr(app.time, 'sleep', pauses.append)
+    lines = list(app.stream_ndjson([{"type": "waiting", "reason": "busy", "retry_after": 2}, {"type": "done"}]))
+    assert len(lines) == 2 and pauses == [2]
+
+
+def test_asgi_stream_waits_without_holding_a_thread(monkeypatch):
+    asgi = pytest.importorskip('asgi')
+    monkeypatch.setattr(asgi, '_handler_limiter', None)
+    closed = []
+    borrowed_while_waiting = []
+
+    def events():
+        try:
+            yield {"type": "waiting", "reason": "busy", "retry_after": 0.01}
+            yield {"type": "file", "index": 1}
+            yield {"type": "done"}
+        finally:
+            closed.append(True)
+
+    async def consume():
+        stream = asgi.iterate_lazy_events(events())
+        lines = [await stream.__anext__()]
+        borrowed_while_waiting.append(asgi.handler_limiter().borrowed_tokens)
+        lines.append(await stream.__anext__())
+        await stream.aclose()  # клиент отключился до конца потока
+        return lines
+
+    lines = asgi.anyio.run(consume)
+    assert ['"waiting"' in lines[0], '"file"' in lines[1]] == [True, True]
+    assert borrowed_while_waiting == [0]
+    assert closed == [True]
+
+
+@pytest.mark.parametrize('message, cached', [
+    ("ERROR: HTTP Error 503: Service Unavailable", False),
+    ("ERROR: Unsupported URL: https://www.youtube.com/playlist?list=PLtest", True),
+])
+def test_listing_goes_through_breaker_and_negative_cache(lazy_env, monkeypatch, message, cached):
+    monkeypatch.setattr(app, 'CIRCUIT_BREAKERS', {})
+    monkeypatch.setattr(app, 'CIRCUIT_FAILURE_THRESHOLD', 1)
+    monkeypatch.setattr(app, 'NEGATIVE_RESULT_CACHE', app.NegativeResultCache(60, 10))
+    listings = []
+
+    def failing_listing(url, ydl_opts, max_items):
+        listings.append(url)
+        raise app.yt_dlp.utils.DownloadError(message)
+
+    monkeypatch.setattr(download_worker, 'list_playlist_job', failing_listing)
+    for _ in range(2):
+        events = list(app.process_lazy_playlist_request({"url": PLAYLIST_URL, "lazy": True}, 'ip:test')[0])
+        assert [event["type"] for event in events] == ['session', 'error']
+    assert listings == [PLAYLIST_URL]
+    # Отказ источника размыкает предохранитель, ошибка самой ссылки попадает в отрицательный кеш
+    assert ('retry_after' in events[-1]) is not cached
+    assert app.get_circuit_breaker(app.extractor_for_url(PLAYLIST_URL)).is_open() is not cached
+
+
+def test_closing_stream_releases_admission(lazy_env):
+    events = app.process_lazy_playlist_request({"url": PLAYLIST_URL, "lazy": True}, 'ip:test')[0]
+    assert next(events)["type"] == 'session'
+    assert next(events)["type"] == 'file'
+    events.close()
+    assert app.DOWNLOAD_ADMISSION.capacity()["active_downloads"] == 0
+    assert app.DOWNLOAD_ADMISSION.try_enter()
+
+
+def test_profile_covers_streamed_body(lazy_env, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'PROFILE_OUTPUT_DIR', str(tmp_path / 'profiles'))
+    monkeypatch.setattr(app, 'PROFILE_SAMPLE_RATE', 1.0)
+    client = app.app.test_client()
+    response = client.post('/api/download_audio', json={"url": PLAYLIST_URL, "lazy": True}, buffered=False)
+    profile_name = response.headers['X-Profile-Id']
+    assert not os.path.exists(tmp_path / 'profiles' / profile_name)
+    body = response.get_data(as_text=True)
+    response.close()
+    assert body.count('"type": "file"') == 3
+    assert os.path.exists(tmp_path / 'profiles' / profile_name)
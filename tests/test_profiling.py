@@ -0,0 +1,37 @@
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'PROFILE_OUTPUT_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'PROFILE_SAMPLE_RATE', 1.0)
+    return tmp_path
+
+
+def test_rejected_requests_are_not_profiled(profile_dir, monkeypatch):
+    monkeypatch.setattr(app, 'RATE_LIMITER', app.TokenBucketLimiter(rate_per_minute=6, burst=1))
+    monkeypatch.setattr(app, 'process_download_request', lambda data, client_key: ({"status": "error", "message": "x"}, 400))
+    client = app.app.test_client()
+    admitted = client.post('/api/download_audio', json={})
+    assert admitted.status_code == 400
+    assert admitted.headers.get('X-Profile-Id')
+    rejected = client.post('/api/download_audio', json={})
+    assert rejected.status_code == 429
+    assert 'X-Profile-Id' not in rejected.headers
+    assert len(os.listdir(profile_dir)) == 1
+
+
+def test_old_profiles_are_pruned(profile_dir, monkeypatch):
+    monkeypatch.setattr(app, 'PROFILE_MAX_FILES', 2)
+    for index in range(4):
+        path = profile_dir / f"search-{index}.folded"
+        path.write_text('main 1\n')
+        os.utime(path, (time.time() + index, time.time() + index))
+    (profile_dir / 'notes.txt').write_text('keep')
+    app.prune_profiles()
+    assert sorted(os.listdir(profile_dir)) == ['notes.txt', 'search-2.folded', 'search-3.folded']
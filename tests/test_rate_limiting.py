@@ -0,0 +1,61 @@
+import pytest
+
+import app
+
+
+def test_bucket_allows_burst_then_rejects_with_retry_after():
+    limiter = app.TokenBucketLimiter(rate_per_minute=6, burst=3)
+    for _ in range(3):
+        assert limiter.try_acquire('ip:1') == (True, 0)
+    allowed, retry_after = limiter.try_acquire('ip:1')
+    assert not allowed
+    assert retry_after == 10
+
+
+def test_buckets_are_per_client():
+    limiter = app.TokenBucketLimiter(rate_per_minute=6, burst=1)
+    assert limiter.try_acquire('ip:1')[0]
+    assert not limiter.try_acquire('ip:1')[0]
+    assert limiter.try_acquire('ip:2')[0]
+
+
+def test_bucket_refills_over_time(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: clock[0])
+    limiter = app.TokenBucketLimiter(rate_per_minute=60, burst=2)
+    assert limiter.try_acquire('ip:1', 2)[0]
+    assert not limiter.try_acquire('ip:1')[0]
+    clock[0] += 1.0
+    assert limiter.try_acquire('ip:1')[0]
+
+
+def test_zero_rate_disables_limiter():
+    limiter = app.TokenBucketLimiter(rate_per_minute=0, burst=1)
+    for _ in range(10):
+        assert limiter.try_acquire('ip:1', 5) == (True, 0)
+
+
+def test_unknown_api_key_falls_back_to_ip(monkeypatch):
+    monkeypatch.setattr(app, 'API_KEYS', frozenset({'issued'}))
+    assert app.client_key_from('issued', '10.0.0.1') == 'key:issued'
+    assert app.client_key_from('random-1', '10.0.0.1') == 'ip:10.0.0.1'
+    assert app.client_key_from('random-2', '10.0.0.1') == 'ip:10.0.0.1'
+    assert app.client_key_from(None, None) == 'ip:unknown'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'RATE_LIMITER', app.TokenBucketLimiter(rate_per_minute=6, burst=1))
+    monkeypatch.setattr(app, 'DOWNLOAD_ADMISSION', app.DownloadAdmission(max_active=1, max_transcode_queue=10))
+    return app.app.test_client()
+
+
+def test_rate_limited_request_does_not_take_admission_slot(client, monkeypatch):
+    monkeypatch.setattr(app, 'process_download_request', lambda data, client_key: ({"status": "error", "message": "x"}, 400))
+    assert client.post('/api/download_audio', json={}).status_code == 400
+    entered = []
+    monkeypatch.setattr(app.DOWNLOAD_ADMISSION, 'try_enter', lambda: entered.append(True) or True)
+    response = client.post('/api/download_audio', json={})
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
+    assert entered == []
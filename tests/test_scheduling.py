@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("условие не выполнено за отведённое время")
+        time.sleep(0.001)
+
+
+def run_queued_jobs(scheduler, jobs):
+    """Ставит задачи (клиент, длительность) в очередь при занятом слоте и возвращает порядок их выдачи."""
+    order = []
+    release = threading.Event()
+    blocker_started = threading.Event()
+
+    def blocker():
+        with scheduler.slot('blocker', 1):
+            blocker_started.set()
+            release.wait()
+
+    def job(client_key, duration):
+        with scheduler.slot(client_key, duration):
+            order.append(client_key)
+
+    threads = [threading.Thread(target=blocker)]
+    threads[0].start()
+    blocker_started.wait()
+    for index, (client_key, duration) in enumerate(jobs, start=1):
+        thread = threading.Thread(target=job, args=(client_key, duration))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: scheduler.stats()["waiting"] == index)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_large_job_is_not_starved_by_short_jobs_from_new_clients():
+    scheduler = app.FairDownloadScheduler(1, 240)
+    jobs = [(f"short-{index}", 15) for index in range(5)]
+    jobs.append(("big", 590))
+    jobs += [(f"short-{index}", 15) for index in range(5, 40)]
+
+    order = run_queued_jobs(scheduler, jobs)
+
+    assert len(order) == 41
+    # Большая задача выдаётся не позже задач, поставленных в очередь раньше неё
+    assert order.index("big") <= 5
+
+
+def test_client_backlog_does_not_block_other_clients():
+    scheduler = app.FairDownloadScheduler(1, 240)
+    jobs = [("playlist", 60) for _ in range(10)]
+    jobs.append(("single", 60))
+
+    order = run_queued_jobs(scheduler, jobs)
+
+    assert order.index("single") <= 2
+
+
+def test_slots_are_released_after_use():
+    scheduler = app.FairDownloadScheduler(2, 240)
+    with scheduler.slot('a', 10):
+        with scheduler.slot('b', 10):
+            assert scheduler.stats()["busy"] == 2
+    assert scheduler.stats() == {"slots": 2, "busy": 0, "waiting": 0}
+
+
+@pytest.mark.parametrize("duration, expected", [(None, 240.0), ("bad", 240.0), (0, 240.0), (90, 90.0)])
+def test_job_cost_falls_back_to_default(duration, expected):
+    assert app.FairDownloadScheduler(1, 240)._cost(duration) == expected
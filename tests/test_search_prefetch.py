@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def prefetcher(monkeypatch):
+    monkeypatch.setattr(app, 'DOWNLOAD_ADMISSION', app.DownloadAdmission(max_active=4, max_transcode_queue=10))
+    monkeypatch.setattr(app, 'build_track_metadata', lambda info, track_name, artist_name: {})
+    return app.SearchPrefetcher(top_n=2, workers=1, ttl_seconds=0.05, max_entries=10)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_expired_entry_is_prefetched_again(prefetcher, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, 'fetch_content_info', lambda url, record_outcome=True: calls.append(url) or {"id": "a", "title": "A"})
+    url = 'https://www.youtube.com/watch?v=aaaaaaaaaaa'
+    prefetcher.schedule('ip:1', [url])
+    wait_for(lambda: len(calls) == 1 and not prefetcher._in_flight)
+    time.sleep(0.06)
+    prefetcher.schedule('ip:1', [url])
+    wait_for(lambda: len(calls) == 2)
+
+
+def test_prefetch_failures_do_not_touch_breaker(monkeypatch):
+    monkeypatch.setattr(app, 'CIRCUIT_BREAKERS', {})
+    monkeypatch.setattr(app, 'CIRCUIT_FAILURE_THRESHOLD', 1)
+
+    class FailingYDL:
+        def __init__(self, opts):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def extract_info(self, url, download=False):
+            raise app.yt_dlp.utils.DownloadError("ERROR: HTTP Error 503: Service Unavailable")
+
+    monkeypatch.setattr(app.yt_dlp, 'YoutubeDL', FailingYDL)
+    url = 'https://www.youtube.com/watch?v=bbbbbbbbbbb'
+    with pytest.raises(ValueError):
+        app.fetch_content_info(url, record_outcome=False)
+    breaker = app.get_circuit_breaker(app.extractor_for_url(url))
+    assert not breaker.is_open()
+    breaker.record_failure()
+    with pytest.raises(app.ProviderUnavailableError):
+        app.fetch_content_info(url, record_outcome=False)
+
+
+def test_prefetch_does_not_take_half_open_probe(monkeypatch):
+    breaker = app.CircuitBreaker('test', failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    monkeypatch.setattr(app, 'get_circuit_breaker', lambda name: breaker)
+    with pytest.raises(app.ProviderUnavailableError):
+        app.fetch_content_info('https://www.youtube.com/watch?v=ccccccccccc', record_outcome=False)
+    assert breaker.allow()  # пробный запрос остался за настоящей загрузкой
+
+
+def test_prefetch_is_skipped_without_spare_admission(prefetcher, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, 'fetch_content_info', lambda url, record_outcome=True: calls.append(url) or {"id": "d"})
+    monkeypatch.setattr(app, 'DOWNLOAD_ADMISSION', app.DownloadAdmission(max_active=2, max_transcode_queue=10))
+    assert app.DOWNLOAD_ADMISSION.try_enter()
+    # Свободно одно место — столько же, сколько потоков предзагрузки: оно остаётся настоящей загрузке
+    prefetcher.schedule('ip:1', ['https://www.youtube.com/watch?v=ddddddddddd'])
+    wait_for(lambda: not prefetcher._in_flight)
+    assert calls == []
+    assert app.DOWNLOAD_ADMISSION.capacity()["active_downloads"] == 1
+    app.DOWNLOAD_ADMISSION.leave()
+    prefetcher.schedule('ip:1', ['https://www.youtube.com/watch?v=ddddddddddd'])
+    wait_for(lambda: calls)
+
+
+def test_prefetch_holds_admission_while_running(prefetcher, monkeypatch):
+    release = threading.Event()
+    observed = []
+
+    def slow_fetch(url, record_outcome=True):
+        observed.append(app.DOWNLOAD_ADMISSION.capacity()["active_downloads"])
+        release.wait(5)
+        return {"id": "e"}
+
+    monkeypatch.setattr(app, 'fetch_content_info', slow_fetch)
+    prefetcher.schedule('ip:1', ['https://www.youtube.com/watch?v=eeeeeeeeeee'])
+    wait_for(lambda: observed)
+    release.set()
+    wait_for(lambda: not prefetcher._in_flight)
+    assert observed == [1]
+    assert app.DOWNLOAD_ADMISSION.capacity()["active_downloads"] == 0
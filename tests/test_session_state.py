@@ -0,0 +1,79 @@
+import io
+import sqlite3
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return app.SQLiteSessionStateBackend(str(tmp_path / 'state.sqlite3'), ttl_seconds=60)
+
+
+def test_sqlite_backend_closes_connection_after_each_operation(backend, monkeypatch):
+    opened = []
+    connect = sqlite3.connect
+
+    def tracking_connect(*args, **kwargs):
+        opened.append(connect(*args, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(app.sqlite3, 'connect', tracking_connect)
+    backend.register_file('session', 'a.mp3', 'node-b', 'http://10.0.0.2:8080', 'https://b.example.com')
+    assert backend.lookup_file('session', 'a.mp3') == {"node_id": 'node-b', "node_url": 'http://10.0.0.2:8080', "public_url": 'https://b.example.com'}
+    backend.forget_file('session', 'a.mp3')
+    assert backend.lookup_file('session', 'a.mp3') is None
+    assert len(opened) == 4
+    for connection in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+
+
+def test_sqlite_backend_adds_public_url_to_existing_table(tmp_path):
+    path = str(tmp_path / 'old.sqlite3')
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE session_files (session_id TEXT NOT NULL, filename TEXT NOT NULL, node_id TEXT NOT NULL, "
+        "node_url TEXT, created_at REAL NOT NULL, PRIMARY KEY (session_id, filename))"
+    )
+    connection.close()
+    backend = app.SQLiteSessionStateBackend(path, ttl_seconds=60)
+    backend.register_file('session', 'a.mp3', 'node-b', 'http://10.0.0.2:8080')
+    assert backend.lookup_file('session', 'a.mp3')["public_url"] is None
+
+
+@pytest.fixture
+def remote_owner(backend, monkeypatch):
+    monkeypatch.setattr(app, 'SESSION_STATE', backend)
+    monkeypatch.setattr(app, 'SERVE_FILE_FORWARD_MODE', 'redirect')
+    proxied = []
+
+    class FakeUpstream(io.BytesIO):
+        status = 200
+        headers = {'Content-Type': 'audio/mpeg'}
+
+    def fake_urlopen(upstream_request, timeout):
+        proxied.append(upstream_request.full_url)
+        return FakeUpstream(b'audio')
+
+    monkeypatch.setattr(app, 'urlopen', fake_urlopen)
+    return proxied
+
+
+def test_redirect_goes_to_public_url_of_owner(backend, remote_owner):
+    backend.register_file('session', 'a.mp3', 'node-b', 'http://10.0.0.2:8080', 'https://b.example.com')
+    with app.app.test_request_context('/serve_file/session/a.mp3'):
+        response = app.forward_to_owner_node('session', 'a.mp3')
+    assert response.status_code == 307
+    assert response.headers['Location'] == 'https://b.example.com/serve_file/session/a.mp3'
+    assert remote_owner == []
+
+
+def test_redirect_without_public_url_proxies_through_internal_address(backend, remote_owner):
+    backend.register_file('session', 'a.mp3', 'node-b', 'http://10.0.0.2:8080')
+    with app.app.test_request_context('/serve_file/session/a.mp3'):
+        response = app.forward_to_owner_node('session', 'a.mp3')
+        assert response.status_code == 200
+        assert b''.join(response.response) == b'audio'
+    assert remote_owner == ['http://10.0.0.2:8080/serve_file/session/a.mp3']
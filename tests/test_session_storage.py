@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return app.SessionStorage(str(tmp_path / 'disk'), str(tmp_path / 'ram'), max_session_bytes=100, max_file_bytes=40, budget_bytes=150)
+
+
+def write_file(path, size):
+    with open(path, 'wb') as media_file:
+        media_file.write(b'x' * size)
+
+
+def test_small_session_goes_to_memory_and_large_to_disk(storage):
+    os.makedirs(storage.memory_root)
+    assert storage.allocate('small', 50).startswith(storage.memory_root)
+    assert storage.allocate('large', 500).startswith(storage.disk_root)
+    assert storage.allocate('unknown').startswith(storage.disk_root)
+
+
+def test_pending_reservations_count_toward_budget(storage):
+    os.makedirs(storage.memory_root)
+    assert storage.allocate('a', 100).startswith(storage.memory_root)
+    assert storage.allocate('b', 60).startswith(storage.disk_root)
+    storage.settle('a')
+    assert storage.allocate('c', 60).startswith(storage.memory_root)
+
+
+def test_memory_usage_counts_written_files(storage):
+    os.makedirs(storage.memory_root)
+    path = storage.allocate('a', 100)
+    for index in range(3):
+        write_file(os.path.join(path, f'track{index}.mp3'), 40)
+    assert storage.settle('a') == {}
+    assert storage.allocate('b', 40).startswith(storage.disk_root)
+
+
+def test_settle_moves_oversized_files_to_disk(storage):
+    os.makedirs(storage.memory_root)
+    path = storage.allocate('a', 100)
+    write_file(os.path.join(path, 'big.mp3'), 60)
+    write_file(os.path.join(path, 'small.mp3'), 10)
+    write_file(os.path.join(path, app.MANIFEST_FILENAME), 5)
+    moved = storage.settle('a')
+    assert moved == {os.path.join(path, 'big.mp3'): os.path.join(storage.disk_root, 'a', 'big.mp3')}
+    assert os.path.isfile(os.path.join(storage.disk_root, 'a', 'big.mp3'))
+    assert os.path.isfile(os.path.join(path, 'small.mp3'))
+    assert os.path.isfile(os.path.join(path, app.MANIFEST_FILENAME))
+
+
+def test_usage_ignores_entries_removed_during_scan(storage, monkeypatch):
+    os.makedirs(storage.memory_root)
+    path = storage.allocate('a', 10)
+    write_file(os.path.join(path, 'kept.mp3'), 7)
+    write_file(os.path.join(path, 'served.mp3'), 5)
+    real_scandir = os.scandir
+
+    def racing_scandir(directory):
+        entries = list(real_scandir(directory))
+        # Файл отдан и удалён, а папка другой сессии очищена уже после листинга
+        if os.path.exists(os.path.join(path, 'served.mp3')):
+            os.remove(os.path.join(path, 'served.mp3'))
+        return iter(entries)
+
+    monkeypatch.setattr(app.os, 'scandir', racing_scandir)
+    assert storage._memory_usage() == 7
+    monkeypatch.undo()
+    storage.discard('a')
+    assert storage._memory_usage() == 0
+    assert storage.settle('a') == {}
+
+
+def test_discard_removes_all_tiers(storage):
+    os.makedirs(storage.memory_root)
+    memory_path = storage.allocate('a', 10)
+    disk_path = os.path.join(storage.disk_root, 'a')
+    os.makedirs(disk_path)
+    storage.discard('a')
+    assert not os.path.exists(memory_path) and not os.path.exists(disk_path)
+
+
+def test_settle_failure_keeps_successful_session(monkeypatch):
+    class FailingStorage:
+        def settle(self, session_id):
+            raise OSError("disk is full")
+
+    class Manifest:
+        relocated = False
+
+        def relocate(self, moved):
+            self.relocated = True
+
+    monkeypatch.setattr(app, 'SESSION_STORAGE', FailingStorage())
+    manifest = Manifest()
+    app.settle_session('a', manifest)
+    assert not manifest.relocated
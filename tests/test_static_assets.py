@@ -0,0 +1,39 @@
+import gzip
+import json
+
+import app
+
+
+def test_build_writes_manifest_with_relative_variants(tmp_path):
+    static_dir = tmp_path / 'static'
+    (static_dir / 'css').mkdir(parents=True)
+    (static_dir / 'css' / 'style.css').write_text('body { color: red; }\n' * 50)
+    build_dir = tmp_path / 'build'
+    assets = app.build_static_assets(str(static_dir), str(build_dir))
+    asset = assets['css/style.css']
+    assert asset["path"].startswith('css/style.') and asset["path"].endswith('.css')
+    assert asset["variants"]["gzip"] == asset["path"] + '.gz'
+    assert gzip.decompress((build_dir / asset["variants"]["gzip"]).read_bytes()) == (static_dir / 'css' / 'style.css').read_bytes()
+    with open(build_dir / app.ASSET_MANIFEST_FILENAME, encoding='utf-8') as manifest_file:
+        assert json.load(manifest_file) == assets
+    assert app.load_static_assets(str(build_dir)) == assets
+
+
+def test_missing_manifest_falls_back_to_static(tmp_path):
+    assert app.load_static_assets(str(tmp_path)) == {}
+
+
+def test_hashed_asset_is_served_from_prebuilt_manifest(tmp_path, monkeypatch):
+    static_dir = tmp_path / 'static'
+    static_dir.mkdir()
+    (static_dir / 'main.js').write_text('console.log("hi");\n' * 50)
+    build_dir = tmp_path / 'build'
+    assets = app.build_static_assets(str(static_dir), str(build_dir))
+    monkeypatch.setattr(app, 'ASSET_BUILD_DIR', str(build_dir))
+    monkeypatch.setattr(app, 'load_static_assets', lambda: app.json.load(open(build_dir / app.ASSET_MANIFEST_FILENAME)))
+    monkeypatch.setattr(app, '_STATIC_ASSETS', None)
+    monkeypatch.setattr(app, '_HASHED_ASSETS', None)
+    response = app.app.test_client().get(f"/hashed/{assets['main.js']['path']}", headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']